@@ -0,0 +1,186 @@
+"""
+Helpers for resuming a failed pipeline run. Every stage writes its
+outputs atomically (under a temporary name, renamed when complete) and
+leaves a completion marker in the interim directory; a resumed run
+skips stages up to the first one without a marker. When a stage fails,
+extracted archives and partially written files are removed.
+"""
+
+import os
+import json
+import shutil
+import zipfile
+import contextlib
+
+# The subdirectory of the interim directory holding completion markers
+CHECKPOINT_DIRNAME = 'checkpoints'
+
+# Suffix of files that are still being written
+TMP_SUFFIX = '.tmp'
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    Writes a file under a temporary name for the duration of a
+    with-block, renaming it when the block completes and removing it if
+    the block fails.
+
+    :param path: The path of the output.
+    :return: The temporary path to write to.
+    """
+    tmp_path = path + TMP_SUFFIX
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def archive_folder(zip_name):
+    """
+    Names the folder that a source archive unpacks into.
+
+    :param zip_name: The name of the archive (i.e. 'NAEP_ASSESS_STATES.zip').
+    :return: The folder name.
+    :rtype: str
+    """
+    return zip_name[:-len('.zip')]
+
+
+@contextlib.contextmanager
+def extracted_archive(input_dir, zip_name):
+    """
+    Unpacks a source archive into the working directory for the duration
+    of a with-block, removing it afterwards even if the block fails.
+
+    :param input_dir: The directory containing the archive.
+    :param zip_name: The name of the archive.
+    :return: The names of the files in the archive.
+    """
+    with zipfile.ZipFile(os.path.join(input_dir, zip_name), 'r') as input_data:
+        file_list = input_data.namelist()
+        file_list.remove(archive_folder(zip_name) + '/')
+        input_data.extractall(os.getcwd())
+
+    try:
+        yield file_list
+    finally:
+        shutil.rmtree(archive_folder(zip_name), ignore_errors=True)
+
+
+def marker_path(interim_dir, stage):
+    return os.path.join(interim_dir, CHECKPOINT_DIRNAME, stage + '.done')
+
+
+def is_complete(interim_dir, stage, options):
+    """
+    Checks whether a stage finished in an earlier run with the same options.
+
+    :param interim_dir: The interim directory.
+    :param stage: The name of the stage.
+    :param options: The options of the run (i.e. {'engine': 'pandas'}).
+    :return: True if the stage can be skipped.
+    :rtype: bool
+    """
+    path = marker_path(interim_dir, stage)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        return json.load(f) == options
+
+
+def mark_complete(interim_dir, stage, options):
+    """
+    Records that a stage finished.
+
+    :param interim_dir: The interim directory.
+    :param stage: The name of the stage.
+    :param options: The options of the run.
+    :return:
+    """
+    path = marker_path(interim_dir, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(options, f, sort_keys=True)
+
+
+def clear_checkpoints(interim_dir, stages=None):
+    """
+    Removes completion markers, so that the stages run again.
+
+    :param interim_dir: The interim directory.
+    :param stages: The stages to clear (defaults to all of them).
+    :return:
+    """
+    if stages is None:
+        shutil.rmtree(os.path.join(interim_dir, CHECKPOINT_DIRNAME), ignore_errors=True)
+        return
+    for stage in stages:
+        if os.path.exists(marker_path(interim_dir, stage)):
+            os.remove(marker_path(interim_dir, stage))
+
+
+def cleanup_partial(dirs, zip_names):
+    """
+    Removes partially written files and unpacked archives, i.e. those
+    left behind by a stage that failed or a run that was killed.
+
+    :param dirs: The directories holding outputs (searched recursively).
+    :param zip_names: The names of the archives unpacked into the working directory.
+    :return: The paths removed.
+    :rtype: list
+    """
+    removed = []
+    for top in dirs:
+        for root, _, filenames in os.walk(top):
+            for filename in sorted(filenames):
+                if filename.endswith(TMP_SUFFIX):
+                    os.remove(os.path.join(root, filename))
+                    removed.append(os.path.join(root, filename))
+
+    for zip_name in zip_names:
+        if os.path.isdir(archive_folder(zip_name)):
+            shutil.rmtree(archive_folder(zip_name), ignore_errors=True)
+            removed.append(archive_folder(zip_name))
+
+    return removed
+
+
+def run_stages(stages, interim_dir, options, resume=False, logger=None):
+    """
+    Runs the stages in order, marking each one complete. When resuming,
+    stages are skipped up to the first one that didn't complete (with
+    the same options); every stage after that runs again.
+
+    :param stages: A list of (name, function) pairs.
+    :param interim_dir: The interim directory.
+    :param options: The options of the run, recorded in each marker.
+    :param resume: Whether to skip stages completed by an earlier run.
+    :param logger:
+    :return: The names of the stages that ran.
+    :rtype: list
+    """
+    names = [name for name, _ in stages]
+    if not resume:
+        clear_checkpoints(interim_dir)
+
+    ran = []
+    for position, (name, function) in enumerate(stages):
+        if not ran and resume and is_complete(interim_dir, name, options):
+            if logger:
+                logger.info('Skipping ' + name + ', completed by an earlier run...')
+            continue
+
+        # Later stages depend on this one, so their markers no longer hold
+        if not ran:
+            clear_checkpoints(interim_dir, names[position:])
+
+        function()
+        mark_complete(interim_dir, name, options)
+        ran.append(name)
+
+    return ran
@@ -0,0 +1,269 @@
+"""
+A script for combining district finance data (U.S. Census) with district
+enrollment data (NCES) into a single CSV file, matching the differently
+spelled district names of the two sources.
+"""
+
+import re
+import os
+import numpy as np
+import pandas as pd
+from src import data_sanity_check, indexed_join, district_index, summary_views, output_writer, checkpoint, \
+    output_schema
+
+FINANCE_FILENAME = 'finance_districts.csv'
+ENROLL_FILENAME = 'enroll_districts.csv'
+
+OUTPUT_FILENAME = 'districts_all.csv'
+
+# Columns the sources are joined on
+INDEX_COLUMNS = ['DISTRICT_ID', 'YEAR']
+
+# Matches found so far, kept in the interim directory between runs
+MATCHES_FILENAME = 'district_matches.csv'
+MATCHES_COLUMNS = ['STATE', 'NAME', 'DISTRICT_ID', 'SCORE']
+
+# Names without a match on the last run, with their best candidate (for review)
+UNMATCHED_FILENAME = 'district_unmatched.csv'
+
+# Census finance columns mapped to the names used in states_all.csv
+FINANCE_COLUMNS = {'ENROLL': 'ENROLL',
+                   'TOTALREV': 'TOTAL_REVENUE',
+                   'TFEDREV': 'FEDERAL_REVENUE',
+                   'TSTREV': 'STATE_REVENUE',
+                   'TLOCREV': 'LOCAL_REVENUE',
+                   'TOTALEXP': 'TOTAL_EXPENDITURE',
+                   'TCURINST': 'INSTRUCTION_EXPENDITURE',
+                   'TCURSSVC': 'SUPPORT_SERVICES_EXPENDITURE',
+                   'TCURONON': 'OTHER_EXPENDITURE',
+                   'TCAPOUT': 'CAPITAL_OUTLAY_EXPENDITURE'}
+
+# Abbreviations used by the Census, spelled out as NCES spells them
+ABBREVIATIONS = {'CO': 'COUNTY', 'CTY': 'COUNTY', 'JT': 'JOINT', 'IND': 'INDEPENDENT', 'INDEP': 'INDEPENDENT',
+                 'CONS': 'CONSOLIDATED', 'CONSOL': 'CONSOLIDATED', 'CNTRL': 'CENTRAL', 'CEN': 'CENTRAL',
+                 'REG': 'REGIONAL', 'TWP': 'TOWNSHIP', 'VLY': 'VALLEY', 'MT': 'MOUNT', 'ST': 'SAINT'}
+
+# Words that say nothing about which district a name refers to
+STOP_WORDS = {'THE', 'OF', 'SCHOOL', 'SCHOOLS', 'SCH', 'DISTRICT', 'DIST', 'SD', 'PUBLIC', 'NO'}
+
+# Names are compared as sets of character n-grams
+NGRAM_SIZE = 3
+
+# The lowest similarity accepted as a match (a district number in one name
+# only, i.e. 'NAMPA 131' against 'NAMPA', scores about 0.75)
+MATCH_THRESHOLD = 0.7
+
+# Useful regular expressions
+nonalphanumeric = re.compile(r'[^A-Z0-9 ]')
+
+
+def normalize_name(name):
+    """
+    Reduces a district name to its distinguishing words, with
+    abbreviations spelled out
+    (i.e. 'Meridian Jt School District No. 2' to 'MERIDIAN JOINT 2').
+
+    :param name: A district name.
+    :return: The normalized name.
+    :rtype: str
+    """
+    words = nonalphanumeric.sub(' ', str(name).upper()).split()
+    words = [ABBREVIATIONS.get(word, word) for word in words if word not in STOP_WORDS]
+    return ' '.join(words)
+
+
+def ngrams(name):
+    """
+    Splits a normalized name into overlapping character n-grams.
+
+    :param name: A normalized name.
+    :return: The name's n-grams.
+    :rtype: set
+    """
+    padded = ' {0} '.format(name)
+    return set(padded[i:i + NGRAM_SIZE] for i in range(max(len(padded) - NGRAM_SIZE + 1, 1)))
+
+
+def ngram_matrix(names, vocabulary):
+    """
+    Encodes names as unit-length vectors of their n-grams, keeping only
+    the components in the vocabulary. Each name is scaled by the norm of
+    all its n-grams, so that n-grams outside the vocabulary still count
+    against it (otherwise a name would match any name it overlaps with).
+
+    :param names: Normalized names.
+    :param vocabulary: A dictionary of n-gram to column.
+    :return: One row per name.
+    :rtype: np.ndarray
+    """
+    matrix = np.zeros((len(names), len(vocabulary)), dtype='float32')
+    for row, name in enumerate(names):
+        grams = ngrams(name)
+        cols = [vocabulary[x] for x in grams if x in vocabulary]
+        matrix[row, cols] = 1 / len(grams) ** 0.5
+
+    return matrix
+
+
+def match_block(finance_names, enroll_names):
+    """
+    Finds the most similar enrollment name for each finance name within
+    a single block (state), scoring every pair at once by the cosine
+    similarity of their n-grams.
+
+    :param finance_names: Normalized finance names.
+    :param enroll_names: Normalized enrollment names.
+    :return: The position of the best enrollment name, and its score.
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    vocabulary = {}
+    for name in enroll_names:
+        for gram in ngrams(name):
+            vocabulary.setdefault(gram, len(vocabulary))
+
+    scores = ngram_matrix(finance_names, vocabulary) @ ngram_matrix(enroll_names, vocabulary).T
+    best = scores.argmax(axis=1)
+
+    return best, scores[np.arange(len(finance_names)), best]
+
+
+def match_districts(finance_df, dimension, cached_matches=None, logger=None):
+    """
+    Matches each (STATE, NAME) in the finance data to a DISTRICT_ID,
+    comparing names only against districts in the same state. Names
+    matched on an earlier run are taken from the cache. Names scoring
+    below the threshold (or in states without districts) are returned
+    separately, along with their best candidate, if any.
+
+    :param finance_df: District finance data.
+    :param dimension: The district dimension table.
+    :param cached_matches: Matches from earlier runs, if any.
+    :param logger:
+    :return: All matches, including cached ones, and the unmatched names.
+    :rtype: (pd.DataFrame, pd.DataFrame)
+    """
+    if cached_matches is None:
+        cached_matches = pd.DataFrame(columns=MATCHES_COLUMNS)
+
+    names = finance_df[['STATE', 'NAME']].drop_duplicates()
+    cached = names.set_index(['STATE', 'NAME']).index.isin(cached_matches.set_index(['STATE', 'NAME']).index)
+    names = names[~cached]
+    if logger:
+        logger.debug('Matching {0} district names ({1} cached)...'.format(len(names), cached.sum()))
+
+    matches = [cached_matches]
+    unmatched = [pd.DataFrame(columns=MATCHES_COLUMNS)]
+    for state, finance_block in names.groupby('STATE'):
+        enroll_block = dimension[dimension['STATE'] == state]
+        if enroll_block.empty:
+            unmatched.append(finance_block.assign(DISTRICT_ID=np.nan, SCORE=np.nan)[MATCHES_COLUMNS])
+            continue
+
+        finance_names = [normalize_name(x) for x in finance_block['NAME']]
+        enroll_names = [normalize_name(x) for x in enroll_block['AGENCY_NAME']]
+        best, score = match_block(finance_names, enroll_names)
+
+        block_matches = pd.DataFrame({'STATE': state,
+                                      'NAME': finance_block['NAME'].to_numpy(),
+                                      'DISTRICT_ID': enroll_block['DISTRICT_ID'].to_numpy()[best],
+                                      'SCORE': score})
+        matched = block_matches['SCORE'] >= MATCH_THRESHOLD
+        matches.append(block_matches[matched])
+        unmatched.append(block_matches[~matched])
+
+    matches = pd.concat(matches, ignore_index=True)
+    matches['DISTRICT_ID'] = matches['DISTRICT_ID'].astype('int64')
+    unmatched = pd.concat(unmatched, ignore_index=True)
+    if len(unmatched) and logger:
+        logger.warning('{0} district names have no match, i.e. {1}'.format(
+            len(unmatched), unmatched[['STATE', 'NAME']].head(3).values.tolist()))
+
+    return matches, unmatched
+
+
+def join_district_data(finance_df, enroll_df, matches, dimension, logger=None):
+    """
+    Joins matched finance data with enrollment summary columns on
+    DISTRICT_ID and YEAR, naming each district as NCES does.
+
+    :param finance_df: District finance data.
+    :param enroll_df: District enrollment data.
+    :param matches: Matches, as returned by match_districts.
+    :param dimension: The district dimension table.
+    :param logger:
+    :return: The joined data.
+    :rtype: pd.DataFrame
+    """
+    finance_df = finance_df.merge(matches[['STATE', 'NAME', 'DISTRICT_ID', 'SCORE']], on=['STATE', 'NAME'],
+                                  how='inner')
+    finance_df = finance_df.rename(columns=dict(FINANCE_COLUMNS, YRDATA='YEAR'))
+
+    # Two finance records can match the same district; keep the closer match
+    finance_df = finance_df.sort_values('SCORE', ascending=False, kind='stable')
+    duplicated = finance_df.duplicated(subset=INDEX_COLUMNS)
+    if duplicated.any() and logger:
+        logger.warning('Dropping {0} finance records matching a district already matched more closely, '
+                       'i.e. {1}'.format(duplicated.sum(),
+                                         finance_df.loc[duplicated, ['STATE', 'NAME']].head(3).values.tolist()))
+    finance_df = finance_df[~duplicated][INDEX_COLUMNS + list(FINANCE_COLUMNS.values())]
+
+    enroll_df = summary_views.ENROLL_SUMMARY.apply(enroll_df.dropna(subset=['DISTRICT_ID']), INDEX_COLUMNS)
+    enroll_df = enroll_df.astype({'DISTRICT_ID': 'int64'})
+
+    all_data, _ = indexed_join.indexed_join({'finance': finance_df, 'enroll': enroll_df}, INDEX_COLUMNS, logger)
+
+    names = dimension.set_index('DISTRICT_ID')
+    all_data.insert(0, 'PRIMARY_KEY', all_data['YEAR'].astype(str) + '_' + all_data['DISTRICT_ID'].astype(str))
+    all_data.insert(3, 'STATE', names['STATE'].reindex(all_data['DISTRICT_ID']).to_numpy())
+    all_data.insert(4, 'DISTRICT', names['AGENCY_NAME'].reindex(all_data['DISTRICT_ID']).to_numpy())
+
+    return all_data
+
+
+def load_matches(sanity_dir):
+    """
+    Loads matches from earlier runs, if any.
+
+    :param sanity_dir: The interim directory.
+    :return: The cached matches, or None.
+    :rtype: pd.DataFrame
+    """
+    matches_path = os.path.join(sanity_dir, MATCHES_FILENAME)
+    if not os.path.exists(matches_path):
+        return None
+    return pd.read_csv(matches_path)
+
+
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
+    # Notify user
+    logger.debug('Creating district aggregate file...')
+
+    # Load each input once
+    finance_data = output_writer.read_csv(input_dir, FINANCE_FILENAME)
+    enroll_data = output_writer.read_csv(input_dir, ENROLL_FILENAME)
+    dimension = district_index.load_dimension(input_dir)
+
+    # Match district names, then cache the matches for the next run (unmatched names are tried again)
+    matches, unmatched = match_districts(finance_data, dimension, load_matches(sanity_dir), logger)
+    with checkpoint.atomic_output(os.path.join(sanity_dir, MATCHES_FILENAME)) as tmp_path:
+        matches.to_csv(tmp_path, index=False)
+    with checkpoint.atomic_output(os.path.join(sanity_dir, UNMATCHED_FILENAME)) as tmp_path:
+        unmatched.to_csv(tmp_path, index=False)
+
+    all_data = join_district_data(finance_data, enroll_data, matches, dimension, logger)
+
+    output_schema.validate(all_data, OUTPUT_FILENAME)
+    output_path = os.path.join(output_dir, OUTPUT_FILENAME)
+    with checkpoint.atomic_output(output_path) as tmp_path:
+        all_data.to_csv(tmp_path, index=False)
+
+    # Sanity check
+    data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
+
+
+if __name__ == '__main__':
+    print('Beginning data conversion...')
+    print('')
+    main()
+    print('')
+    print('Finished.')
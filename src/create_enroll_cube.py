@@ -0,0 +1,224 @@
+"""
+A script for storing raw NCES enrollment data as a dense cube
+(YEAR x STATE/DISTRICT x GRADE x RACE x GENDER) in a memory-mapped
+NumPy file, alongside a JSON file describing the axis labels. Districts
+are labelled by their DISTRICT_ID.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from src import create_enroll_districts_csv, district_index, checkpoint
+
+# The name of the input CSV
+INPUT_FILENAME = 'enroll_states_raw.csv'
+
+# Cube names by input CSV, along with the name of the entity axis
+CUBE_SOURCES = {'enroll_states_raw.csv': ('enroll_states_cube', 'STATE'),
+                'enroll_districts_raw.csv': ('enroll_districts_cube', 'DISTRICT')}
+
+# The axes of the cube, in order; the entity axis is STATE or DISTRICT
+AXIS_ORDER = ['YEAR', None, 'GRADE', 'RACE', 'GENDER']
+
+# The label used by NCES for totals on the GRADE, RACE, and GENDER axes
+TOTAL_LABEL = 'A'
+
+# Separates the ends of a band of grades (i.e. 'G01-G08'), which NCES also provides totals for
+BAND_SEPARATOR = '-'
+
+# Counts stay exact in float32 up to 2^24, well above any state's enrollment
+CUBE_DTYPE = 'float32'
+
+
+def build_axes(data_cols, entity_axis, entity_labels):
+    """
+    Collects the labels for each axis of the cube from the column names.
+
+    :param data_cols: The <YEAR_GRADE_RACE_GENDER> columns.
+    :param entity_axis: The name of the entity axis (STATE or DISTRICT).
+    :param entity_labels: The labels for the entity axis, in row order.
+    :return: A dictionary of axis name to a dictionary of label to position.
+    :rtype: dict
+    """
+    specs = [create_enroll_districts_csv.find_specs(x) for x in data_cols]
+
+    axes = {}
+    for position, axis in enumerate(AXIS_ORDER):
+        if axis is None:
+            labels = list(entity_labels)
+            axes[entity_axis] = {label: i for i, label in enumerate(labels)}
+        else:
+            spec_idx = position if position == 0 else position - 1
+            labels = sorted(set(x[spec_idx] for x in specs))
+            axes[axis] = {label: i for i, label in enumerate(labels)}
+
+    return axes
+
+
+def district_labels(input_df, input_dir):
+    """
+    Labels each district by its DISTRICT_ID (see district_index), as
+    district names repeat across states (i.e. LINCOLN CO in OREGON and
+    WYOMING).
+
+    :param input_df: Raw district enrollment data.
+    :param input_dir: The directory containing districts.csv.
+    :return: The DISTRICT_ID of each row, as a string.
+    :rtype: list
+    """
+    dimension = district_index.load_dimension(input_dir)
+    if dimension is None:
+        raise ValueError(district_index.OUTPUT_FILENAME + ' is needed to label the districts of the cube')
+
+    ids = district_index.assign_district_ids(district_index.raw_districts(input_df), dimension)
+    if ids.isna().any():
+        raise ValueError('{0} districts are missing from {1}'.format(ids.isna().sum(),
+                                                                     district_index.OUTPUT_FILENAME))
+    return ids.astype('int64').astype(str).tolist()
+
+
+def build_cube(input_df, cube_path, entity_axis='STATE', entity_labels=None):
+    """
+    Writes raw enrollment data to a memory-mapped cube, one year at a time.
+    Combinations missing from the input are left as NaN.
+
+    :param input_df: Raw enrollment data, one row per state or district.
+    :param cube_path: The path of the .npy file to write.
+    :param entity_axis: The name of the entity axis (STATE or DISTRICT).
+    :param entity_labels: The label of each row (required for districts, see district_labels).
+    :return: A dictionary of axis name to a dictionary of label to position.
+    :rtype: dict
+    """
+    if entity_axis == 'DISTRICT':
+        data_cols = [x for x in input_df.columns if x not in create_enroll_districts_csv.RAW_KEY_COLUMNS]
+    else:
+        data_cols = input_df.columns.to_list()[1:]
+        if entity_labels is None:
+            entity_labels = input_df['State Name'].str.replace(' ', '_', regex=False).tolist()
+
+    # Each row needs a position of its own on the entity axis
+    if entity_labels is None or len(set(entity_labels)) != len(input_df):
+        raise ValueError('The {0} axis needs a distinct label for each row'.format(entity_axis))
+
+    axes = build_axes(data_cols, entity_axis, entity_labels)
+    shape = tuple(len(x) for x in axes.values())
+
+    with checkpoint.atomic_output(cube_path) as tmp_path:
+        cube = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=CUBE_DTYPE, shape=shape)
+        cube[:] = np.nan
+
+        column_groups = create_enroll_districts_csv.group_columns_by_year(data_cols)
+        for year, cols in column_groups.items():
+            values = create_enroll_districts_csv.convert_column_group(input_df[cols])
+
+            specs = [create_enroll_districts_csv.find_specs(x) for x in cols]
+            grade_idx = [axes['GRADE'][x[1]] for x in specs]
+            race_idx = [axes['RACE'][x[2]] for x in specs]
+            gender_idx = [axes['GENDER'][x[3]] for x in specs]
+
+            cube[axes['YEAR'][year], :, grade_idx, race_idx, gender_idx] = values.T
+
+        cube.flush()
+        del cube
+
+    return axes
+
+
+def load_cube(input_dir, cube_name):
+    """
+    Opens a cube without reading it into memory.
+
+    :param input_dir: The directory containing the cube.
+    :param cube_name: The cube's name, i.e. 'enroll_states_cube'.
+    :return: The memory-mapped cube and its axes.
+    :rtype: (np.ndarray, dict)
+    """
+    cube = np.load(os.path.join(input_dir, cube_name + '.npy'), mmap_mode='r')
+    with open(os.path.join(input_dir, cube_name + '.json')) as f:
+        axis_labels = json.load(f)['axes']
+
+    axes = {axis: {label: i for i, label in enumerate(labels)} for axis, labels in axis_labels}
+
+    return cube, axes
+
+
+def cube_slice(cube, axes, **selection):
+    """
+    Selects a single label on any number of axes, i.e.
+    cube_slice(cube, axes, YEAR='2017', STATE='IDAHO'). Only the selected
+    part of a memory-mapped cube is read.
+
+    :param cube: The cube (or a previous slice of it).
+    :param axes: The axes of the cube.
+    :param selection: Axis names mapped to the label to select.
+    :return: The sliced cube and its remaining axes.
+    :rtype: (np.ndarray, dict)
+    """
+    index = []
+    remaining_axes = {}
+    for axis, labels in axes.items():
+        if axis in selection:
+            index.append(labels[str(selection[axis])])
+        else:
+            index.append(slice(None))
+            remaining_axes[axis] = labels
+
+    return cube[tuple(index)], remaining_axes
+
+
+def cube_rollup(cube, axes, axis):
+    """
+    Sums over one axis (i.e. over RACE), leaving out the NCES-provided
+    totals on that axis (both the overall total and bands of grades).
+    Cells with no data on the axis stay NaN.
+
+    :param cube: The cube (or a slice of it).
+    :param axes: The axes of the cube.
+    :param axis: The name of the axis to sum over.
+    :return: The rolled-up cube and its remaining axes.
+    :rtype: (np.ndarray, dict)
+    """
+    axis_pos = list(axes.keys()).index(axis)
+    members = [i for label, i in axes[axis].items() if label != TOTAL_LABEL and BAND_SEPARATOR not in label]
+
+    # Summing over the last axis leaves a scalar, so the result is kept as a (0-d) array
+    values = np.take(cube, members, axis=axis_pos)
+    totals = np.nansum(values, axis=axis_pos, dtype='float64')
+    totals = np.where(np.isnan(values).all(axis=axis_pos), np.nan, totals)
+
+    remaining_axes = {name: labels for name, labels in axes.items() if name != axis}
+
+    return totals, remaining_axes
+
+
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, input_filename=INPUT_FILENAME):
+    # Notify user
+    logger.debug('Parsing ' + str(input_filename) + '...')
+
+    # Unpack the data
+    input_data = pd.read_csv(os.path.join(input_dir, input_filename), dtype={'Agency ID': str})
+    cube_name, entity_axis = CUBE_SOURCES[input_filename]
+
+    # Drop districts w/ no associated State Name
+    input_data = input_data[input_data['State Name'].notna()]
+
+    # Output as cube, with its axis labels alongside
+    entity_labels = district_labels(input_data, input_dir) if entity_axis == 'DISTRICT' else None
+    axes = build_cube(input_data, os.path.join(output_dir, cube_name + '.npy'), entity_axis, entity_labels)
+
+    metadata = {'axes': [[axis, list(labels.keys())] for axis, labels in axes.items()]}
+    if entity_axis == 'DISTRICT':
+        metadata['district_names'] = input_data['Agency Name'].tolist()
+        metadata['district_states'] = input_data['State Name'].tolist()
+    with checkpoint.atomic_output(os.path.join(output_dir, cube_name + '.json')) as tmp_path:
+        with open(tmp_path, 'w+') as f:
+            json.dump(metadata, f)
+
+
+if __name__ == '__main__':
+    print('Beginning data conversion...')
+    print('')
+    main()
+    print('')
+    print('Finished.')
@@ -5,9 +5,14 @@ single CSV file.
 
 import re
 import os
+import contextlib
+import multiprocessing
+import numpy as np
 import pandas as pd
+from pandas._libs.sparse import IntIndex
 import us  # US metadata, like state names
-from src import data_sanity_check
+from src import data_sanity_check, frame_handoff, tidy_data, district_index, polars_engine, output_writer, \
+    checkpoint, output_schema
 
 # Disable warnings for Pandas dataframe assignments
 pd.options.mode.chained_assignment = None  # default='warn'
@@ -18,6 +23,15 @@ INPUT_FILENAME = 'enroll_districts_raw.csv'
 # The name of the output CSVs
 OUTPUT_FILENAME = 'enroll_districts.csv'
 
+# The name of the sparse (COO) output
+OUTPUT_SPARSE_FILENAME = 'enroll_districts_sparse.npz'
+
+# Columns identifying each row, as opposed to data columns
+KEY_COLUMNS = ['PRIMARY_KEY', 'DISTRICT', 'DISTRICT_ID', 'YEAR']
+
+# Columns identifying each district in the raw data
+RAW_KEY_COLUMNS = ['Agency Name', 'State Name', 'Agency ID']
+
 # State names
 STATES = us.STATES
 
@@ -39,90 +53,291 @@ def find_specs(col_name):
     return spec_list
 
 
-def restructure_enroll_data(input_df):
+def group_columns_by_year(data_cols):
+    """
+    Splits <YEAR_GRADE_RACE_GENDER> columns into groups by survey year.
+
+    :param data_cols: The column names to group.
+    :return: A dictionary of year to column names, sorted by year.
+    :rtype: dict
+    """
+    column_groups = {}
+    for col_name in data_cols:
+        year = find_specs(col_name)[0]
+        column_groups.setdefault(year, []).append(col_name)
+
+    return dict(sorted(column_groups.items()))
+
+
+def convert_column_group(column_data):
+    """
+    Sets a group of columns to numeric, filtering out strings.
+    Runs in a worker process when restructuring in parallel.
+
+    :param column_data: The columns for a single column group.
+    :return: The converted values.
+    :rtype: np.ndarray
+    """
+    return column_data.apply(pd.to_numeric, errors='coerce').to_numpy(dtype='float64')
+
+
+def convert_published_column_group(group_spec):
+    """
+    Opens a single column group from a published dataframe and converts it.
+
+    :param group_spec: A tuple of (published frame path, column names).
+    :return: The converted values.
+    :rtype: np.ndarray
+    """
+    path, cols = group_spec
+    return convert_column_group(frame_handoff.open_frame(path, cols))
+
+
+def transform_column_groups(input_df, data_cols, processes=1, handoff_dir=None, engine='pandas', sparse=False):
+    """
+    Converts <YEAR_GRADE_RACE_GENDER> columns into <GRADE_RACE_GENDER>
+    columns, with one row per input row and year (years varying fastest).
+
+    Columns are independent of each other, so each year's group of columns
+    is converted separately. With processes > 1 the groups are converted in
+    a pool of worker processes. If a handoff directory is given, the input
+    is published there once and each worker memory-maps its own columns;
+    otherwise each worker is sent a pickled copy of its columns. With the
+    polars engine, every column is converted at once on Polars' own threads.
+
+    With sparse=True, each group is reduced to its non-null cells as soon
+    as it's converted, so the dense output is never built.
+
+    :param input_df: The input data, one row per state or district.
+    :param data_cols: The <YEAR_GRADE_RACE_GENDER> columns to convert.
+    :param processes: The number of worker processes to use.
+    :param handoff_dir: The interim directory used to share the input.
+    :param engine: The dataframe library doing the conversion ('pandas' or 'polars').
+    :param sparse: Whether to store the converted columns sparsely.
+    :return: The converted data.
+    :rtype: pd.DataFrame
+    """
+    column_groups = group_columns_by_year(data_cols)
+    year_range = list(column_groups.keys())
+
+    # Target columns keep the order in which they first appear
+    target_cols = []
+    for col_name in data_cols:
+        target_col = '_'.join(find_specs(col_name)[1:])
+        if target_col not in target_cols:
+            target_cols.append(target_col)
+    target_index = {target_col: i for i, target_col in enumerate(target_cols)}
+
+    with contextlib.ExitStack() as stack:
+        # Groups are converted lazily, so each is placed (and freed) before the next is kept
+        if engine == 'polars':
+            converted = polars_engine.convert_columns(input_df[data_cols])
+            col_positions = {col_name: i for i, col_name in enumerate(data_cols)}
+            group_values = (converted[:, [col_positions[x] for x in cols]] for cols in column_groups.values())
+        elif processes > 1 and handoff_dir:
+            handoff_name = 'enroll_columns_{0}'.format(os.getpid())
+            path = stack.enter_context(frame_handoff.published_frame(input_df[data_cols], handoff_name, handoff_dir))
+            pool = stack.enter_context(multiprocessing.Pool(processes))
+            group_values = pool.imap(convert_published_column_group, [(path, cols) for cols in column_groups.values()])
+        elif processes > 1:
+            pool = stack.enter_context(multiprocessing.Pool(processes))
+            group_values = pool.imap(convert_column_group, (input_df[cols] for cols in column_groups.values()))
+        else:
+            group_values = (convert_column_group(input_df[cols]) for cols in column_groups.values())
+
+        if sparse:
+            return sparse_column_groups(column_groups, group_values, target_index, len(input_df))
+
+        # Place each group into a (row, year, target column) array
+        output_values = np.full((len(input_df), len(year_range), len(target_cols)), np.nan)
+        for year_idx, (cols, values) in enumerate(zip(column_groups.values(), group_values)):
+            col_idx = [target_index['_'.join(find_specs(x)[1:])] for x in cols]
+            output_values[:, year_idx, col_idx] = values
+
+    output_values = output_values.reshape(-1, len(target_cols))
+    return pd.DataFrame(output_values, columns=target_cols)
+
+
+def sparse_column_groups(column_groups, group_values, target_index, row_count):
+    """
+    Places converted column groups into sparse <GRADE_RACE_GENDER>
+    columns, keeping only the non-null cells of each group.
+
+    :param column_groups: A dictionary of year to column names (see group_columns_by_year).
+    :param group_values: The converted values of each group, in the same order.
+    :param target_index: A dictionary of target column to position.
+    :param row_count: The number of input rows.
+    :return: The converted data, one row per input row and year (years varying fastest).
+    :rtype: pd.DataFrame
+    """
+    year_count = len(column_groups)
+    rows = {target_col: [] for target_col in target_index}
+    cells = {target_col: [] for target_col in target_index}
+    for year_idx, (cols, values) in enumerate(zip(column_groups.values(), group_values)):
+        for col_name, column in zip(cols, values.T):
+            present = np.flatnonzero(~np.isnan(column))
+            target_col = '_'.join(find_specs(col_name)[1:])
+            rows[target_col].append(present * year_count + year_idx)
+            cells[target_col].append(column[present])
+
+    data = {}
+    for target_col in target_index:
+        column_rows = np.concatenate(rows[target_col]) if rows[target_col] else np.array([], dtype='int64')
+        column_cells = np.concatenate(cells[target_col]) if cells[target_col] else np.array([])
+        order = np.argsort(column_rows, kind='stable')
+        data[target_col] = pd.arrays.SparseArray(
+            column_cells[order], sparse_index=IntIndex(row_count * year_count, column_rows[order].astype('int32')),
+            dtype=pd.SparseDtype('float64', np.nan))
+
+    return pd.DataFrame(data, index=pd.RangeIndex(row_count * year_count))
+
+
+def write_sparse(output_df, output_path):
+    """
+    Writes the non-null cells of the data columns in coordinate (COO)
+    format: a row index, column index, and value per cell, alongside
+    the key columns and column names.
+
+    :param output_df: The restructured enrollment data.
+    :param output_path: The path of the .npz file to write.
+    :return:
+    """
+    data_cols = [col for col in output_df.columns if col not in KEY_COLUMNS]
+
+    rows = []
+    cols = []
+    values = []
+    for col_idx, col_name in enumerate(data_cols):
+        column = output_df[col_name]
+        if isinstance(column.dtype, pd.SparseDtype):
+            row_idx = column.array.sp_index.to_int_index().indices
+            column_values = column.array.sp_values
+        else:
+            row_idx = np.flatnonzero(column.notna().to_numpy())
+            column_values = column.to_numpy()[row_idx]
+        rows.append(row_idx.astype('int32'))
+        cols.append(np.full(len(row_idx), col_idx, dtype='int32'))
+        values.append(column_values.astype('float64'))
+
+    # Written through a file object, as numpy would add .npz to the temporary name
+    with checkpoint.atomic_output(output_path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f,
+                                row=np.concatenate(rows),
+                                col=np.concatenate(cols),
+                                value=np.concatenate(values),
+                                columns=np.array(data_cols),
+                                **{key: output_df[key].to_numpy(dtype=str) for key in KEY_COLUMNS})
+
+
+def read_sparse(input_path):
+    """
+    Reads data written by write_sparse, keeping the data columns sparse.
+
+    :param input_path: The path of the .npz file.
+    :return: The restructured enrollment data.
+    :rtype: pd.DataFrame
+    """
+    with np.load(input_path) as input_data:
+        output_df = pd.DataFrame({key: input_data[key] for key in KEY_COLUMNS})
+        row = input_data['row']
+        col = input_data['col']
+        value = input_data['value']
+        data_cols = input_data['columns'].tolist()
+
+    # Cells are written column by column, so each column is a contiguous run
+    bounds = np.searchsorted(col, np.arange(len(data_cols) + 1))
+    data = {}
+    for col_idx, col_name in enumerate(data_cols):
+        start, end = bounds[col_idx], bounds[col_idx + 1]
+        column = np.full(len(output_df), np.nan)
+        column[row[start:end]] = value[start:end]
+        data[col_name] = pd.arrays.SparseArray(column, fill_value=np.nan)
+
+    output_df = pd.concat([output_df, pd.DataFrame(data)], axis=1)
+    output_df['DISTRICT_ID'] = pd.to_numeric(output_df['DISTRICT_ID'], errors='coerce').astype('Int64')
+    output_df['YEAR'] = output_df['YEAR'].astype(int)
+
+    return output_df
+
+
+def restructure_enroll_data(input_df, processes=1, handoff_dir=None, sparse=False, dimension=None,
+                            engine='pandas'):
     """
     Restructure enrollment data from NCES by putting
     rows in YEAR_STATE format.
 
+    :param input_df: The raw district enrollment data.
+    :param processes: The number of worker processes to use.
+    :param handoff_dir: The interim directory used to share data with workers.
+    :param sparse: Whether to store the data columns sparsely.
+    :param dimension: The district dimension table (built from the input if not given).
+    :param engine: The dataframe library doing the conversion ('pandas' or 'polars').
     :return:
     """
-    data_cols = input_df.columns.to_list()
-    ## Ignore the first two columns, "Agency Name" and "State Name"
-    data_cols = data_cols[2:]
+    ## Ignore the columns identifying each district
+    data_cols = [col for col in input_df.columns if col not in RAW_KEY_COLUMNS]
 
-    year_range = [find_specs(x)[0] for x in data_cols]
-    ## Remove duplicate years
-    year_range = sorted(list(set(year_range)))
+    year_range = list(group_columns_by_year(data_cols).keys())
 
     # Drop districts w/ no associated State Name
     input_df = input_df[input_df['State Name'].notna()]
 
-    # Combine districts and states into a single column
-    input_df['district_key_series'] = input_df['Agency Name'] + '_' + input_df['State Name']
-    district_list = sorted(list(set(input_df['district_key_series'].to_list())))
+    # Order districts by name and state
+    district_key_series = input_df['Agency Name'] + '_' + input_df['State Name']
+    input_df = input_df.loc[district_key_series.sort_values(kind='stable').index]
 
-    # For each district and year, create a primary key
-    output_df = pd.DataFrame()
-    primary_key = []
-    for district in district_list:
-        for year in year_range:
-            primary_key.append('{0}_{1}'.format(year, str(district).upper()))
+    # Identify each district by its DISTRICT_ID
+    districts = district_index.raw_districts(input_df)
+    if dimension is None:
+        dimension = district_index.update_dimension(districts)
+    district_ids = district_index.assign_district_ids(districts, dimension)
 
-    output_df['PRIMARY_KEY'] = primary_key
-    output_df['DISTRICT'] = [x.split('_')[1] for x in output_df['PRIMARY_KEY']]
-    output_df['YEAR'] = [x.split('_')[0] for x in output_df['PRIMARY_KEY']]
+    # For each district and year, create a primary key (names repeat within a state, so use the DISTRICT_ID)
+    district_count = len(input_df)
+    years = pd.Series(np.tile(year_range, district_count))
+    output_df = pd.DataFrame()
+    output_df['DISTRICT_ID'] = pd.array(np.repeat(district_ids.to_numpy(), len(year_range)), dtype='Int64')
+    output_df.insert(0, 'PRIMARY_KEY', years + '_' + output_df['DISTRICT_ID'].astype(str))
+    output_df.insert(1, 'DISTRICT', np.repeat(input_df['Agency Name'].str.upper().to_numpy(), len(year_range)))
+    output_df['YEAR'] = years
 
     # Convert each <YEAR_GRADE_RACE_GENDER> column,
     # producing <GRADE_RACE_GENDER> columns
-    for col_name in data_cols:
-        ## Generate the new column
-        year = find_specs(col_name)[0]
-        new_col_name = col_name.replace('{0}_'.format(year), '')
-        output_df[new_col_name] = pd.Series()
-
-    # Populate the output dataframe using the input dataframe
-    ## There has to be a nicer way to do this...
-    for col_name in data_cols:
-        # Parse the column name
-        specs = find_specs(col_name)
-        year = specs[0]
-        grade = specs[1]
-        race = specs[2]
-        gender = specs[3]
-
-        # Import rows from the input data into the output dataframe
-        column_data = input_df[['district_key_series', col_name]]
-        target_col = '{0}_{1}_{2}'.format(grade, race, gender)
-        target_col_data = output_df[['DISTRICT', 'YEAR', target_col]]
-        target_col_data = target_col_data[(target_col_data['YEAR'].str.contains(year))]
-
-        ## Avoid dealing with index issues by converting to list
-        target_col_data[target_col] = column_data[col_name].to_list()
-
-        # Set the column type to numeric, filtering out strings
-        target_col_data[target_col] = pd.to_numeric(target_col_data[target_col], errors='coerce')
-
-        output_df[target_col].update(target_col_data[target_col])
+    data_df = transform_column_groups(input_df, data_cols, processes, handoff_dir, engine, sparse)
+    output_df = pd.concat([output_df, data_df], axis=1)
 
     return output_df
 
 
-def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, processes=1, sparse=False, tidy=False,
+         engine='pandas', compress=None):
     # Notify user
     logger.debug('Parsing ' + str(INPUT_FILENAME) + '...')
 
     # Unpack the data
-    input_data = pd.read_csv(os.path.join(input_dir, INPUT_FILENAME))
+    input_data = pd.read_csv(os.path.join(input_dir, INPUT_FILENAME), dtype={'Agency ID': str})
+
+    # Transform the data (YEAR_DISTRICT_ID format)
+    output_df = restructure_enroll_data(input_data, processes, sanity_dir, sparse,
+                                        district_index.load_dimension(input_dir), engine)
+
+    # Output as file. The published CSV keeps its wide format whether or not the data is stored sparsely
+    # (it's written a chunk at a time); the sparse cells are also written as COO, and --tidy writes them long.
+    output_schema.validate(output_df, OUTPUT_FILENAME)
+    output_writer.write_csv(output_df, output_dir, OUTPUT_FILENAME, compress)
 
-    # Transform the data (YEAR_DISTRICT_STATE format)
-    output_df = restructure_enroll_data(input_data)
+    if sparse:
+        logger.debug('Sparse data columns use {0:.1f} MB in memory'.format(
+            output_df.memory_usage(deep=False).sum() / 1e6))
+        write_sparse(output_df, os.path.join(output_dir, OUTPUT_SPARSE_FILENAME))
 
-    # Output as file
-    output_data_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    output_df.to_csv(output_data_path, index=False)
+    if tidy:
+        tidy_data.write_tidy(output_df, output_dir, OUTPUT_FILENAME, KEY_COLUMNS, tidy_data.ENROLL_DIMENSIONS)
 
     # Sanity check
-    data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
+    data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True,
+                           report_density=True)
 
 
 if __name__ == '__main__':
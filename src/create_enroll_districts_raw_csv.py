@@ -4,12 +4,10 @@ single CSV file.
 """
 
 import re
-import zipfile
 import os
 import pandas as pd
 import us  # US metadata, like state names
-import shutil
-from src import data_sanity_check
+from src import data_sanity_check, indexed_join, district_index, checkpoint, output_schema, parse_cache
 
 # Disable warnings for Pandas dataframe assignments
 pd.options.mode.chained_assignment = None  # default='warn'
@@ -20,6 +18,14 @@ OUTPUT_FILENAME = 'enroll_districts_raw.csv'
 # The name of the zip file being unpacked
 ZIP_NAME = 'NCES_ENROLL_DISTRICTS.zip'
 
+# Columns identifying a district across the exported files,
+# used when the exports don't all carry the NCES LEA ID
+KEY_COLUMNS = ['Agency Name', 'State Name']
+LEA_KEY_COLUMNS = ['Agency ID']
+
+# Columns describing a district rather than counting students, repeated in every export
+DESCRIPTIVE_COLUMNS = ['Agency Name', 'State Name', 'Agency ID']
+
 # State names
 STATES = us.STATES
 
@@ -71,6 +77,9 @@ def label_fixup(label_str):
     if 'Agency Name' in label_str:
         return 'Agency Name'
 
+    if 'Agency ID' in label_str:
+        return 'Agency ID'
+
     label_str = label_str.lower()
 
     # Survey Year
@@ -108,44 +117,113 @@ def label_fixup(label_str):
     return '{0}_{1}_{2}_{3}'.format(year_str, grade_str, race_str, gender_str)
 
 
+def merge_exports(exports, key_columns, logger=None):
+    """
+    Joins Table Generator exports on their key columns rather than by
+    row position, so exports that list different states or districts
+    can't misalign. Data columns already provided by an earlier export
+    are skipped rather than joined and dropped afterwards. Descriptive
+    columns (i.e. the district's name, when joining on its LEA ID) are
+    taken from the first export that has a value for each row, so a
+    district missing from one export keeps its name.
+
+    :param exports: A dictionary of filename to exported data.
+    :param key_columns: The columns identifying each row.
+    :param logger:
+    :return: The merged data, sorted by the key columns.
+    :rtype: pd.DataFrame
+    """
+    sources = {}
+    descriptions = None
+    seen_columns = set(key_columns)
+    for filename, df in exports.items():
+        descriptive_columns = [col for col in DESCRIPTIVE_COLUMNS if col in df.columns and col not in key_columns]
+        new_columns = [col for col in df.columns if col not in seen_columns and col not in descriptive_columns]
+        seen_columns.update(new_columns)
+        if not new_columns and not descriptive_columns:
+            continue
+
+        # Handle whitespace issues related to names in source data
+        df = df[key_columns + descriptive_columns + new_columns].dropna(subset=key_columns)
+        for col in key_columns:
+            df[col] = df[col].astype(str).str.strip()
+
+        duplicated = df.duplicated(subset=key_columns)
+        if duplicated.any():
+            logger.debug('Dropping {0} repeated keys from {1}'.format(duplicated.sum(), filename))
+            df = df[~duplicated]
+
+        if descriptive_columns:
+            described = df.set_index(key_columns)[descriptive_columns]
+            descriptions = described if descriptions is None else descriptions.combine_first(described)
+        if new_columns:
+            sources[filename] = df[key_columns + new_columns]
+
+    output_df, coverage = indexed_join.indexed_join(sources, key_columns, logger)
+
+    # Fill in the descriptive columns, following the key columns
+    if descriptions is not None:
+        described = descriptions.reindex(output_df.set_index(key_columns).index)
+        for position, col in enumerate(descriptions.columns, len(key_columns)):
+            output_df.insert(position, col, described[col].to_numpy())
+
+    # Report keys that some exports are missing
+    for row in coverage.itertuples():
+        if row.MATCHED < len(output_df):
+            missing = output_df[key_columns][~output_df.set_index(key_columns).index.isin(
+                sources[row.SOURCE].set_index(key_columns).index)]
+            logger.info('{0} is missing {1} keys, i.e. {2}'.format(
+                row.SOURCE, len(output_df) - row.MATCHED, missing.head(3).values.tolist()))
+
+    return output_df
+
+
+def export_to_dataframe(filename, logger=None):
+    """
+    Converts an NCES table export to a Pandas dataframe, with simplified
+    column labels.
+
+    :param filename: The name of the csv file.
+    :return: The export.
+    :rtype: pd.DataFrame
+    """
+    # Notify user
+    logger.debug('Parsing ' + str(filename) + '...')
+
+    # Read in the input file, skipping the first six rows and last seven rows
+    # This chops off the header and footer text
+    df = pd.read_csv(filename, skiprows=6, skipfooter=7, engine='python', dtype={'Agency ID': str})
+
+    # Fix the column headers
+    return df.rename(mapper=label_fixup, axis=1)
+
+
 def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
-    # Unpack the data
-    input_data_path = os.path.join(input_dir, ZIP_NAME)
-    input_data = zipfile.ZipFile(input_data_path, 'r')
-    file_list = input_data.namelist()
-    file_list.remove(ZIP_NAME.strip('.zip') + '/')
-    input_data.extractall(os.getcwd())
-    input_data.close()
-
-    # Combine the data into a single dataframe
-    df_list = []
-    for item in file_list:
-        if '/.' not in item:
-            # Notify user
-            logger.debug('Parsing ' + str(item) + '...')
-
-            # Read in the input file, skipping the first six rows and last seven rows
-            # This chops off the header and footer text
-            df = pd.read_csv(item, skiprows=6, skipfooter=7, engine='python')
-
-            # Fix the column headers
-            df.rename(mapper=label_fixup, axis=1, inplace=True)
-            # print(df)
-
-            # Append it to the join list
-            df_list.append(df)
-
-    # Merge the dataframes
-    output_df = pd.concat(df_list, axis=1)
-
-    # Remove duplicates
-    output_df = output_df.loc[:, ~output_df.columns.duplicated()]
+    # Unpack the data (removed again once it's read, even if reading fails)
+    with checkpoint.extracted_archive(input_dir, ZIP_NAME) as file_list:
+        # Combine the data into a single dataframe
+        exports = {}
+        for item in file_list:
+            if '/.' not in item:
+                exports[item] = parse_cache.parse(item, export_to_dataframe, logger)
+
+    # Merge the dataframes by district, preferring the LEA ID
+    if all('Agency ID' in df.columns for df in exports.values()):
+        for df in exports.values():
+            df['Agency ID'] = district_index.normalize_lea_ids(df['Agency ID'])
+        output_df = merge_exports(exports, LEA_KEY_COLUMNS, logger)
+    else:
+        output_df = merge_exports(exports, KEY_COLUMNS, logger)
 
     # Sort the column names
     column_names = output_df.columns.tolist()
     column_names = sorted(list(set(column_names)))
 
-    # Place 'Agency Name' and 'State Name' as first two columns
+    # Place 'Agency Name', 'State Name', and 'Agency ID' (if any) as the first columns
+    if 'Agency ID' in column_names:
+        column_names.remove('Agency ID')
+        column_names.insert(0, 'Agency ID')
+
     column_names.remove('State Name')
     column_names.insert(0, 'State Name')
 
@@ -154,20 +232,15 @@ def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
 
     output_df = output_df[column_names]
 
-    # Handle whitespace issues related to district names in source data
-    output_df['Agency Name'] = output_df[['Agency Name']].applymap(lambda x: str(x).strip())
-    output_df.drop_duplicates(subset='Agency Name', inplace=True)
-
     # Output as file
+    output_schema.validate(output_df, OUTPUT_FILENAME)
     output_data_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    output_df.to_csv(output_data_path, index=False)
+    with checkpoint.atomic_output(output_data_path) as tmp_path:
+        output_df.to_csv(tmp_path, index=False)
 
     # Sanity check
     data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME)
 
-    # Clean up
-    shutil.rmtree(ZIP_NAME.strip('.zip') + '/')
-
 
 if __name__ == '__main__':
     print('Beginning data conversion...')
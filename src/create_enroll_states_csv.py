@@ -7,7 +7,7 @@ import re
 import os
 import pandas as pd
 import us  # US metadata, like state names
-from src import data_sanity_check
+from src import data_sanity_check, create_enroll_districts_csv, tidy_data, checkpoint, output_schema
 
 # Disable warnings for Pandas dataframe assignments
 pd.options.mode.chained_assignment = None  # default='warn'
@@ -18,6 +18,9 @@ INPUT_FILENAME = 'enroll_states_raw.csv'
 # The name of the output CSVs
 OUTPUT_FILENAME = 'enroll_states.csv'
 
+# Columns identifying each row, as opposed to data columns
+KEY_COLUMNS = ['PRIMARY_KEY', 'STATE', 'YEAR']
+
 # State names
 STATES = us.STATES
 
@@ -39,25 +42,28 @@ def find_specs(col_name):
     return spec_list
 
 
-def restructure_enroll_data(input_df):
+def restructure_enroll_data(input_df, processes=1, handoff_dir=None, engine='pandas'):
     """
     Restructure enrollment data from NCES by putting
     rows in YEAR_STATE format.
 
+    :param input_df: The raw state enrollment data.
+    :param processes: The number of worker processes to use.
+    :param handoff_dir: The interim directory used to share data with workers.
+    :param engine: The dataframe library doing the conversion ('pandas' or 'polars').
     :return:
     """
     data_cols = input_df.columns.to_list()
     ## Ignore the first column, "STATE_NAME"
     data_cols = data_cols[1:]
 
-    year_range = [find_specs(x)[0] for x in data_cols]
-    ## Remove duplicate years
-    year_range = sorted(list(set(year_range)))
+    year_range = list(create_enroll_districts_csv.group_columns_by_year(data_cols).keys())
 
     # For each state and year, create a primary key
+    ## Taken from the rows themselves, as us.STATES doesn't always list DC in alphabetical order
     output_df = pd.DataFrame()
     primary_key = []
-    for state in STATES:
+    for state in input_df['State Name']:
         for year in year_range:
             primary_key.append('{0}_{1}'.format(year, str(state).upper()))
 
@@ -67,44 +73,18 @@ def restructure_enroll_data(input_df):
 
     # Convert each <YEAR_GRADE_RACE_GENDER> column,
     # producing <GRADE_RACE_GENDER> columns
-    for col_name in data_cols:
-        ## Generate the new column
-        year = find_specs(col_name)[0]
-        new_col_name = col_name.replace('{0}_'.format(year), '')
-        output_df[new_col_name] = pd.Series()
-
-    # Populate the output dataframe using the input dataframe
-    ## There has to be a nicer way to do this...
-    for col_name in data_cols:
-        # Parse the column name
-        specs = find_specs(col_name)
-        year = specs[0]
-        grade = specs[1]
-        race = specs[2]
-        gender = specs[3]
-
-        # Import rows from the input data into the output dataframe
-        column_data = input_df[['State Name', col_name]]
-        target_col = '{0}_{1}_{2}'.format(grade, race, gender)
-        target_col_data = output_df[['STATE', 'YEAR', target_col]]
-        target_col_data = target_col_data[(target_col_data['YEAR'].str.contains(year))]
-
-        ## Avoid dealing with index issues by converting to list
-        target_col_data[target_col] = column_data[col_name].to_list()
-
-        # Set the column type to numeric, filtering out strings
-        target_col_data[target_col] = pd.to_numeric(target_col_data[target_col], errors='coerce')
-
-        output_df[target_col].update(target_col_data[target_col])
+    data_df = create_enroll_districts_csv.transform_column_groups(input_df, data_cols, processes,
+                                                                  handoff_dir, engine)
+    output_df = pd.concat([output_df, data_df], axis=1)
 
     # Replace spaces in state names with underscores
-    output_df['PRIMARY_KEY'] = output_df['PRIMARY_KEY'].apply(lambda x: x.replace(' ', '_'))
-    output_df['STATE'] = output_df['STATE'].apply(lambda x: x.replace(' ', '_'))
+    output_df['PRIMARY_KEY'] = output_df['PRIMARY_KEY'].str.replace(' ', '_', regex=False)
+    output_df['STATE'] = output_df['STATE'].str.replace(' ', '_', regex=False)
 
     return output_df
 
 
-def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, processes=1, tidy=False, engine='pandas'):
     # Notify user
     logger.debug('Parsing ' + str(INPUT_FILENAME) + '...')
 
@@ -112,11 +92,16 @@ def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
     input_data = pd.read_csv(os.path.join(input_dir, INPUT_FILENAME))
 
     # Transform the data (YEAR_STATE format)
-    output_df = restructure_enroll_data(input_data)
+    output_df = restructure_enroll_data(input_data, processes, sanity_dir, engine)
 
     # Output as file
+    output_schema.validate(output_df, OUTPUT_FILENAME)
     output_data_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    output_df.to_csv(output_data_path, index=False)
+    with checkpoint.atomic_output(output_data_path) as tmp_path:
+        output_df.to_csv(tmp_path, index=False)
+
+    if tidy:
+        tidy_data.write_tidy(output_df, output_dir, OUTPUT_FILENAME, KEY_COLUMNS, tidy_data.ENROLL_DIMENSIONS)
 
     # Sanity check
     data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
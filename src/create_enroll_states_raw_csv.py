@@ -4,12 +4,10 @@ single CSV file.
 """
 
 import re
-import zipfile
 import os
 import pandas as pd
 import us  # US metadata, like state names
-import shutil
-from src import data_sanity_check
+from src import data_sanity_check, create_enroll_districts_raw_csv, checkpoint, output_schema, parse_cache
 
 # Disable warnings for Pandas dataframe assignments
 pd.options.mode.chained_assignment = None  # default='warn'
@@ -20,6 +18,9 @@ OUTPUT_FILENAME = 'enroll_states_raw.csv'
 # The name of the zip file being unpacked
 ZIP_NAME = 'NCES_ENROLL_STATES.zip'
 
+# Columns identifying a state across the exported files
+KEY_COLUMNS = ['State Name']
+
 # State names
 STATES = us.STATES
 
@@ -105,38 +106,37 @@ def label_fixup(label_str):
     return '{0}_{1}_{2}_{3}'.format(year_str, grade_str, race_str, gender_str)
 
 
+def export_to_dataframe(filename, logger=None):
+    """
+    Converts an NCES table export to a Pandas dataframe, with simplified
+    column labels.
+
+    :param filename: The name of the csv file.
+    :return: The export.
+    :rtype: pd.DataFrame
+    """
+    # Notify user
+    logger.debug('Parsing ' + str(filename) + '...')
+
+    # Read in the input file, skipping the first six rows and last seven rows
+    # This chops off the header and footer text
+    df = pd.read_csv(filename, skiprows=6, skipfooter=7, engine='python')
+
+    # Fix the column headers
+    return df.rename(mapper=label_fixup, axis=1)
+
+
 def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
-    # Unpack the data
-    input_data_path = os.path.join(input_dir, ZIP_NAME)
-    input_data = zipfile.ZipFile(input_data_path, 'r')
-    file_list = input_data.namelist()
-    file_list.remove(ZIP_NAME.strip('.zip') + '/')
-    input_data.extractall(os.getcwd())
-    input_data.close()
-
-    # Combine the data into a single dataframe
-    df_list = []
-    for item in file_list:
-        if '/.' not in item:
-            # Notify user
-            logger.debug('Parsing ' + str(item) + '...')
-
-            # Read in the input file, skipping the first six rows and last seven rows
-            # This chops off the header and footer text
-            df = pd.read_csv(item, skiprows=6, skipfooter=7, engine='python')
-
-            # Fix the column headers
-            df.rename(mapper=label_fixup, axis=1, inplace=True)
-            # print(df)
-
-            # Append it to the join list
-            df_list.append(df)
-
-    # Merge the dataframes
-    output_df = pd.concat(df_list, axis=1)
-
-    # Remove duplicates
-    output_df = output_df.loc[:, ~output_df.columns.duplicated()]
+    # Unpack the data (removed again once it's read, even if reading fails)
+    with checkpoint.extracted_archive(input_dir, ZIP_NAME) as file_list:
+        # Combine the data into a single dataframe
+        exports = {}
+        for item in file_list:
+            if '/.' not in item:
+                exports[item] = parse_cache.parse(item, export_to_dataframe, logger)
+
+    # Merge the dataframes by state
+    output_df = create_enroll_districts_raw_csv.merge_exports(exports, KEY_COLUMNS, logger)
 
     # Sort the column names
     column_names = output_df.columns.tolist()
@@ -149,15 +149,14 @@ def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
     output_df = output_df[column_names]
 
     # Output as file
+    output_schema.validate(output_df, OUTPUT_FILENAME)
     output_data_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    output_df.to_csv(output_data_path, index=False)
+    with checkpoint.atomic_output(output_data_path) as tmp_path:
+        output_df.to_csv(tmp_path, index=False)
 
     # Sanity check
     data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME)
 
-    # Clean up
-    shutil.rmtree(ZIP_NAME.strip('.zip') + '/')
-
 
 if __name__ == '__main__':
     print('Beginning data conversion...')
@@ -0,0 +1,165 @@
+"""
+A script for precomputing enrollment roll-ups (every combination of
+grade, race, and gender totals) from the state enrollment cube, and
+reconciling them against the totals provided by NCES.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from src import data_sanity_check, create_enroll_cube, checkpoint, output_schema
+
+# The name of the input cube
+CUBE_NAME = 'enroll_states_cube'
+
+# The name of the output CSV
+OUTPUT_FILENAME = 'enroll_states_rollup.csv'
+
+# Roll-up labels per axis, mapped to the labels they sum over
+# (None means every label that isn't itself a roll-up)
+GRADE_ROLLUPS = {'A': None,
+                 'G01-G08': ['G01', 'G02', 'G03', 'G04', 'G05', 'G06', 'G07', 'G08'],
+                 'G09-G12': ['G09', 'G10', 'G11', 'G12'],
+                 'KG-G12': ['KG', 'G01', 'G02', 'G03', 'G04', 'G05', 'G06', 'G07', 'G08', 'G09', 'G10',
+                            'G11', 'G12']}
+RACE_ROLLUPS = {'A': None}
+GENDER_ROLLUPS = {'A': None}
+
+# Computed and provided totals further apart than this are flagged
+MISMATCH_TOLERANCE = 0.5
+
+
+def aggregation_matrix(labels, rollups):
+    """
+    Builds a matrix that maps an axis onto its detail labels followed by
+    its roll-up labels.
+
+    :param labels: The axis labels, mapped to their positions.
+    :param rollups: Roll-up labels mapped to the labels they sum over.
+    :return: The output labels and the aggregation matrix.
+    :rtype: (list, np.ndarray)
+    """
+    details = [label for label in labels if label not in rollups]
+    output_labels = details + list(rollups.keys())
+
+    matrix = np.zeros((len(output_labels), len(labels)))
+    for i, label in enumerate(details):
+        matrix[i, labels[label]] = 1
+    for i, (label, members) in enumerate(rollups.items(), start=len(details)):
+        members = details if members is None else members
+        for member in members:
+            if member in labels:
+                matrix[i, labels[member]] = 1
+
+    return output_labels, matrix
+
+
+def provided_values(cube, axes, output_labels):
+    """
+    Looks up the NCES-provided value for every output label combination,
+    leaving NaN where NCES doesn't provide that combination.
+
+    :param cube: The enrollment cube.
+    :param axes: The axes of the cube.
+    :param output_labels: The output labels for the GRADE, RACE, and GENDER axes.
+    :return: The provided values, shaped like the computed roll-ups.
+    :rtype: np.ndarray
+    """
+    provided = np.asarray(cube, dtype='float64')
+    for axis_pos, (axis, labels) in enumerate(zip(['GRADE', 'RACE', 'GENDER'], output_labels), start=2):
+        index = np.array([axes[axis].get(label, -1) for label in labels])
+        provided = np.take(provided, np.maximum(index, 0), axis=axis_pos)
+
+        # Blank out labels that NCES doesn't provide
+        missing_shape = [1] * provided.ndim
+        missing_shape[axis_pos] = len(index)
+        provided = np.where((index < 0).reshape(missing_shape), np.nan, provided)
+
+    return provided
+
+
+def rollup_enroll_data(cube, axes):
+    """
+    Computes every grade/race/gender roll-up in one vectorized pass and
+    compares them against the NCES-provided totals.
+
+    :param cube: The enrollment cube.
+    :param axes: The axes of the cube.
+    :return: One row per state, year, grade, race, and gender.
+    :rtype: pd.DataFrame
+    """
+    output_labels = []
+    matrices = []
+    for axis, rollups in [('GRADE', GRADE_ROLLUPS), ('RACE', RACE_ROLLUPS), ('GENDER', GENDER_ROLLUPS)]:
+        labels, matrix = aggregation_matrix(axes[axis], rollups)
+        output_labels.append(labels)
+        matrices.append(matrix)
+
+    # Sum over present values, tracking how many were present
+    values = np.asarray(cube, dtype='float64')
+    present = ~np.isnan(values)
+    totals = np.einsum('ysgrx,Gg,Rr,Xx->ysGRX', np.nan_to_num(values), *matrices, optimize=True)
+    counts = np.einsum('ysgrx,Gg,Rr,Xx->ysGRX', present.astype('float64'), *matrices, optimize=True)
+    totals[counts == 0] = np.nan
+
+    provided = provided_values(cube, axes, output_labels)
+
+    index = pd.MultiIndex.from_product([list(axes['YEAR']), list(axes['STATE'])] + output_labels,
+                                       names=['YEAR', 'STATE', 'GRADE', 'RACE', 'GENDER'])
+    output_df = pd.DataFrame({'VALUE': totals.reshape(-1), 'NCES_VALUE': provided.reshape(-1)}, index=index)
+    output_df = output_df.reset_index()
+
+    # Drop combinations with no data at all
+    output_df = output_df[output_df['VALUE'].notna() | output_df['NCES_VALUE'].notna()]
+
+    output_df['DIFFERENCE'] = output_df['VALUE'] - output_df['NCES_VALUE']
+    output_df['MISMATCH'] = output_df['DIFFERENCE'].abs() > MISMATCH_TOLERANCE
+
+    output_df['YEAR'] = output_df['YEAR'].astype(int)
+    output_df.insert(0, 'PRIMARY_KEY', output_df['YEAR'].astype(str) + '_' + output_df['STATE'])
+
+    return output_df.reset_index(drop=True)
+
+
+def load_rollups(input_dir):
+    """
+    Loads the roll-ups, indexed for fast lookups, i.e.
+    rollups.loc[(2015, 'IDAHO', 'G04', 'A', 'F'), 'VALUE'].
+
+    :param input_dir: The directory containing the roll-up CSV.
+    :return: The roll-ups, indexed by YEAR, STATE, GRADE, RACE, and GENDER.
+    :rtype: pd.DataFrame
+    """
+    rollups = pd.read_csv(os.path.join(input_dir, OUTPUT_FILENAME))
+    rollups = rollups.set_index(['YEAR', 'STATE', 'GRADE', 'RACE', 'GENDER']).sort_index()
+
+    return rollups
+
+
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
+    # Notify user
+    logger.debug('Parsing ' + str(CUBE_NAME) + '...')
+
+    # Unpack the data
+    cube, axes = create_enroll_cube.load_cube(input_dir, CUBE_NAME)
+
+    # Compute and reconcile the roll-ups
+    output_df = rollup_enroll_data(cube, axes)
+    logger.debug('{0} roll-ups differ from the NCES-provided totals'.format(output_df['MISMATCH'].sum()))
+
+    # Output as file
+    output_schema.validate(output_df, OUTPUT_FILENAME)
+    output_data_path = os.path.join(output_dir, OUTPUT_FILENAME)
+    with checkpoint.atomic_output(output_data_path) as tmp_path:
+        output_df.to_csv(tmp_path, index=False)
+
+    # Sanity check
+    data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
+
+
+if __name__ == '__main__':
+    print('Beginning data conversion...')
+    print('')
+    main()
+    print('')
+    print('Finished.')
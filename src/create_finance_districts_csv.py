@@ -4,16 +4,17 @@ single CSV file.
 """
 
 import re
-import zipfile
-import os
 import pandas as pd
 import us  # US metadata, like state names
-import shutil
-from src import data_sanity_check
+from src import data_sanity_check, year_partitions, output_writer, checkpoint, output_schema, \
+    parse_cache
 
 # The name of the output CSV
 OUTPUT_FILENAME = 'finance_districts.csv'
 
+# The name of the year-partitioned output
+DATASET_NAME = 'finance_districts'
+
 # The name of the zip file being unpacked
 ZIP_NAME = 'US_CENSUS_FINANCE.zip'
 
@@ -36,11 +37,35 @@ SCHEMA = ['STATE',
 # State names
 STATES = us.STATES
 
+# Census state codes number the states and DC alphabetically
+# (us.STATES lists DC only with DC_STATEHOOD set)
+CENSUS_STATES = sorted(set(state.name for state in us.STATES) | {us.states.DC.name})
+
 # Useful regular expressions
 doublespace = re.compile(r'  ')
 numbersonly = re.compile(r'\d+')
 
 
+def survey_year(filename):
+    """
+    Converts the two-digit year in an elsect filename to a full year
+    (i.e. 'elsec17.xls' to '2017').
+
+    :param filename: The name of the xls file.
+    :return: The survey year.
+    :rtype: str
+    """
+    year = int(re.findall(numbersonly, filename)[0])
+    if year < 10:
+        year = '200' + str(year)
+    elif year < 50:
+        year = '20' + str(year)
+    else:
+        year = '19' + str(year)
+
+    return year
+
+
 def elsect_spreadsheet_to_dataframe(filename, logger=None):
     """
     Converts a elsect data spreadsheet to a Pandas dataframe.
@@ -57,13 +82,7 @@ def elsect_spreadsheet_to_dataframe(filename, logger=None):
 
     # Convert the year data to full years
     # Can't depend on spreadsheet value, so we'll do it by filename
-    year = int(re.findall(numbersonly, filename)[0])
-    if year < 10:
-        year = '200' + str(year)
-    elif year < 50:
-        year = '20' + str(year)
-    else:
-        year = '19' + str(year)
+    year = survey_year(filename)
 
     # Use year to determine state identifier
     # (column name changes in 2002)
@@ -81,7 +100,7 @@ def elsect_spreadsheet_to_dataframe(filename, logger=None):
 
     # Convert the state codes to state names
     data[st_code] = data[st_code].applymap(lambda x: x[:2])
-    data['STATE'] = data[st_code].applymap(lambda x: us.STATES[int(x) - 1])
+    data['STATE'] = data[st_code].applymap(lambda x: CENSUS_STATES[int(x) - 1])
     data['STATE'] = data['STATE'].apply(lambda x: str(x).upper())
     data = data.drop(st_code, axis=1)
 
@@ -94,34 +113,37 @@ def elsect_spreadsheet_to_dataframe(filename, logger=None):
     return data
 
 
-def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
-    # Unpack the data
-    input_data_path = os.path.join(input_dir, ZIP_NAME)
-    input_data = zipfile.ZipFile(input_data_path, 'r')
-    file_list = input_data.namelist()
-    file_list.remove(ZIP_NAME.strip('.zip')+'/')
-    input_data.extractall(os.getcwd())
-    input_data.close()
-
-    # Iterate through spreadsheets, extracting data
-    record = []
-    for item in file_list:
-        df = elsect_spreadsheet_to_dataframe(item, logger)
-        record.append(df)
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, partitioned=False, compress=None):
+    # Unpack the data (removed again once it's read, even if reading fails)
+    with checkpoint.extracted_archive(input_dir, ZIP_NAME) as file_list:
+        # Iterate through spreadsheets, extracting data
+        record = []
+        for item in file_list:
+            # Years that were already ingested are left as they are
+            if partitioned and year_partitions.has_partition(output_dir, DATASET_NAME, survey_year(item)):
+                logger.debug('Skipping ' + str(item) + ', already ingested...')
+                continue
+
+            df = parse_cache.parse(item, elsect_spreadsheet_to_dataframe, logger)
+            if partitioned:
+                # Partitions are kept by later runs, so a bad year must fail before it's stored
+                output_schema.validate(df, OUTPUT_FILENAME)
+                year_partitions.write_partition(df, output_dir, DATASET_NAME, survey_year(item))
+            record.append(df)
 
     # Glue the annual surveys into a single file
-    output = pd.concat(record)
+    if partitioned:
+        output = year_partitions.read_partitions(output_dir, DATASET_NAME)
+    else:
+        output = pd.concat(record)
 
     # Write to file as CSV
-    output_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    output.to_csv(output_path, index=False)
+    output_schema.validate(output, OUTPUT_FILENAME)
+    output_writer.write_csv(output, output_dir, OUTPUT_FILENAME, compress)
 
     # Sanity check
     data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, year_label='YRDATA')
 
-    # Clean up
-    shutil.rmtree(ZIP_NAME.strip('.zip') + '/')
-
 
 if __name__ == '__main__':
     print('Beginning data conversion...')
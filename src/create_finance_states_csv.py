@@ -6,11 +6,15 @@ Should be run after "create_finance_districts_csv.py".
 import os
 import pandas as pd
 import sqlite3
-from src import data_sanity_check
+from src import data_sanity_check, year_partitions, polars_engine, output_writer, checkpoint, output_schema
 
 INPUT_FILENAME = 'finance_districts.csv'
 OUTPUT_FILENAME = 'finance_states.csv'
 
+# The names of the year-partitioned input and output
+INPUT_DATASET_NAME = 'finance_districts'
+OUTPUT_DATASET_NAME = 'finance_states'
+
 SCHEMA = ['STATE',
           'ENROLL',
           'NAME',
@@ -44,32 +48,89 @@ query = \
     ORDER BY YRDATA;
     '''
 
+# The same sums, for engines that don't run SQL
+SUMS = {'ENROLL': 'ENROLL',
+        'TOTAL_REVENUE': 'TOTALREV',
+        'FEDERAL_REVENUE': 'TFEDREV',
+        'STATE_REVENUE': 'TSTREV',
+        'LOCAL_REVENUE': 'TLOCREV',
+        'TOTAL_EXPENDITURE': 'TOTALEXP',
+        'INSTRUCTION_EXPENDITURE': 'TCURINST',
+        'SUPPORT_SERVICES_EXPENDITURE': 'TCURSSVC',
+        'OTHER_EXPENDITURE': 'TCURONON',
+        'CAPITAL_OUTLAY_EXPENDITURE': 'TCAPOUT'}
 
-def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
-    # Notify user
-    logger.debug('Parsing ' + str(INPUT_FILENAME) + '...')
+
+def aggregate_districts(df, engine='pandas'):
+    """
+    Sums district finance data by state and year.
+
+    :param df: District finance data.
+    :param engine: The dataframe library doing the aggregation ('pandas' or 'polars').
+    :return: State finance data.
+    :rtype: pd.DataFrame
+    """
+    if engine == 'polars':
+        return polars_engine.aggregate_districts(df, SUMS)
 
     # Create a temporary SQL database populated with district data
     con = sqlite3.connect(':memory:')
-    cur = con.cursor()
-    input_data_path = os.path.join(input_dir, INPUT_FILENAME)
-    df = pd.read_csv(input_data_path)
     df.to_sql(name='school_money', con=con, if_exists='replace')
     con.commit()
 
     # Run a query to aggregate data by state
     output = pd.read_sql(sql=query, con=con)
+    con.close()
 
     # Add a primary key
     pk = output['YEAR'].astype(str) + '_' + output['STATE']
     output.insert(0, 'PRIMARY_KEY', pk)
 
+    return output
+
+
+def update_state_partitions(logger, input_dir, output_dir, engine='pandas'):
+    """
+    Aggregates only the years whose district partition is new or has
+    changed since the state partition was written.
+
+    :param logger:
+    :param input_dir: The directory containing the district partitions.
+    :param output_dir: The directory containing the state partitions.
+    :param engine: The dataframe library doing the aggregation.
+    :return:
+    """
+    numeric_columns = [col for col in SCHEMA if col not in ['STATE', 'NAME']]
+
+    for year in year_partitions.partition_years(input_dir, INPUT_DATASET_NAME):
+        if not year_partitions.is_stale(output_dir, OUTPUT_DATASET_NAME, year, input_dir, INPUT_DATASET_NAME):
+            continue
+
+        logger.debug('Aggregating ' + str(year) + '...')
+        df = year_partitions.read_partitions(input_dir, INPUT_DATASET_NAME, years=[year])
+        df[numeric_columns] = df[numeric_columns].apply(pd.to_numeric, errors='coerce')
+
+        year_partitions.write_partition(aggregate_districts(df, engine), output_dir, OUTPUT_DATASET_NAME, year)
+
+
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, partitioned=False, engine='pandas'):
+    # Notify user
+    logger.debug('Parsing ' + str(INPUT_FILENAME) + '...')
+
+    if partitioned:
+        update_state_partitions(logger, input_dir, output_dir, engine)
+        output = year_partitions.read_partitions(output_dir, OUTPUT_DATASET_NAME)
+    else:
+        output = aggregate_districts(output_writer.read_csv(input_dir, INPUT_FILENAME), engine)
+
     # Sort
-    output.sort_values(['YEAR', 'STATE'])
+    output = output.sort_values(['YEAR', 'STATE'])
 
     # Output
+    output_schema.validate(output, OUTPUT_FILENAME)
     output_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    output.to_csv(output_path, index=False)
+    with checkpoint.atomic_output(output_path) as tmp_path:
+        output.to_csv(tmp_path, index=False)
 
     # Sanity check
     data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
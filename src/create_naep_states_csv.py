@@ -8,7 +8,7 @@ import os
 import numpy as np
 import pandas as pd
 import us  # US metadata, like state names
-from src import data_sanity_check
+from src import data_sanity_check, tidy_data, polars_engine, checkpoint, output_schema
 
 # The name of the input CSV
 INPUT_FILENAME = 'naep_states_raw.csv'
@@ -16,6 +16,9 @@ INPUT_FILENAME = 'naep_states_raw.csv'
 # The name of the output CSV
 OUTPUT_FILENAME = 'naep_states.csv'
 
+# Columns identifying each row, as opposed to data columns
+KEY_COLUMNS = ['PRIMARY_KEY', 'STATE', 'YEAR']
+
 # State names
 STATES = us.STATES
 
@@ -36,12 +39,16 @@ def find_specs(col_name):
     return spec_list
 
 
-def naep_aggregate(input_df):
+def naep_aggregate(input_df, engine='pandas'):
     """
 
     :param input_df:
+    :param engine: The dataframe library doing the aggregation ('pandas' or 'polars').
     :return:
     """
+    if engine == 'polars':
+        return polars_engine.naep_aggregate(input_df)
+
     # Treat years as strings
     input_df['YEAR'] = input_df['YEAR'].astype('str')
     # input_df.drop_duplicates(inplace=True)
@@ -94,7 +101,7 @@ def naep_aggregate(input_df):
     return output_df
 
 
-def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, tidy=False, engine='pandas'):
     # Notify user
     logger.debug('Parsing ' + str(INPUT_FILENAME) + '...')
 
@@ -102,11 +109,16 @@ def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
     input_data = pd.read_csv(os.path.join(input_dir, INPUT_FILENAME))
 
     # Aggregate the data (combine rows per demographic)
-    output_df = naep_aggregate(input_data)
+    output_df = naep_aggregate(input_data, engine)
 
     # Output as file
+    output_schema.validate(output_df, OUTPUT_FILENAME)
     output_data_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    output_df.to_csv(output_data_path, index=False)
+    with checkpoint.atomic_output(output_data_path) as tmp_path:
+        output_df.to_csv(tmp_path, index=False)
+
+    if tidy:
+        tidy_data.write_tidy(output_df, output_dir, OUTPUT_FILENAME, KEY_COLUMNS, tidy_data.NAEP_DIMENSIONS)
 
     # Sanity check
     data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
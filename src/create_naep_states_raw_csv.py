@@ -4,12 +4,10 @@ data on states into a single CSV file.
 """
 
 import re
-import zipfile
-import shutil
 import os
 import pandas as pd
 import us  # US metadata, like state names
-from src import data_sanity_check
+from src import data_sanity_check, checkpoint, output_schema, parse_cache
 
 OUTPUT_FILENAME = 'naep_states_raw.csv'
 
@@ -71,6 +69,22 @@ def label_fixup(label_str):
     return '{0}_{1}'.format(race_str, gender_str)
 
 
+def map_unique(series, transform):
+    """
+    Applies a transform once per unique value in a series, then maps
+    the results back onto every row. Spreadsheet columns like STATE and
+    DEMO repeat a small set of labels many times over.
+
+    :param series: The series to transform.
+    :param transform: A function taking and returning a series of unique values.
+    :return: The transformed series.
+    :rtype: pd.Series
+    """
+    uniques = pd.Series(series.unique())
+    mapping = dict(zip(uniques, transform(uniques)))
+    return series.map(mapping)
+
+
 def nde_spreadsheet_to_dataframe(filename, logger=None):
     """
     Converts an NDE data spreadsheet to a Pandas dataframe.
@@ -95,26 +109,20 @@ def nde_spreadsheet_to_dataframe(filename, logger=None):
                                            'Average scale score': 'AVG_SCORE'})
     filename = filename.split('/')[1]
     data['TEST_SUBJECT'] = filename.split('_')[1]
-    data['TEST_YEAR'] = filename.split('_')[2].replace('G', '')
+    test_grade = filename.split('_')[2].replace('G', '')
+    data['TEST_YEAR'] = test_grade
 
     # Clean up the year by removing the superscript
-    data['YEAR'] = data['YEAR'].apply(lambda x: x[:4])
+    data['YEAR'] = data['YEAR'].str[:4]
 
-    # Capitalize state names if necessary
-    data['STATE'] = data['STATE'].apply(lambda x: x.upper())
-
-    # Replace spaces with underscore in state names
-    data['STATE'] = data['STATE'].apply(lambda x: re.sub(' ', '_', x.strip()))
+    # Capitalize state names and replace spaces with underscores
+    data['STATE'] = map_unique(data['STATE'],
+                               lambda x: x.str.upper().str.strip().str.replace(' ', '_', regex=False))
 
     # Format the demographic column
-    ## Swap out race/gender strings
-    data['DEMO'] = data['DEMO'].apply(lambda x: label_fixup(x))
-
-    ## Prepend grade
-    data['DEMO'] = 'G0' + data['TEST_YEAR'] + '_' + data['DEMO']
-
-    ## Prepend survey year
-    data['DEMO'] = data['DEMO']
+    ## Swap out race/gender strings and prepend grade
+    grade_prefix = 'G0' + test_grade + '_'
+    data['DEMO'] = map_unique(data['DEMO'], lambda x: grade_prefix + x.map(label_fixup))
 
     # Cast appropriate columns to numbers, removing non-number symbols
     data['AVG_SCORE'] = pd.to_numeric(data['AVG_SCORE'], errors='coerce')
@@ -126,29 +134,22 @@ def nde_spreadsheet_to_dataframe(filename, logger=None):
 
 
 def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
-    # Unpack the data
-    input_data_path = os.path.join(input_dir, ZIP_NAME)
-    input_data = zipfile.ZipFile(input_data_path, 'r')
-    file_list = input_data.namelist()
-    file_list.remove(ZIP_NAME.strip('.zip') + '/')
-    input_data.extractall(os.getcwd())
-    input_data.close()
-
-    # Iterate through spreadsheets, extracting data
-    record = []
-    for item in file_list:
-        df = nde_spreadsheet_to_dataframe(item, logger)
-        record.append(df)
+    # Unpack the data (removed again once it's read, even if reading fails)
+    with checkpoint.extracted_archive(input_dir, ZIP_NAME) as file_list:
+        # Iterate through spreadsheets, extracting data
+        record = []
+        for item in file_list:
+            df = parse_cache.parse(item, nde_spreadsheet_to_dataframe, logger)
+            record.append(df)
 
     # Glue the annual surveys into a single file
     output = pd.concat(record)
 
     # Output as file
+    output_schema.validate(output, OUTPUT_FILENAME)
     output_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    output.to_csv(output_path, index=False)
-
-    # Clean up
-    shutil.rmtree(ZIP_NAME.strip('.zip') + '/')
+    with checkpoint.atomic_output(output_path) as tmp_path:
+        output.to_csv(tmp_path, index=False)
 
     # Sanity check
     data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
@@ -7,17 +7,19 @@ import os
 import re
 import pandas as pd
 import us  # US metadata, like state names
-from src import data_sanity_check
+from src import data_sanity_check, indexed_join, summary_views, output_writer, checkpoint, output_schema
 
 FINANCE_FILENAME = 'finance_states.csv'
-ENROLL_FILENAME = 'enroll_states_summary.csv'
 ENROLL_EXTENDED_FILENAME = 'enroll_states.csv'
-ACHIEVE_FILENAME = 'naep_states_summary.csv'
 ACHIEVE_EXTENDED_FILENAME = 'naep_states.csv'
 
 OUTPUT_FILENAME = 'states_all.csv'
 OUTPUT_EXTENDED_FILENAME = 'states_all_extended.csv'
 
+# Columns shared by every state-level file
+KEY_COLUMNS = ['PRIMARY_KEY', 'STATE', 'YEAR']
+INDEX_COLUMNS = ['YEAR', 'STATE']
+
 # State names
 STATES = us.STATES
 
@@ -26,37 +28,72 @@ doublespace = re.compile(r'  ')
 numbersonly = re.compile(r'\d+')
 
 
-def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
-    # Notify user
-    logger.debug('Creating aggregate file...')
+def join_state_data(finance_df, enroll_df, achieve_df, logger=None, engine='pandas'):
+    """
+    Joins the finance, enrollment, and achievement data on a shared
+    (YEAR, STATE) index, sorted by year and state.
 
-    # Combine data
-    finance_data = pd.read_csv(os.path.join(input_dir, FINANCE_FILENAME))
-    enroll_data = pd.read_csv(os.path.join(input_dir, ENROLL_FILENAME))
-    achieve_data = pd.read_csv(os.path.join(input_dir, ACHIEVE_FILENAME))
+    :param finance_df: State-level finance data.
+    :param enroll_df: State-level enrollment data (all columns).
+    :param achieve_df: State-level NAEP data (all columns).
+    :param logger: Used to report key coverage per source.
+    :param engine: The dataframe library doing the join ('pandas' or 'polars').
+    :return: The joined data.
+    :rtype: pd.DataFrame
+    """
+    # The primary key is rebuilt after the join rather than joined on
+    sources = {'finance': finance_df, 'enroll': enroll_df, 'achieve': achieve_df}
+    sources = {name: df.drop(columns='PRIMARY_KEY') for name, df in sources.items()}
 
-    all_data = finance_data.merge(enroll_data, on=['PRIMARY_KEY', 'STATE', 'YEAR'], how='outer')
+    all_data, _ = indexed_join.indexed_join(sources, INDEX_COLUMNS, logger, engine)
 
-    all_data = all_data.merge(achieve_data, on=['PRIMARY_KEY', 'STATE', 'YEAR'], how='outer')
+    all_data.insert(0, 'PRIMARY_KEY', all_data['YEAR'].astype(str) + '_' + all_data['STATE'])
+    data_columns = [col for col in all_data.columns if col not in KEY_COLUMNS]
+    all_data = all_data[KEY_COLUMNS + data_columns]
 
-    all_data.sort_values(['YEAR', 'STATE'])
+    return all_data
 
-    output_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    all_data.to_csv(output_path, index=False)
 
-    # Combine extended data
-    finance_data_extend = pd.read_csv(os.path.join(input_dir, FINANCE_FILENAME))
-    enroll_data_extend = pd.read_csv(os.path.join(input_dir, ENROLL_EXTENDED_FILENAME))
-    achieve_data_extend = pd.read_csv(os.path.join(input_dir, ACHIEVE_EXTENDED_FILENAME))
+def summarize_state_data(all_data, finance_columns):
+    """
+    Projects the joined data down to the summary columns, renaming them
+    to their human-readable names.
+
+    :param all_data: The output of join_state_data.
+    :param finance_columns: The columns taken from the finance data.
+    :return: The summarized data.
+    :rtype: pd.DataFrame
+    """
+    summary_columns = summary_views.summary_columns([summary_views.ENROLL_SUMMARY, summary_views.NAEP_SUMMARY])
 
-    all_data_extend = finance_data_extend.merge(enroll_data_extend, on=['PRIMARY_KEY', 'STATE', 'YEAR'], how='outer')
+    output_df = all_data[finance_columns + list(summary_columns.keys())]
+    output_df = output_df.rename(columns=summary_columns)
 
-    all_data_extend = all_data_extend.merge(achieve_data_extend, on=['PRIMARY_KEY', 'STATE', 'YEAR'], how='outer')
+    return output_df
 
-    all_data_extend.sort_values(['YEAR', 'STATE'])
 
-    output_path = os.path.join(output_dir, OUTPUT_EXTENDED_FILENAME)
-    all_data_extend.to_csv(output_path, index=False)
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, engine='pandas', compress=None):
+    # Notify user
+    logger.debug('Creating aggregate file...')
+
+    # Load each input once
+    finance_data = pd.read_csv(os.path.join(input_dir, FINANCE_FILENAME))
+    enroll_data = pd.read_csv(os.path.join(input_dir, ENROLL_EXTENDED_FILENAME))
+    achieve_data = pd.read_csv(os.path.join(input_dir, ACHIEVE_EXTENDED_FILENAME))
+
+    # Combine extended data
+    all_data_extend = join_state_data(finance_data, enroll_data, achieve_data, logger, engine)
+
+    # The summary is a projection of the extended data
+    all_data = summarize_state_data(all_data_extend, finance_data.columns.tolist())
+
+    output_schema.validate(all_data, OUTPUT_FILENAME)
+    output_schema.validate(all_data_extend, OUTPUT_EXTENDED_FILENAME)
+    output_path = os.path.join(output_dir, OUTPUT_FILENAME)
+    with checkpoint.atomic_output(output_path) as tmp_path:
+        all_data.to_csv(tmp_path, index=False)
+
+    output_writer.write_csv(all_data_extend, output_dir, OUTPUT_EXTENDED_FILENAME, compress)
 
     # Sanity check
     data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
@@ -0,0 +1,163 @@
+"""
+A script for enriching states_all.csv with columns derived from lookup
+tables shipped in data/external (the state's region, finance data in
+real dollars, and finance data per pupil).
+"""
+
+import os
+import functools
+import numpy as np
+import pandas as pd
+from src import data_sanity_check, checkpoint, output_schema, output_manifest
+
+INPUT_FILENAME = 'states_all.csv'
+
+OUTPUT_FILENAME = 'states_all_enriched.csv'
+
+# Lookup tables are versioned by filename; a revised table gets a new version
+LOOKUP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'data', 'external')
+CPI_FILENAME = 'cpi_u_v1.csv'
+REGIONS_FILENAME = 'state_regions_v1.csv'
+
+# The subdirectory of the interim directory holding parsed lookup tables between runs
+LOOKUP_CACHE_DIRNAME = 'lookup_cache'
+
+# Real dollars are expressed in this year's dollars
+CPI_BASE_YEAR = 2019
+
+# Finance columns measured in dollars
+DOLLAR_COLUMNS = ['TOTAL_REVENUE',
+                  'FEDERAL_REVENUE',
+                  'STATE_REVENUE',
+                  'LOCAL_REVENUE',
+                  'TOTAL_EXPENDITURE',
+                  'INSTRUCTION_EXPENDITURE',
+                  'SUPPORT_SERVICES_EXPENDITURE',
+                  'OTHER_EXPENDITURE',
+                  'CAPITAL_OUTLAY_EXPENDITURE']
+
+# The column per-pupil values are divided by
+PUPIL_COLUMN = 'ENROLL'
+
+
+@functools.lru_cache(maxsize=None)
+def _read_lookup(path, mtime, cache_dir=None):
+    # The modification time is only part of the cache key, so that an
+    # edited table is read again
+    if cache_dir is None:
+        return pd.read_csv(path)
+
+    # Parsed tables are kept between runs, named by the hash of the file they were parsed from
+    filename = os.path.basename(path)
+    cache_path = os.path.join(cache_dir, '{0}.{1}.pkl'.format(filename, output_manifest.file_hash(path)[:16]))
+    if os.path.exists(cache_path):
+        return pd.read_pickle(cache_path)
+
+    table = pd.read_csv(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    for other in os.listdir(cache_dir):
+        if other.startswith(filename + '.'):
+            os.remove(os.path.join(cache_dir, other))
+    with checkpoint.atomic_output(cache_path) as tmp_path:
+        table.to_pickle(tmp_path)
+    return table
+
+
+def load_lookup(lookup_dir, filename, sanity_dir=None):
+    """
+    Loads a lookup table, reusing the copy already in memory unless the
+    file has changed since it was read. Given the interim directory, the
+    parsed table is also kept there for later runs.
+
+    :param lookup_dir: The directory containing the lookup tables.
+    :param filename: The name of the lookup table.
+    :param sanity_dir: The interim directory (None to only cache in memory).
+    :return: The lookup table (shared; don't modify it).
+    :rtype: pd.DataFrame
+    """
+    path = os.path.join(lookup_dir, filename)
+    cache_dir = os.path.join(sanity_dir, LOOKUP_CACHE_DIRNAME) if sanity_dir else None
+    return _read_lookup(path, os.path.getmtime(path), cache_dir)
+
+
+def cpi_factors(cpi_table, years, base_year=CPI_BASE_YEAR):
+    """
+    Gives the factor that converts each year's dollars to base-year
+    dollars, looked up as an array indexed by year.
+
+    :param cpi_table: A lookup table with YEAR and CPI columns.
+    :param years: The year of each row.
+    :param base_year: The year whose dollars are used.
+    :return: One factor per row (NaN for years without a CPI).
+    :rtype: np.ndarray
+    """
+    first_year = int(cpi_table['YEAR'].min())
+    cpi = np.full(int(cpi_table['YEAR'].max()) - first_year + 1, np.nan)
+    cpi[cpi_table['YEAR'].to_numpy() - first_year] = cpi_table['CPI'].to_numpy()
+
+    offsets = np.asarray(years, dtype='int64') - first_year
+    in_range = (offsets >= 0) & (offsets < len(cpi))
+    row_cpi = np.where(in_range, cpi[np.clip(offsets, 0, len(cpi) - 1)], np.nan)
+
+    return cpi[base_year - first_year] / row_cpi
+
+
+def enrich_state_data(input_df, cpi_table, regions_table):
+    """
+    Adds REGION, <COLUMN>_REAL, and <COLUMN>_PER_PUPIL columns for every
+    finance column, computing each group in a single array operation.
+
+    :param input_df: The states_all data.
+    :param cpi_table: A lookup table with YEAR and CPI columns.
+    :param regions_table: A lookup table with STATE and REGION columns.
+    :return: The enriched data.
+    :rtype: pd.DataFrame
+    """
+    output_df = input_df.copy()
+
+    regions = regions_table.set_index('STATE')['REGION']
+    output_df.insert(output_df.columns.get_loc('STATE') + 1, 'REGION',
+                     regions.reindex(output_df['STATE']).to_numpy())
+
+    dollars = input_df[DOLLAR_COLUMNS].to_numpy(dtype='float64')
+    real = dollars * cpi_factors(cpi_table, input_df['YEAR'])[:, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per_pupil = dollars / input_df[PUPIL_COLUMN].to_numpy(dtype='float64')[:, None]
+    per_pupil[~np.isfinite(per_pupil)] = np.nan
+
+    derived = np.hstack([real, per_pupil])
+    derived_columns = [col + '_REAL' for col in DOLLAR_COLUMNS] + [col + '_PER_PUPIL' for col in DOLLAR_COLUMNS]
+    output_df = pd.concat([output_df, pd.DataFrame(derived, columns=derived_columns, index=output_df.index)],
+                          axis=1)
+
+    return output_df
+
+
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, lookup_dir=LOOKUP_DIR):
+    # Notify user
+    logger.debug('Enriching ' + str(INPUT_FILENAME) + '...')
+
+    # Unpack the data
+    input_data = pd.read_csv(os.path.join(input_dir, INPUT_FILENAME))
+    cpi_table = load_lookup(lookup_dir, CPI_FILENAME, sanity_dir)
+    regions_table = load_lookup(lookup_dir, REGIONS_FILENAME, sanity_dir)
+
+    output_df = enrich_state_data(input_data, cpi_table, regions_table)
+
+    # Output as file
+    output_schema.validate(output_df, OUTPUT_FILENAME)
+    output_data_path = os.path.join(output_dir, OUTPUT_FILENAME)
+    with checkpoint.atomic_output(output_data_path) as tmp_path:
+        output_df.to_csv(tmp_path, index=False)
+
+    # Sanity check
+    data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME, count_year_nulls=True)
+
+
+if __name__ == '__main__':
+    print('Beginning data conversion...')
+    print('')
+    main()
+    print('')
+    print('Finished.')
@@ -4,16 +4,16 @@ in the aggregated output and exploring where those nulls stem from.
 """
 
 import os
-import pandas as pd
 import pprint
+from src import output_writer
 
 
-def main(logger=None, input_dir=None, output_dir=None, input_filename=None, count_year_nulls=False, year_label='YEAR'):
+def main(logger=None, input_dir=None, output_dir=None, input_filename=None, count_year_nulls=False, year_label='YEAR',
+         report_density=False):
     logger.debug('Creating data sanity check file...')
 
     # Load in data
-    input_path = os.path.join(input_dir, input_filename)
-    input_df = pd.read_csv(input_path)
+    input_df = output_writer.read_csv(input_dir, input_filename)
     sanity_check_output = []
 
     # High Level Overview
@@ -30,6 +30,18 @@ def main(logger=None, input_dir=None, output_dir=None, input_filename=None, coun
         sanity_check_output.append('\n')
     sanity_check_output.append('\n')
 
+    # Share of non-null values per column
+    if report_density:
+        sanity_check_output.append('Column Density')
+        sanity_check_output.append('\n')
+        density = input_df.notna().mean()
+        for col in input_df.columns:
+            sanity_check_output.append(col + ': ' + '{0:.3f}'.format(density[col]))
+            sanity_check_output.append('\n')
+        sanity_check_output.append('Overall: ' + '{0:.3f}'.format(input_df.notna().to_numpy().mean()))
+        sanity_check_output.append('\n')
+        sanity_check_output.append('\n')
+
     # Nulls by years
     if count_year_nulls:
         null_count_dict = {}
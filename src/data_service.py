@@ -0,0 +1,321 @@
+"""
+A small read-only HTTP service over the processed outputs, for
+dashboards that need slices of the state tables. Tables are loaded once
+and indexed by state and year; responses are cached and tagged with
+ETags derived from the output manifest, and tables are reloaded when a
+pipeline run writes a new manifest. Summary tables are served as
+projections of their (served) base tables, so they needn't be written.
+
+Usage: python -m src.data_service data/processed --port 8000
+Then: GET /states_all?state=IDAHO,OHIO&year=2010-2015&columns=TOTAL_REVENUE&format=csv
+"""
+
+import io
+import os
+import json
+import hashlib
+import logging
+import threading
+import collections
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import click
+import numpy as np
+from src import output_manifest, output_writer, summary_views
+
+# Tables served, by the name used in the URL
+SERVED_TABLES = {'states_all': 'states_all.csv',
+                 'states_all_extended': 'states_all_extended.csv',
+                 'states_all_enriched': 'states_all_enriched.csv',
+                 'naep_states': 'naep_states.csv',
+                 'enroll_states': 'enroll_states.csv',
+                 'finance_states': 'finance_states.csv'}
+
+# Summary tables served as projections of a served table (see summary_views)
+SERVED_VIEWS = {'enroll_states_summary': 'enroll_states_summary.csv',
+                'naep_states_summary': 'naep_states_summary.csv'}
+
+# Columns always included in a response
+KEY_COLUMNS = ['PRIMARY_KEY', 'STATE', 'YEAR']
+
+# Response formats and their content types
+FORMATS = {'json': 'application/json',
+           'csv': 'text/csv',
+           'arrow': 'application/vnd.apache.arrow.stream'}
+
+# The most responses kept in the cache
+CACHE_SIZE = 256
+
+HOST = '127.0.0.1'
+PORT = 8000
+
+
+class Table:
+    """
+    A table held in memory, with the row positions of every state and year.
+    """
+
+    def __init__(self, df, content_hash):
+        self.df = df
+        self.content_hash = content_hash
+        self.state_rows = df.groupby('STATE').indices
+        self.year_rows = df.groupby('YEAR').indices
+
+    def select(self, states=None, years=None, columns=None):
+        """
+        Selects a slice of the table using its state and year indexes.
+
+        :param states: The states to include (all if None).
+        :param years: The years to include (all if None).
+        :param columns: The data columns to include (all if None).
+        :return: The slice, in the table's row order.
+        :rtype: pd.DataFrame
+        """
+        rows = np.arange(len(self.df))
+        for index, labels in [(self.state_rows, states), (self.year_rows, years)]:
+            if labels is not None:
+                selected = [index[label] for label in labels if label in index]
+                rows = np.intersect1d(rows, np.concatenate(selected) if selected else np.array([], dtype=int))
+
+        if columns is not None:
+            unknown = [col for col in columns if col not in self.df.columns]
+            if unknown:
+                raise ValueError('Unknown columns: {0}'.format(', '.join(unknown)))
+            keys = [col for col in KEY_COLUMNS if col in self.df.columns]
+            columns = keys + [col for col in columns if col not in keys]
+        else:
+            columns = self.df.columns
+
+        return self.df.iloc[rows][columns]
+
+
+class DataStore:
+    """
+    Holds the served tables, reloading those whose hash changes when a
+    new manifest is written.
+    """
+
+    def __init__(self, output_dir, logger=None):
+        self.output_dir = output_dir
+        self.logger = logger
+        self.tables = {}
+        self.manifest_mtime = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reloads changed tables if the manifest has been rewritten since
+        the last check. Cheap enough to call on every request.
+
+        :return:
+        """
+        manifest_path = os.path.join(self.output_dir, output_manifest.MANIFEST_FILENAME)
+        mtime = os.path.getmtime(manifest_path) if os.path.exists(manifest_path) else None
+        if self.tables and mtime == self.manifest_mtime:
+            return
+
+        with self.lock:
+            manifest = output_manifest.read_manifest(self.output_dir)
+            for name, filename in SERVED_TABLES.items():
+                path = output_writer.find_csv(self.output_dir, filename)
+                if not os.path.exists(path):
+                    continue
+                content_hash = manifest.get(os.path.basename(path)) or output_manifest.file_hash(path)
+                if name in self.tables and self.tables[name].content_hash == content_hash:
+                    continue
+
+                if self.logger:
+                    self.logger.debug('Loading ' + filename + '...')
+                self.tables[name] = Table(output_writer.read_csv(self.output_dir, filename), content_hash)
+
+            # Views are rebuilt when their base table was reloaded
+            table_names = {filename: name for name, filename in SERVED_TABLES.items()}
+            for name, filename in SERVED_VIEWS.items():
+                view = summary_views.VIEWS[filename]
+                base = self.tables.get(table_names[view.base_filename])
+                if base is None or (name in self.tables and self.tables[name].content_hash == base.content_hash):
+                    continue
+                self.tables[name] = Table(view.apply(base.df), base.content_hash)
+            self.manifest_mtime = mtime
+
+
+class ResponseCache:
+    """
+    A least-recently-used cache of rendered responses.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def parse_years(values):
+    """
+    Parses year filters, i.e. ['2015', '2017-2019'].
+
+    :param values: Comma-separated years or year ranges.
+    :return: The years.
+    :rtype: list
+    """
+    years = []
+    for value in ','.join(values).split(','):
+        start, _, end = value.strip().partition('-')
+        years += list(range(int(start), int(end or start) + 1))
+    return years
+
+
+def parse_query(query):
+    """
+    Normalizes a query string into a filter, so that equivalent queries
+    share a cache entry.
+
+    :param query: The query string.
+    :return: A tuple of (states, years, columns, format), with None for no filter.
+    :rtype: tuple
+    """
+    params = parse_qs(query)
+
+    states = None
+    if 'state' in params:
+        states = [x.strip().upper().replace(' ', '_') for x in ','.join(params['state']).split(',')]
+        states = tuple(sorted(set(states)))
+    years = tuple(sorted(set(parse_years(params['year'])))) if 'year' in params else None
+    columns = tuple(x.strip() for x in ','.join(params['columns']).split(',')) if 'columns' in params else None
+
+    response_format = params.get('format', ['json'])[0]
+    if response_format not in FORMATS:
+        raise ValueError('Unknown format: {0}'.format(response_format))
+
+    return states, years, columns, response_format
+
+
+def render(df, response_format):
+    """
+    Serializes a slice of a table.
+
+    :param df: The slice.
+    :param response_format: One of FORMATS.
+    :return: The response body.
+    :rtype: bytes
+    """
+    if response_format == 'csv':
+        return df.to_csv(index=False).encode('utf-8')
+    if response_format == 'arrow':
+        import pyarrow.ipc
+
+        sink = io.BytesIO()
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue()
+    return df.to_json(orient='records').encode('utf-8')
+
+
+def make_handler(store, cache):
+    """
+    Creates a request handler serving a data store.
+
+    :param store: The DataStore.
+    :param cache: The ResponseCache.
+    :return: The request handler class.
+    """
+    class DataRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            name = url.path.strip('/')
+            store.refresh()
+
+            if not name:
+                body = json.dumps({name: table.content_hash for name, table in store.tables.items()})
+                return self.respond(HTTPStatus.OK, body.encode('utf-8'), FORMATS['json'])
+            if name not in store.tables:
+                return self.respond(HTTPStatus.NOT_FOUND, b'Unknown table', 'text/plain')
+
+            table = store.tables[name]
+            try:
+                states, years, columns, response_format = parse_query(url.query)
+            except ValueError as e:
+                return self.respond(HTTPStatus.BAD_REQUEST, str(e).encode('utf-8'), 'text/plain')
+
+            # The ETag changes whenever the table's contents or the query do
+            query_key = (name, states, years, columns, response_format)
+            query_hash = hashlib.sha1(repr(query_key).encode('utf-8')).hexdigest()
+            etag = '"{0}-{1}"'.format(table.content_hash[:16], query_hash[:16])
+            if self.headers.get('If-None-Match') == etag:
+                return self.respond(HTTPStatus.NOT_MODIFIED, b'', None, etag)
+
+            body = cache.get(etag)
+            if body is None:
+                try:
+                    body = render(table.select(states, years, columns), response_format)
+                except ValueError as e:
+                    return self.respond(HTTPStatus.BAD_REQUEST, str(e).encode('utf-8'), 'text/plain')
+                cache.put(etag, body)
+
+            self.respond(HTTPStatus.OK, body, FORMATS[response_format], etag)
+
+        def respond(self, status, body, content_type, etag=None):
+            self.send_response(status)
+            if content_type:
+                self.send_header('Content-Type', content_type)
+            if etag:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            if store.logger:
+                store.logger.debug(format % args)
+
+    return DataRequestHandler
+
+
+def create_server(output_dir, host=HOST, port=PORT, logger=None):
+    """
+    Creates (but doesn't start) the HTTP server.
+
+    :param output_dir: The directory containing the processed outputs.
+    :param host: The address to listen on.
+    :param port: The port to listen on (0 picks a free port).
+    :param logger:
+    :return: The server.
+    :rtype: ThreadingHTTPServer
+    """
+    store = DataStore(output_dir, logger)
+    return ThreadingHTTPServer((host, port), make_handler(store, ResponseCache()))
+
+
+@click.command()
+@click.argument('output_filepath', type=click.Path(exists=True))
+@click.option('--host', default=HOST, help='Address to listen on.')
+@click.option('--port', default=PORT, type=int, help='Port to listen on.')
+def main(output_filepath, host, port):
+    """ Serves slices of the processed data (in ../processed) over HTTP.
+    """
+    logger = logging.getLogger(__name__)
+    server = create_server(output_filepath, host, port, logger)
+    logger.info('Serving {0} on http://{1}:{2}/'.format(output_filepath, *server.server_address))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s: %(filename)s [%(funcName)s]- %(message)s', level=logging.DEBUG)
+    main()
@@ -0,0 +1,233 @@
+"""
+A script for maintaining the district dimension table (districts.csv),
+which gives every district a stable integer DISTRICT_ID keyed by its
+NCES LEA ID, along with a name lookup for sources that only carry
+district names.
+"""
+
+import re
+import os
+import numpy as np
+import pandas as pd
+from src import data_sanity_check, checkpoint, output_schema
+
+# The name of the input CSV
+INPUT_FILENAME = 'enroll_districts_raw.csv'
+
+# The name of the output CSV
+OUTPUT_FILENAME = 'districts.csv'
+
+# Columns of the dimension table
+DIMENSION_COLUMNS = ['DISTRICT_ID', 'LEA_ID', 'AGENCY_NAME', 'STATE']
+
+# NCES LEA IDs are seven digits, the first two being the state's FIPS code
+LEA_ID_LENGTH = 7
+
+# Useful regular expressions
+multispace = re.compile(r'\s+')
+
+
+def normalize_lea_ids(lea_ids):
+    """
+    Normalizes LEA IDs exported as numbers or as ="0100005" strings.
+
+    :param lea_ids: A series of LEA IDs.
+    :return: Seven-character LEA IDs (NaN where missing).
+    :rtype: pd.Series
+    """
+    missing = lea_ids.isna()
+    lea_ids = lea_ids.astype(str).str.strip().str.strip('="')
+    lea_ids = lea_ids.str.replace(r'\.0$', '', regex=True).str.zfill(LEA_ID_LENGTH)
+
+    # Placeholders (i.e. '†') aren't IDs
+    return lea_ids.where(~missing & lea_ids.str.isdigit(), np.nan)
+
+
+def normalize_names(names):
+    """
+    Normalizes district or state names for lookups (upper case,
+    single spaces).
+
+    :param names: A series of names.
+    :return: The normalized names.
+    :rtype: pd.Series
+    """
+    return names.astype(str).str.strip().str.upper().str.replace(multispace, ' ', regex=True)
+
+
+def natural_key(df):
+    """
+    Picks the columns that identify a district: the LEA ID when every
+    district has one, otherwise its name and state.
+
+    :param df: District data with LEA_ID, AGENCY_NAME, and STATE columns.
+    :return: The key columns.
+    :rtype: list
+    """
+    if 'LEA_ID' in df.columns and df['LEA_ID'].notna().all():
+        return ['LEA_ID']
+    return ['AGENCY_NAME', 'STATE']
+
+
+def raw_districts(raw_df):
+    """
+    Extracts the identifying columns from raw district enrollment data.
+
+    :param raw_df: The raw district enrollment data.
+    :return: One row per district, with LEA_ID, AGENCY_NAME, and STATE.
+    :rtype: pd.DataFrame
+    """
+    districts = pd.DataFrame(index=raw_df.index)
+    if 'Agency ID' in raw_df.columns:
+        districts['LEA_ID'] = normalize_lea_ids(raw_df['Agency ID'])
+    else:
+        districts['LEA_ID'] = np.nan
+    districts['AGENCY_NAME'] = normalize_names(raw_df['Agency Name'])
+    districts['STATE'] = normalize_names(raw_df['State Name']).str.replace(' ', '_', regex=False)
+
+    return districts
+
+
+def fill_lea_ids(districts, dimension):
+    """
+    Fills in the LEA ID of districts that were added by name and state
+    (from data without LEA IDs), so that they keep their DISTRICT_ID
+    once the data carries LEA IDs. Names shared by more than one
+    district in a state are left alone, as they can't be matched.
+
+    :param districts: Output of raw_districts, with an LEA ID for every district.
+    :param dimension: The existing dimension table.
+    :return: The dimension table, with the LEA IDs filled in.
+    :rtype: pd.DataFrame
+    """
+    names = ['AGENCY_NAME', 'STATE']
+    unkeyed = dimension[dimension['LEA_ID'].isna()].drop_duplicates(subset=names, keep=False)
+    unmatched = districts[~districts['LEA_ID'].isin(dimension['LEA_ID'])].drop_duplicates(subset=names, keep=False)
+    if unkeyed.empty or unmatched.empty:
+        return dimension
+
+    rows = pd.Series(unkeyed.index, index=pd.MultiIndex.from_frame(unkeyed[names]))
+    rows = rows.reindex(pd.MultiIndex.from_frame(unmatched[names])).to_numpy()
+    found = ~pd.isna(rows)
+
+    dimension = dimension.copy()
+    dimension['LEA_ID'] = dimension['LEA_ID'].astype(object)
+    dimension.loc[rows[found].astype('int64'), 'LEA_ID'] = unmatched['LEA_ID'].to_numpy()[found]
+    return dimension
+
+
+def update_dimension(districts, dimension=None):
+    """
+    Adds districts that aren't in the dimension table yet. Existing
+    districts keep their DISTRICT_ID, so IDs are stable across runs.
+
+    :param districts: Output of raw_districts.
+    :param dimension: The existing dimension table, if any.
+    :return: The updated dimension table.
+    :rtype: pd.DataFrame
+    """
+    if dimension is None:
+        dimension = pd.DataFrame(columns=DIMENSION_COLUMNS)
+
+    key = natural_key(districts)
+    districts = districts.drop_duplicates(subset=key)
+    if key == ['LEA_ID']:
+        dimension = fill_lea_ids(districts, dimension)
+
+    known = districts.set_index(key).index.isin(dimension.set_index(key).index)
+    new_districts = districts[~known].sort_values(key)
+
+    next_id = int(dimension['DISTRICT_ID'].max()) + 1 if len(dimension) else 1
+    new_districts.insert(0, 'DISTRICT_ID', np.arange(next_id, next_id + len(new_districts)))
+
+    dimension = pd.concat([dimension, new_districts[DIMENSION_COLUMNS]], ignore_index=True)
+    dimension['DISTRICT_ID'] = dimension['DISTRICT_ID'].astype('int64')
+
+    return dimension
+
+
+def assign_district_ids(districts, dimension):
+    """
+    Looks up the DISTRICT_ID for each district.
+
+    :param districts: Output of raw_districts.
+    :param dimension: The dimension table.
+    :return: The DISTRICT_ID of each row (NaN if unknown).
+    :rtype: pd.Series
+    """
+    key = natural_key(districts)
+    ids = dimension.drop_duplicates(subset=key).set_index(key)['DISTRICT_ID']
+    return pd.Series(ids.reindex(districts.set_index(key).index).to_numpy(), index=districts.index)
+
+
+def name_index(dimension):
+    """
+    Builds a lookup from (STATE, normalized district name) to DISTRICT_ID.
+    Names shared by more than one district in a state are left out, as
+    they can't be resolved by name alone.
+
+    :param dimension: The dimension table.
+    :return: DISTRICT_IDs indexed by STATE and name, sorted.
+    :rtype: pd.Series
+    """
+    names = dimension[['STATE', 'AGENCY_NAME', 'DISTRICT_ID']]
+    names = names.drop_duplicates(subset=['STATE', 'AGENCY_NAME'], keep=False)
+    return names.set_index(['STATE', 'AGENCY_NAME'])['DISTRICT_ID'].sort_index()
+
+
+def lookup_by_name(index, states, names):
+    """
+    Looks up DISTRICT_IDs for sources that only carry names.
+
+    :param index: Output of name_index.
+    :param states: A series of state names.
+    :param names: A series of district names.
+    :return: The DISTRICT_ID of each row (NaN where not found or ambiguous).
+    :rtype: pd.Series
+    """
+    states = normalize_names(states).str.replace(' ', '_', regex=False)
+    keys = pd.MultiIndex.from_arrays([states, normalize_names(names)])
+    return pd.Series(index.reindex(keys).to_numpy(), index=names.index)
+
+
+def load_dimension(input_dir):
+    """
+    Loads the dimension table, if it exists.
+
+    :param input_dir: The directory containing districts.csv.
+    :return: The dimension table, or None.
+    :rtype: pd.DataFrame
+    """
+    input_path = os.path.join(input_dir, OUTPUT_FILENAME)
+    if not os.path.exists(input_path):
+        return None
+    return pd.read_csv(input_path, dtype={'LEA_ID': str})
+
+
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None):
+    # Notify user
+    logger.debug('Parsing ' + str(INPUT_FILENAME) + '...')
+
+    # Unpack the data
+    raw_data = pd.read_csv(os.path.join(input_dir, INPUT_FILENAME), dtype={'Agency ID': str})
+    raw_data = raw_data[raw_data['State Name'].notna()]
+
+    # Add any new districts to the existing table
+    dimension = update_dimension(raw_districts(raw_data), load_dimension(output_dir))
+
+    # Output as file
+    output_schema.validate(dimension, OUTPUT_FILENAME)
+    output_data_path = os.path.join(output_dir, OUTPUT_FILENAME)
+    with checkpoint.atomic_output(output_data_path) as tmp_path:
+        dimension.to_csv(tmp_path, index=False)
+
+    # Sanity check
+    data_sanity_check.main(logger, output_dir, sanity_dir, OUTPUT_FILENAME)
+
+
+if __name__ == '__main__':
+    print('Beginning data conversion...')
+    print('')
+    main()
+    print('')
+    print('Finished.')
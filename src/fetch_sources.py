@@ -0,0 +1,261 @@
+"""
+A script for refreshing the source archives in data/raw (i.e.
+NAEP_ASSESS_STATES.zip) from a local mirror of the per-year source files.
+
+Files are downloaded concurrently (up to a limit), interrupted downloads
+resume where they stopped, and files that haven't changed since the last
+refresh aren't downloaded again (the server is asked with ETag or
+Last-Modified). An archive is only rebuilt when one of its files changed,
+so unchanged archives don't trigger pipeline work.
+
+The files to fetch are listed in a JSON file mapping each archive to its
+members and their URLs:
+
+    {"NAEP_ASSESS_STATES.zip": {"NDECoreExcel_Reading_G4_All_students.Xls": "https://..."}}
+
+Usage: python -m src.fetch_sources sources.json data/raw data/interim
+"""
+
+import os
+import json
+import asyncio
+import logging
+import zipfile
+import http.client
+import urllib.request
+import urllib.error
+import click
+
+# The name of the mirror inside the interim directory
+MIRROR_DIRNAME = 'mirror'
+
+# The most downloads running at once
+CONCURRENCY = 4
+
+# Attempts per file before giving up (each resumes the last)
+ATTEMPTS = 3
+
+# Bytes read per chunk while downloading
+CHUNK_SIZE = 1 << 16
+
+# Seconds to wait for the server
+TIMEOUT = 60
+
+# Archive members get a fixed timestamp, so unchanged files give identical archives
+ARCHIVE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def read_metadata(path):
+    """
+    Reads the validators (ETag, Last-Modified) saved with a mirrored file.
+
+    :param path: The path of the mirrored file.
+    :return: The saved validators (empty if none).
+    :rtype: dict
+    """
+    if not os.path.exists(path + '.meta.json'):
+        return {}
+    with open(path + '.meta.json') as f:
+        return json.load(f)
+
+
+def write_metadata(path, metadata):
+    """
+    Saves the validators of a mirrored file.
+
+    :param path: The path of the mirrored file.
+    :param metadata: The validators.
+    :return:
+    """
+    with open(path + '.meta.json', 'w') as f:
+        json.dump(metadata, f)
+
+
+def download(url, path):
+    """
+    Downloads a file unless the mirrored copy is current, resuming a
+    partial download if one was left behind. Blocking; run in a thread.
+
+    :param url: The URL of the file.
+    :param path: The path of the mirrored file.
+    :return: True if the file changed.
+    :rtype: bool
+    """
+    metadata = read_metadata(path)
+    part_path = path + '.part'
+    headers = {}
+
+    if os.path.exists(part_path) and metadata.get('partial_validator'):
+        # Resume, unless the file changed since the partial download started
+        headers['Range'] = 'bytes={0}-'.format(os.path.getsize(part_path))
+        headers['If-Range'] = metadata['partial_validator']
+    elif os.path.exists(path):
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last_modified'):
+            headers['If-Modified-Since'] = metadata['last_modified']
+
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise
+
+    with response:
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+        # Saved first, so that an interrupted download can be resumed
+        metadata['partial_validator'] = etag or last_modified
+        write_metadata(path, metadata)
+
+        # The server answers a range request with the whole file (200) if it changed
+        received = 0
+        with open(part_path, 'ab' if response.status == 206 else 'wb') as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+                received += len(chunk)
+
+        # A dropped connection can look like the end of the file
+        expected = response.headers.get('Content-Length')
+        if expected is not None and received < int(expected):
+            raise http.client.IncompleteRead(b'', int(expected) - received)
+
+    os.replace(part_path, path)
+    write_metadata(path, {'etag': etag, 'last_modified': last_modified})
+
+    return True
+
+
+async def fetch_file(url, path, semaphore, logger=None):
+    """
+    Downloads a single file once a download slot is free, retrying
+    (and resuming) on connection errors.
+
+    :param url: The URL of the file.
+    :param path: The path of the mirrored file.
+    :param semaphore: Limits the number of concurrent downloads.
+    :param logger:
+    :return: True if the file changed.
+    :rtype: bool
+    """
+    async with semaphore:
+        for attempt in range(1, ATTEMPTS + 1):
+            try:
+                changed = await asyncio.to_thread(download, url, path)
+                break
+            except (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError) as e:
+                if attempt == ATTEMPTS:
+                    raise
+                if logger:
+                    logger.debug('Retrying {0} ({1})'.format(url, e))
+
+    if logger:
+        logger.debug('{0} {1}'.format('Downloaded' if changed else 'Unchanged', os.path.basename(path)))
+    return changed
+
+
+async def fetch_sources(sources, mirror_dir, concurrency=CONCURRENCY, logger=None):
+    """
+    Mirrors every source file, with at most `concurrency` downloads at once.
+
+    :param sources: A dictionary of archive name to {member name: URL}.
+    :param mirror_dir: The directory holding the mirrored files.
+    :param concurrency: The most downloads running at once.
+    :param logger:
+    :return: A dictionary of archive name to the members that changed.
+    :rtype: dict
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    tasks = []
+    for archive_name, members in sources.items():
+        archive_dir = os.path.join(mirror_dir, archive_name[:-len('.zip')])
+        os.makedirs(archive_dir, exist_ok=True)
+        for member, url in members.items():
+            tasks.append((archive_name, member, fetch_file(url, os.path.join(archive_dir, member), semaphore,
+                                                           logger)))
+
+    results = await asyncio.gather(*[task for _, _, task in tasks])
+
+    changed = {archive_name: [] for archive_name in sources}
+    for (archive_name, member, _), member_changed in zip(tasks, results):
+        if member_changed:
+            changed[archive_name].append(member)
+
+    return changed
+
+
+def assemble_archive(mirror_dir, archive_name, members, output_dir):
+    """
+    Builds a source archive from mirrored files, laid out like the
+    archives the pipeline reads (a folder named after the archive).
+
+    :param mirror_dir: The directory holding the mirrored files.
+    :param archive_name: The name of the archive (i.e. 'NAEP_ASSESS_STATES.zip').
+    :param members: The names of the files in the archive.
+    :param output_dir: The directory to write the archive to.
+    :return: The path of the archive.
+    :rtype: str
+    """
+    folder = archive_name[:-len('.zip')]
+    output_path = os.path.join(output_dir, archive_name)
+
+    with zipfile.ZipFile(output_path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(zipfile.ZipInfo(folder + '/', ARCHIVE_DATE_TIME), b'')
+        for member in sorted(members):
+            info = zipfile.ZipInfo(folder + '/' + member, ARCHIVE_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(os.path.join(mirror_dir, folder, member), 'rb') as f:
+                archive.writestr(info, f.read())
+    os.replace(output_path + '.tmp', output_path)
+
+    return output_path
+
+
+def refresh_archives(sources, output_dir, interim_dir, concurrency=CONCURRENCY, logger=None):
+    """
+    Mirrors the source files and rebuilds the archives that changed.
+
+    :param sources: A dictionary of archive name to {member name: URL}.
+    :param output_dir: The directory holding the archives (i.e. data/raw).
+    :param interim_dir: The directory holding the mirror.
+    :param concurrency: The most downloads running at once.
+    :param logger:
+    :return: The names of the rebuilt archives.
+    :rtype: list
+    """
+    mirror_dir = os.path.join(interim_dir, MIRROR_DIRNAME)
+    changed = asyncio.run(fetch_sources(sources, mirror_dir, concurrency, logger))
+
+    rebuilt = []
+    for archive_name, members in sources.items():
+        if changed[archive_name] or not os.path.exists(os.path.join(output_dir, archive_name)):
+            assemble_archive(mirror_dir, archive_name, members.keys(), output_dir)
+            rebuilt.append(archive_name)
+            if logger:
+                logger.debug('Rebuilt {0} ({1} changed files)'.format(archive_name, len(changed[archive_name])))
+
+    return rebuilt
+
+
+@click.command()
+@click.argument('sources_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path(exists=True))
+@click.argument('interim_filepath', type=click.Path(exists=True))
+@click.option('--concurrency', default=CONCURRENCY, type=int, help='Most downloads running at once.')
+def main(sources_filepath, output_filepath, interim_filepath, concurrency):
+    """ Refreshes the source archives (in ../raw) from their per-year files.
+    """
+    logger = logging.getLogger(__name__)
+    with open(sources_filepath) as f:
+        sources = json.load(f)
+
+    rebuilt = refresh_archives(sources, output_filepath, interim_filepath, concurrency, logger)
+    logger.info('Rebuilt: {0}'.format(', '.join(rebuilt) if rebuilt else 'nothing'))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s: %(filename)s [%(funcName)s]- %(message)s', level=logging.DEBUG)
+    main()
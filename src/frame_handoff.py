@@ -0,0 +1,116 @@
+"""
+A helper for handing dataframes between processes. Frames are published
+as Arrow IPC files in the interim directory, which other processes
+memory-map instead of receiving a pickled copy. Falls back to plain
+pickle files when pyarrow is unavailable or can't convert the frame.
+"""
+
+import os
+import shutil
+import contextlib
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# The subdirectory of the interim directory holding published frames
+HANDOFF_DIRNAME = 'handoff'
+
+
+def publish_frame(df, name, interim_dir):
+    """
+    Writes a dataframe to the handoff directory. The file is written under
+    a temporary name and renamed, so readers never see a partial file.
+
+    :param df: The dataframe to publish.
+    :param name: A name for the frame, unique among running processes.
+    :param interim_dir: The interim directory.
+    :return: The path of the published frame.
+    :rtype: str
+    """
+    handoff_dir = os.path.join(interim_dir, HANDOFF_DIRNAME)
+    os.makedirs(handoff_dir, exist_ok=True)
+
+    if pa is not None:
+        path = os.path.join(handoff_dir, name + '.arrow')
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            with pa.OSFile(path + '.tmp', 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(path + '.tmp', path)
+            return path
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            release_frame(path + '.tmp')
+
+    # Fall back to a plain file
+    path = os.path.join(handoff_dir, name + '.pkl')
+    df.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def open_frame(path, columns=None):
+    """
+    Opens a published dataframe. Arrow files are memory-mapped, so only
+    the requested columns are read from the page cache.
+
+    :param path: The path returned by publish_frame.
+    :param columns: The columns to load (defaults to all of them).
+    :return: The published data.
+    :rtype: pd.DataFrame
+    """
+    if path.endswith('.arrow'):
+        # The mapping stays open for as long as the returned data uses it
+        source = pa.memory_map(path, 'r')
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas()
+
+    df = pd.read_pickle(path)
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+def release_frame(path):
+    """
+    Removes a published dataframe, if it still exists.
+
+    :param path: The path returned by publish_frame.
+    :return:
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def published_frame(df, name, interim_dir):
+    """
+    Publishes a dataframe for the duration of a with-block, removing it
+    afterwards even if the block fails.
+
+    :param df: The dataframe to publish.
+    :param name: A name for the frame, unique among running processes.
+    :param interim_dir: The interim directory.
+    :return: The path of the published frame.
+    """
+    path = publish_frame(df, name, interim_dir)
+    try:
+        yield path
+    finally:
+        release_frame(path)
+
+
+def cleanup(interim_dir):
+    """
+    Removes every published dataframe, i.e. those left behind by a
+    run that was killed.
+
+    :param interim_dir: The interim directory.
+    :return:
+    """
+    shutil.rmtree(os.path.join(interim_dir, HANDOFF_DIRNAME), ignore_errors=True)
@@ -0,0 +1,70 @@
+"""
+A helper for joining several data sources on shared key columns
+(i.e. YEAR and STATE) in a single pass.
+"""
+
+import pandas as pd
+from src import polars_engine
+
+
+def key_coverage(indexed_sources, all_keys):
+    """
+    Counts how many of the joined keys are present in each source.
+
+    :param indexed_sources: A dictionary of source name to indexed dataframe.
+    :param all_keys: The union of every source's index.
+    :return: A dataframe with one row per source.
+    :rtype: pd.DataFrame
+    """
+    coverage = []
+    for name, df in indexed_sources.items():
+        matched = all_keys.isin(df.index).sum()
+        coverage.append({'SOURCE': name,
+                         'KEYS': len(df.index),
+                         'MATCHED': matched,
+                         'COVERAGE': matched / len(all_keys) if len(all_keys) else 0.0})
+
+    return pd.DataFrame(coverage, columns=['SOURCE', 'KEYS', 'MATCHED', 'COVERAGE'])
+
+
+def indexed_join(sources, index_columns, logger=None, engine='pandas'):
+    """
+    Outer joins any number of sources on their shared key columns.
+    Each source is given a sorted index on the key columns once, and
+    all of them are aligned with a single concat.
+
+    :param sources: A dictionary of source name to dataframe. Every dataframe
+    must contain the index columns, and no other column may appear twice.
+    :param index_columns: The key columns, i.e. ['YEAR', 'STATE'].
+    :param logger: Used to report key coverage per source.
+    :param engine: The dataframe library doing the join ('pandas' or 'polars').
+    :return: The joined data, sorted by the key columns, and the key coverage.
+    :rtype: (pd.DataFrame, pd.DataFrame)
+    """
+    if engine == 'polars':
+        output_df = polars_engine.indexed_join(sources, index_columns)
+        indexed_sources = {name: df.set_index(index_columns) for name, df in sources.items()}
+        all_keys = output_df.set_index(index_columns).index
+    else:
+        indexed_sources = {}
+        for name, df in sources.items():
+            df = df.set_index(index_columns).sort_index()
+            if not df.index.is_unique:
+                raise ValueError('Source "{0}" has duplicate keys on {1}'.format(name, index_columns))
+            indexed_sources[name] = df
+
+        output_df = pd.concat(list(indexed_sources.values()), axis=1, join='outer', sort=True)
+        if output_df.columns.duplicated().any():
+            duplicates = output_df.columns[output_df.columns.duplicated()].tolist()
+            raise ValueError('Columns appear in more than one source: {0}'.format(duplicates))
+
+        all_keys = output_df.index
+        output_df = output_df.reset_index()
+
+    coverage = key_coverage(indexed_sources, all_keys)
+    if logger:
+        for row in coverage.itertuples():
+            logger.debug('{0}: {1} of {2} keys ({3:.1%})'.format(row.SOURCE, row.MATCHED,
+                                                                 len(all_keys), row.COVERAGE))
+
+    return output_df, coverage
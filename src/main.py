@@ -4,17 +4,60 @@ import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 
-from src import create_finance_states_csv, create_enroll_states_summary_csv, create_enroll_districts_csv, \
-    create_finance_districts_csv, create_states_all_csv, create_naep_states_raw_csv, create_naep_states_csv, \
-    create_naep_states_summary_csv, create_enroll_districts_raw_csv, create_enroll_states_csv, \
-    create_enroll_states_raw_csv
+from src import create_finance_states_csv, create_enroll_districts_csv, create_finance_districts_csv, \
+    create_states_all_csv, create_naep_states_raw_csv, create_naep_states_csv, create_enroll_districts_raw_csv, \
+    create_enroll_states_csv, create_enroll_states_raw_csv, create_enroll_cube, create_enroll_states_rollup_csv, \
+    create_districts_all_csv, create_states_enriched_csv, district_index, summary_views, frame_handoff, \
+    polars_engine, output_manifest, output_writer, checkpoint, watch as source_watch, vintages as source_vintages
+
+# Source archives unpacked into the working directory by the stages
+SOURCE_ARCHIVES = [create_finance_districts_csv.ZIP_NAME, create_naep_states_raw_csv.ZIP_NAME,
+                   create_enroll_districts_raw_csv.ZIP_NAME, create_enroll_states_raw_csv.ZIP_NAME]
+
+# The archives and stages whose outputs each stage reads, in pipeline order (used by --watch)
+STAGE_INPUTS = {
+    'finance_districts': [create_finance_districts_csv.ZIP_NAME],
+    'finance_states': ['finance_districts'],
+    'naep_states_raw': [create_naep_states_raw_csv.ZIP_NAME],
+    'naep_states': ['naep_states_raw'],
+    'enroll_districts_raw': [create_enroll_districts_raw_csv.ZIP_NAME],
+    'district_index': ['enroll_districts_raw'],
+    'enroll_districts_cube': ['enroll_districts_raw', 'district_index'],
+    'enroll_districts': ['enroll_districts_raw', 'district_index'],
+    'enroll_states_raw': [create_enroll_states_raw_csv.ZIP_NAME],
+    'enroll_states_cube': ['enroll_states_raw'],
+    'enroll_states_rollup': ['enroll_states_cube'],
+    'enroll_states': ['enroll_states_raw'],
+    'districts_all': ['finance_districts', 'enroll_districts', 'district_index'],
+    'states_all': ['finance_states', 'enroll_states', 'naep_states'],
+    'states_enriched': ['states_all'],
+    'summaries': ['enroll_states', 'naep_states'],
+}
 
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
 @click.argument('interim_filepath', type=click.Path())
-def main(input_filepath, output_filepath, interim_filepath):
+@click.option('--processes', default=1, type=int, help='Worker processes used to restructure enrollment data.')
+@click.option('--sparse', is_flag=True, help='Store mostly-null district enrollment columns sparsely (also '
+              'writing them in COO format; the published CSV stays wide).')
+@click.option('--tidy', is_flag=True, help='Also write tidy (long) versions of the enrollment and NAEP files.')
+@click.option('--partitioned', is_flag=True, help='Store finance data by year, only ingesting new years.')
+@click.option('--engine', default='pandas', type=click.Choice(polars_engine.ENGINES),
+              help='Dataframe library used by the reshape and aggregation stages.')
+@click.option('--compress', type=click.Choice(list(output_writer.COMPRESSIONS)),
+              help='Compress the large published files (finance_districts, enroll_districts, states_all_extended).')
+@click.option('--resume', is_flag=True, help='Skip the stages completed by the last (failed) run.')
+@click.option('--summaries', is_flag=True,
+              help='Also write the summary tables (enroll_states_summary, naep_states_summary) as CSV files.')
+@click.option('--watch', is_flag=True,
+              help='After the run, keep rebuilding the outputs of archives that change, until interrupted.')
+@click.option('--vintages', is_flag=True,
+              help='Treat each subdirectory of the input directory as a vintage of the archives, processing them in '
+                   'parallel and writing a report of the cells that changed between vintages.')
+def main(input_filepath, output_filepath, interim_filepath, processes, sparse, tidy, partitioned, engine, compress,
+         resume, summaries, watch, vintages):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
@@ -28,37 +71,103 @@ def main(input_filepath, output_filepath, interim_filepath):
 
     LOGGER.info('Starting data processing...')
 
-    # Create district and state summary files
-    ## District
-    create_finance_districts_csv.main(LOGGER, INPUT_DIR, OUTPUT_DIR, SANITY_DIR)
-    ## State
-    create_finance_states_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)
+    # Each vintage is run through the rest of this function in a worker process
+    if vintages:
+        if watch:
+            raise click.UsageError('--watch can only be used with a single vintage')
+        source_vintages.main(LOGGER, INPUT_DIR, OUTPUT_DIR, SANITY_DIR, SOURCE_ARCHIVES,
+                             {'processes': processes, 'sparse': sparse, 'tidy': tidy, 'partitioned': partitioned,
+                              'engine': engine, 'compress': compress, 'resume': resume, 'summaries': summaries,
+                              'watch': False, 'vintages': False})
+        LOGGER.info('Data processing complete!')
+        return
+
+    # Remove frames and partial files left behind by an earlier run that was killed
+    frame_handoff.cleanup(SANITY_DIR)
+    checkpoint.cleanup_partial([OUTPUT_DIR, SANITY_DIR], SOURCE_ARCHIVES)
+
+    stages = [
+        # Create district and state summary files
+        ## District
+        ('finance_districts', lambda: create_finance_districts_csv.main(LOGGER, INPUT_DIR, OUTPUT_DIR, SANITY_DIR,
+                                                                        partitioned, compress)),
+        ## State
+        ('finance_states', lambda: create_finance_states_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR,
+                                                                  partitioned, engine)),
+
+        # Create a summary file from the NAEP data
+        ## District
+
+        ## State
+        ('naep_states_raw', lambda: create_naep_states_raw_csv.main(LOGGER, INPUT_DIR, OUTPUT_DIR, SANITY_DIR)),
+        ('naep_states', lambda: create_naep_states_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR, tidy, engine)),
+
+        # Create a summary file from the NCES data
+        ## District
+        ('enroll_districts_raw', lambda: create_enroll_districts_raw_csv.main(LOGGER, INPUT_DIR, OUTPUT_DIR,
+                                                                              SANITY_DIR)),
+        ('district_index', lambda: district_index.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)),
+        ('enroll_districts_cube', lambda: create_enroll_cube.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR,
+                                                                  'enroll_districts_raw.csv')),
+        ('enroll_districts', lambda: create_enroll_districts_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR,
+                                                                      processes, sparse, tidy, engine, compress)),
+
+        ## State
+        ('enroll_states_raw', lambda: create_enroll_states_raw_csv.main(LOGGER, INPUT_DIR, OUTPUT_DIR, SANITY_DIR)),
+        ('enroll_states_cube', lambda: create_enroll_cube.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR,
+                                                               'enroll_states_raw.csv')),
+        ('enroll_states_rollup', lambda: create_enroll_states_rollup_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR,
+                                                                              SANITY_DIR)),
+        ('enroll_states', lambda: create_enroll_states_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR,
+                                                                processes, tidy, engine)),
+
+        # Create a summary file from all the data
+        ## District
+        ('districts_all', lambda: create_districts_all_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)),
+
+        ## State
+        ('states_all', lambda: create_states_all_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR, engine,
+                                                          compress)),
+        ('states_enriched', lambda: create_states_enriched_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)),
+
+        # Summary tables are projections of enroll_states and naep_states, only written on request
+        ('summaries', lambda: summary_views.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR, summaries)),
+    ]
+
+    # Options that change the outputs; a stage completed with other options runs again.
+    # The engine and process count don't change the outputs, so can differ on resume.
+    options = {'sparse': sparse, 'tidy': tidy, 'partitioned': partitioned, 'compress': compress,
+               'summaries': summaries}
+
+    # The archives as read by this run, so that changes made during it are rebuilt
+    if watch:
+        archive_state = source_watch.ArchiveState(INPUT_DIR, SOURCE_ARCHIVES)
+
+    try:
+        checkpoint.run_stages(stages, SANITY_DIR, options, resume, LOGGER)
+    except BaseException:
+        # Leave only complete outputs behind, so a resumed run can trust them
+        LOGGER.error('Data processing failed; run again with --resume to continue from the failed stage')
+        checkpoint.cleanup_partial([OUTPUT_DIR, SANITY_DIR], SOURCE_ARCHIVES)
+        raise
+    finally:
+        frame_handoff.cleanup(SANITY_DIR)
+
+    # Record the hash of every output, which tells the data service to reload
+    output_manifest.write_manifest(OUTPUT_DIR)
 
-    # Create a summary file from the NAEP data
-    ## District
-
-    ## State
-    create_naep_states_raw_csv.main(LOGGER, INPUT_DIR, OUTPUT_DIR, SANITY_DIR)
-    create_naep_states_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)
-    create_naep_states_summary_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)
-
-    # Create a summary file from the NCES data
-    ## District
-    create_enroll_districts_raw_csv.main(LOGGER, INPUT_DIR, OUTPUT_DIR, SANITY_DIR)
-    create_enroll_districts_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)
-
-    ## State
-    create_enroll_states_raw_csv.main(LOGGER, INPUT_DIR, OUTPUT_DIR, SANITY_DIR)
-    create_enroll_states_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)
-    create_enroll_states_summary_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)
+    LOGGER.info('Data processing complete!')
 
-    # Create a summary file from all the data
-    ## District
+    if watch:
+        def rebuilt():
+            frame_handoff.cleanup(SANITY_DIR)
+            output_manifest.write_manifest(OUTPUT_DIR)
 
-    ## State
-    create_states_all_csv.main(LOGGER, OUTPUT_DIR, OUTPUT_DIR, SANITY_DIR)
+        def failed():
+            frame_handoff.cleanup(SANITY_DIR)
+            checkpoint.cleanup_partial([OUTPUT_DIR, SANITY_DIR], SOURCE_ARCHIVES)
 
-    LOGGER.info('Data processing complete!')
+        source_watch.watch(archive_state, stages, STAGE_INPUTS, SANITY_DIR, options, LOGGER, rebuilt, failed)
 
 
 if __name__ == '__main__':
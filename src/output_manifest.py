@@ -0,0 +1,71 @@
+"""
+A helper for recording a hash of every output file once the pipeline
+finishes (manifest.json in the output directory), so that consumers can
+tell which outputs changed between runs.
+"""
+
+import os
+import json
+import hashlib
+
+# The name of the manifest in the output directory
+MANIFEST_FILENAME = 'manifest.json'
+
+# Outputs with these extensions are hashed
+OUTPUT_EXTENSIONS = ('.csv', '.csv.gz', '.csv.zst', '.npz', '.npy', '.json')
+
+# Files are hashed in chunks of this many bytes
+CHUNK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    """
+    Hashes a file's contents.
+
+    :param path: The path of the file.
+    :return: The SHA-256 hex digest.
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_manifest(output_dir):
+    """
+    Hashes every output file and writes the manifest, replacing the
+    previous one atomically.
+
+    :param output_dir: The output directory.
+    :return: A dictionary of filename to hash.
+    :rtype: dict
+    """
+    manifest = {}
+    for filename in sorted(os.listdir(output_dir)):
+        path = os.path.join(output_dir, filename)
+        if filename != MANIFEST_FILENAME and filename.endswith(OUTPUT_EXTENSIONS) and os.path.isfile(path):
+            manifest[filename] = file_hash(path)
+
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return manifest
+
+
+def read_manifest(output_dir):
+    """
+    Reads the manifest written by the last finished run.
+
+    :param output_dir: The output directory.
+    :return: A dictionary of filename to hash (empty if there's no manifest).
+    :rtype: dict
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
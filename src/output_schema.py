@@ -0,0 +1,311 @@
+"""
+Declares what every pipeline output should look like (its columns, the
+kind of values in each, key columns that must be unique, ranges, and
+allowed states and years), and checks a dataframe against its schema
+before it's written, so that a bad output stops the pipeline instead of
+being published.
+
+Checks are vectorized, one pass over each column. Kinds are checked on
+values rather than dtypes, so a column of numeric strings (as read from
+the spreadsheets) passes as a number column, but one holding '†' doesn't.
+"""
+
+import re
+import datetime
+import numpy as np
+import pandas as pd
+import us  # US metadata, like state names
+
+# Kinds of values
+TEXT = 'text'
+NUMBER = 'number'
+INTEGER = 'integer'
+YEAR = 'year'
+BOOL = 'bool'
+
+# The range of survey years
+MIN_YEAR = 1986
+MAX_YEAR = datetime.date.today().year + 1
+
+# NAEP scale scores
+MIN_SCORE = 0
+MAX_SCORE = 500
+
+# Offending values quoted per violation
+EXAMPLE_COUNT = 3
+
+# State names, as spelled by the sources (us.STATES lists DC only with DC_STATEHOOD set)
+STATE_NAMES = sorted(set([state.name.upper() for state in us.STATES] + ['DISTRICT OF COLUMBIA']))
+STATES = [name.replace(' ', '_') for name in STATE_NAMES]
+
+# NAEP also reports on the nation and on Department of Defense schools
+JURISDICTIONS = STATES + ['NATIONAL', 'DODEA']
+
+# Summed finance columns (see create_finance_states_csv.SUMS)
+FINANCE_COLUMNS = ['TOTAL_REVENUE', 'FEDERAL_REVENUE', 'STATE_REVENUE', 'LOCAL_REVENUE', 'TOTAL_EXPENDITURE',
+                   'INSTRUCTION_EXPENDITURE', 'SUPPORT_SERVICES_EXPENDITURE', 'OTHER_EXPENDITURE',
+                   'CAPITAL_OUTLAY_EXPENDITURE']
+
+
+class SchemaError(ValueError):
+    """
+    Raised when an output doesn't match its schema.
+    """
+
+
+class Column:
+    """
+    The values allowed in a column.
+    """
+
+    def __init__(self, kind=None, minimum=None, maximum=None, values=None, nullable=True):
+        """
+        :param kind: TEXT, NUMBER, INTEGER, YEAR, BOOL, or None for any values.
+        :param minimum: The smallest number allowed.
+        :param maximum: The largest number allowed.
+        :param values: The values allowed (i.e. state names).
+        :param nullable: Whether values may be missing.
+        """
+        if kind == YEAR:
+            minimum = MIN_YEAR if minimum is None else minimum
+            maximum = MAX_YEAR if maximum is None else maximum
+        self.kind = kind
+        self.minimum = minimum
+        self.maximum = maximum
+        self.values = values
+        self.nullable = nullable
+
+
+class Schema:
+    """
+    The columns of an output. Every named column is required; any other
+    column must match one of the patterns (the first match applies).
+    """
+
+    def __init__(self, columns, patterns=None, keys=None):
+        """
+        :param columns: A dictionary of column name to Column.
+        :param patterns: A list of (regular expression, Column) pairs for data columns.
+        :param keys: The columns that together identify each row.
+        """
+        self.columns = columns
+        self.patterns = [(re.compile(pattern), column) for pattern, column in (patterns or [])]
+        self.keys = keys or []
+
+    def column(self, name):
+        if name in self.columns:
+            return self.columns[name]
+        for pattern, column in self.patterns:
+            if pattern.fullmatch(name):
+                return column
+        return None
+
+
+# Columns shared by several outputs
+PRIMARY_KEY = Column(TEXT, nullable=False)
+STATE_KEY = Column(TEXT, values=STATES, nullable=False)
+JURISDICTION_KEY = Column(TEXT, values=JURISDICTIONS, nullable=False)
+YEAR_KEY = Column(YEAR, nullable=False)
+COUNT = Column(NUMBER, minimum=0)
+SCORE = Column(NUMBER, minimum=MIN_SCORE, maximum=MAX_SCORE)
+AMOUNT = Column(NUMBER)
+RAW_COUNT = Column(None, minimum=0)  # Before NCES markers like '†' are removed
+
+# Data columns named <GRADE_RACE_GENDER> (enrollment) or <GRADE_RACE_GENDER_SUBJECT> (NAEP)
+ENROLL_PATTERN = r'[A-Z0-9]+(-[A-Z0-9]+)?_[A-Z]+_[A-Z]+'
+NAEP_PATTERN = r'G\d{2}_[A-Z]+_[A-Z]+_[A-Z]+'
+
+# Summary columns (see summary_views)
+SUMMARY_PATTERNS = [(r'GRADES_\w+_G', COUNT), (r'AVG_\w+_SCORE', SCORE)]
+
+STATE_KEYS = {'PRIMARY_KEY': PRIMARY_KEY, 'STATE': STATE_KEY, 'YEAR': YEAR_KEY}
+FINANCE = dict({'ENROLL': COUNT}, **{col: AMOUNT for col in FINANCE_COLUMNS})
+
+# Schemas of the outputs, by filename
+SCHEMAS = {
+    'naep_states_raw.csv': Schema({'YEAR': YEAR_KEY, 'STATE': JURISDICTION_KEY, 'DEMO': Column(TEXT, nullable=False),
+                                   'AVG_SCORE': SCORE, 'TEST_SUBJECT': Column(TEXT, nullable=False),
+                                   'TEST_YEAR': Column(INTEGER, minimum=1, maximum=12)}),
+    'naep_states.csv': Schema(dict(STATE_KEYS, STATE=JURISDICTION_KEY), [(NAEP_PATTERN, SCORE)], ['PRIMARY_KEY']),
+    'naep_states_summary.csv': Schema(dict(STATE_KEYS, STATE=JURISDICTION_KEY), SUMMARY_PATTERNS, ['PRIMARY_KEY']),
+
+    'enroll_states_raw.csv': Schema({'State Name': Column(TEXT, values=STATE_NAMES, nullable=False)},
+                                    [(r'\d{4}_' + ENROLL_PATTERN, RAW_COUNT)], ['State Name']),
+    'enroll_states.csv': Schema(STATE_KEYS, [(ENROLL_PATTERN, COUNT)], ['PRIMARY_KEY']),
+    'enroll_states_summary.csv': Schema(STATE_KEYS, SUMMARY_PATTERNS, ['PRIMARY_KEY']),
+    'enroll_states_rollup.csv': Schema(
+        dict(STATE_KEYS, GRADE=Column(TEXT, nullable=False), RACE=Column(TEXT, nullable=False),
+             GENDER=Column(TEXT, nullable=False), VALUE=COUNT, NCES_VALUE=COUNT, DIFFERENCE=AMOUNT,
+             MISMATCH=Column(BOOL, nullable=False)),
+        keys=['PRIMARY_KEY', 'GRADE', 'RACE', 'GENDER']),
+
+    'enroll_districts_raw.csv': Schema({'Agency Name': Column(TEXT, nullable=False), 'State Name': Column(TEXT),
+                                        'Agency ID': Column()}, [(r'\d{4}_' + ENROLL_PATTERN, RAW_COUNT)]),
+    'enroll_districts.csv': Schema({'PRIMARY_KEY': PRIMARY_KEY, 'DISTRICT': Column(TEXT),
+                                    'DISTRICT_ID': Column(INTEGER, minimum=1, nullable=False), 'YEAR': YEAR_KEY},
+                                   [(ENROLL_PATTERN, COUNT)], ['DISTRICT_ID', 'YEAR']),
+    'districts.csv': Schema({'DISTRICT_ID': Column(INTEGER, minimum=1, nullable=False), 'LEA_ID': Column(),
+                             'AGENCY_NAME': Column(TEXT), 'STATE': Column(TEXT)}, keys=['DISTRICT_ID']),
+
+    'finance_districts.csv': Schema(dict(STATE=STATE_KEY, NAME=Column(TEXT), YRDATA=YEAR_KEY, ENROLL=COUNT),
+                                    [(r'T[A-Z]+', AMOUNT)]),
+    'finance_states.csv': Schema(dict(STATE_KEYS, **FINANCE), keys=['PRIMARY_KEY']),
+
+    'districts_all.csv': Schema(dict(PRIMARY_KEY=PRIMARY_KEY, DISTRICT_ID=Column(INTEGER, minimum=1), YEAR=YEAR_KEY,
+                                     STATE=Column(TEXT), DISTRICT=Column(TEXT), **FINANCE),
+                                SUMMARY_PATTERNS, ['PRIMARY_KEY']),
+    'states_all.csv': Schema(dict(STATE_KEYS, STATE=JURISDICTION_KEY, **FINANCE), SUMMARY_PATTERNS, ['PRIMARY_KEY']),
+    'states_all_extended.csv': Schema(dict(STATE_KEYS, STATE=JURISDICTION_KEY, **FINANCE),
+                                      [(NAEP_PATTERN, SCORE), (ENROLL_PATTERN, COUNT)], ['PRIMARY_KEY']),
+    'states_all_enriched.csv': Schema(dict(STATE_KEYS, STATE=JURISDICTION_KEY, REGION=Column(TEXT), **FINANCE),
+                                      SUMMARY_PATTERNS + [(r'\w+_(REAL|PER_PUPIL)', AMOUNT)], ['PRIMARY_KEY']),
+
+    # Tidy outputs (see tidy_data), with a dimension column per part of a data column name
+    'enroll_states_tidy.csv': Schema(dict(STATE_KEYS, VALUE=COUNT), [(r'[A-Z]+', Column(TEXT, nullable=False))]),
+    'naep_states_tidy.csv': Schema(dict(STATE_KEYS, STATE=JURISDICTION_KEY, VALUE=SCORE),
+                                   [(r'[A-Z]+', Column(TEXT, nullable=False))]),
+    'enroll_districts_tidy.csv': Schema({'PRIMARY_KEY': PRIMARY_KEY, 'DISTRICT': Column(TEXT),
+                                         'DISTRICT_ID': Column(INTEGER, minimum=1), 'YEAR': YEAR_KEY, 'VALUE': COUNT},
+                                        [(r'[A-Z]+', Column(TEXT, nullable=False))]),
+}
+
+
+def examples(values):
+    values = pd.unique(np.asarray(values, dtype=object))
+    quoted = [repr(x) for x in values[:EXAMPLE_COUNT]]
+    return ', '.join(quoted) + (', ...' if len(values) > EXAMPLE_COUNT else '')
+
+
+def numeric_values(series):
+    """
+    Reads a column's values as numbers.
+
+    :param series: The column.
+    :return: The values (NaN where missing or not a number), and where values aren't numbers.
+    :rtype: tuple
+    """
+    dtype = series.dtype.subtype if isinstance(series.dtype, pd.SparseDtype) else series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return np.full(len(series), np.nan), series.notna().to_numpy()
+    if pd.api.types.is_numeric_dtype(dtype):
+        return series.to_numpy(dtype='float64', na_value=np.nan), np.zeros(len(series), dtype=bool)
+    if isinstance(dtype, pd.CategoricalDtype):
+        series = series.astype(object)
+
+    # Parsing every value at once is much faster, when they're all numbers
+    try:
+        return series.astype('float64').to_numpy(), np.zeros(len(series), dtype=bool)
+    except (ValueError, TypeError):
+        pass
+    parsed = pd.to_numeric(series, errors='coerce')
+    return parsed.to_numpy(dtype='float64', na_value=np.nan), (parsed.isna() & series.notna()).to_numpy()
+
+
+def check_column(name, series, column):
+    """
+    Checks the values of a column.
+
+    :param name: The name of the column.
+    :param series: The column.
+    :param column: The Column it should match.
+    :return: A description of each violation.
+    :rtype: list
+    """
+    problems = []
+    if not column.nullable:
+        missing = series.isna().to_numpy()
+        if missing.any():
+            problems.append('{0}: {1} missing values'.format(name, missing.sum()))
+
+    if column.kind == TEXT:
+        dtype = series.dtype
+        if not (dtype == object or pd.api.types.is_string_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype)):
+            problems.append('{0}: expected text, found {1}'.format(name, dtype))
+    elif column.kind == BOOL:
+        if not pd.api.types.is_bool_dtype(series.dtype):
+            problems.append('{0}: expected true/false values, found {1}'.format(name, series.dtype))
+
+    numbers = None
+    if column.kind in (NUMBER, INTEGER, YEAR) or column.minimum is not None or column.maximum is not None:
+        numbers, not_numbers = numeric_values(series)
+        if column.kind in (NUMBER, INTEGER, YEAR) and not_numbers.any():
+            problems.append('{0}: {1} values are not numbers ({2})'.format(
+                name, not_numbers.sum(), examples(series[not_numbers])))
+
+    if column.kind in (INTEGER, YEAR):
+        with np.errstate(invalid='ignore'):
+            fractional = np.mod(numbers, 1) != 0
+        fractional &= ~np.isnan(numbers)
+        if fractional.any():
+            problems.append('{0}: {1} values are not whole numbers ({2})'.format(
+                name, fractional.sum(), examples(numbers[fractional])))
+
+    for bound, label, outside in [(column.minimum, 'below', np.less), (column.maximum, 'above', np.greater)]:
+        if bound is None:
+            continue
+        with np.errstate(invalid='ignore'):
+            out_of_range = outside(numbers, bound)
+        if out_of_range.any():
+            problems.append('{0}: {1} values {2} {3} ({4})'.format(
+                name, out_of_range.sum(), label, bound, examples(numbers[out_of_range])))
+
+    if column.values is not None:
+        unknown = ~series.isin(column.values).to_numpy() & series.notna().to_numpy()
+        if unknown.any():
+            problems.append('{0}: {1} unexpected values ({2})'.format(
+                name, unknown.sum(), examples(series[unknown])))
+
+    return problems
+
+
+def check(df, schema):
+    """
+    Checks a dataframe against a schema.
+
+    :param df: The dataframe.
+    :param schema: The Schema.
+    :return: A description of each violation (empty if there are none).
+    :rtype: list
+    """
+    problems = []
+
+    missing_cols = [col for col in schema.columns if col not in df.columns]
+    if missing_cols:
+        problems.append('Missing columns: {0}'.format(', '.join(missing_cols)))
+
+    unexpected = []
+    for col in df.columns:
+        column = schema.column(col)
+        if column is None:
+            unexpected.append(col)
+        else:
+            problems += check_column(col, df[col], column)
+    if unexpected:
+        problems.append('Unexpected columns: {0}'.format(examples(unexpected)))
+
+    keys = [col for col in schema.keys if col in df.columns]
+    if keys and keys == schema.keys:
+        duplicated = df.duplicated(subset=keys, keep=False).to_numpy()
+        if duplicated.any():
+            duplicates = df.loc[duplicated, keys].astype(str).agg('/'.join, axis=1)
+            problems.append('{0}: {1} rows share a key ({2})'.format('/'.join(keys), duplicated.sum(),
+                                                                     examples(duplicates)))
+
+    return problems
+
+
+def validate(df, filename):
+    """
+    Checks an output against its schema before it's written.
+
+    :param df: The output.
+    :param filename: The name of the output (outputs without a schema aren't checked).
+    :return:
+    """
+    schema = SCHEMAS.get(filename)
+    if schema is None:
+        return
+
+    problems = check(df, schema)
+    if problems:
+        raise SchemaError('{0} does not match its schema:\n  {1}'.format(filename, '\n  '.join(problems)))
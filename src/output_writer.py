@@ -0,0 +1,190 @@
+"""
+A helper for writing the large published CSV files (i.e.
+enroll_districts.csv), optionally compressed with gzip or zstd, and for
+reading them back wherever they were written.
+
+Rows are formatted in chunks. Compressed outputs are formatted by
+Arrow's CSV writer (falling back to pandas when pyarrow is unavailable)
+and compressed in a pool of threads, as both release the GIL. Each
+compressed chunk is a complete gzip member or zstd frame; concatenated,
+they form a single valid .gz or .zst file. Uncompressed outputs are
+formatted by pandas, so they keep their original format, one chunk at a
+time (pandas holds the GIL, so threads wouldn't help).
+"""
+
+import io
+import os
+import gzip
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from src import checkpoint
+
+# Compression methods and their file extensions
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Rows formatted (and compressed) per chunk
+CHUNK_ROWS = 16384
+
+# Threads formatting and compressing chunks of compressed outputs
+THREADS = os.cpu_count() or 1
+
+# Chunks in flight per thread
+WINDOW_CHUNKS = 2
+
+
+def compressed_filename(filename, compress=None):
+    """
+    Names a possibly compressed output (i.e. enroll_districts.csv.gz).
+
+    :param filename: The name of the uncompressed output.
+    :param compress: The compression method, or None.
+    :return: The name of the output file.
+    :rtype: str
+    """
+    return filename + COMPRESSIONS[compress] if compress else filename
+
+
+def find_csv(input_dir, filename):
+    """
+    Finds an output, whether or not it was compressed.
+
+    :param input_dir: The directory containing the output.
+    :param filename: The name of the uncompressed output.
+    :return: The path of the output (the uncompressed path if none exists).
+    :rtype: str
+    """
+    for compress in [None] + list(COMPRESSIONS):
+        path = os.path.join(input_dir, compressed_filename(filename, compress))
+        if os.path.exists(path):
+            return path
+    return os.path.join(input_dir, filename)
+
+
+def read_csv(input_dir, filename, **kwargs):
+    """
+    Reads an output, whether or not it was compressed.
+
+    :param input_dir: The directory containing the output.
+    :param filename: The name of the uncompressed output.
+    :param kwargs: Passed on to pd.read_csv.
+    :return: The output.
+    :rtype: pd.DataFrame
+    """
+    path = find_csv(input_dir, filename)
+    if path.endswith(COMPRESSIONS['zstd']):
+        # Arrow bundles zstd, so the zstandard package isn't needed
+        import pyarrow
+
+        with pyarrow.CompressedInputStream(pyarrow.OSFile(path), 'zstd') as stream:
+            return pd.read_csv(io.BytesIO(stream.read()), **kwargs)
+    return pd.read_csv(path, **kwargs)
+
+
+def format_chunk(df, start, arrow=True):
+    """
+    Formats a chunk of rows as CSV.
+
+    :param df: The data to format.
+    :param start: The position of the chunk's first row (the header is written with the first chunk).
+    :param arrow: Whether to use Arrow's writer, which quotes every string and writes booleans as true/false.
+    :return: The CSV text of the chunk.
+    :rtype: bytes
+    """
+    try:
+        import pyarrow
+        import pyarrow.csv
+    except ImportError:
+        pyarrow = None
+
+    chunk = df.iloc[start:start + CHUNK_ROWS]
+    if pyarrow is None or not arrow:
+        return chunk.to_csv(index=False, header=(start == 0)).encode('utf-8')
+
+    # Arrow has no sparse columns, so they're made dense a chunk at a time
+    sparse_cols = [col for col, dtype in chunk.dtypes.items() if isinstance(dtype, pd.SparseDtype)]
+    if sparse_cols:
+        chunk = chunk.assign(**{col: chunk[col].sparse.to_dense() for col in sparse_cols})
+    sink = io.BytesIO()
+    pyarrow.csv.write_csv(pyarrow.Table.from_pandas(chunk, preserve_index=False), sink,
+                          pyarrow.csv.WriteOptions(include_header=(start == 0)))
+    return sink.getvalue()
+
+
+def compress_chunk(chunk, compress):
+    """
+    Compresses a chunk as a standalone gzip member or zstd frame.
+
+    :param chunk: The CSV text of a chunk.
+    :param compress: The compression method.
+    :return: The compressed chunk.
+    :rtype: bytes
+    """
+    if compress == 'zstd':
+        import pyarrow
+
+        return pyarrow.compress(chunk, codec='zstd', asbytes=True)
+
+    # A fixed timestamp keeps the output reproducible
+    return gzip.compress(chunk, compresslevel=6, mtime=0)
+
+
+def encode_chunk(df, start, compress=None):
+    """
+    Formats a chunk of rows as CSV, compressing it if requested.
+
+    :param df: The data to format.
+    :param start: The position of the chunk's first row.
+    :param compress: 'gzip', 'zstd', or None.
+    :return: The chunk, as written to the file.
+    :rtype: bytes
+    """
+    # Uncompressed outputs are formatted by pandas, as they always were
+    if not compress:
+        return format_chunk(df, start, arrow=False)
+    return compress_chunk(format_chunk(df, start), compress)
+
+
+def write_csv(df, output_dir, filename, compress=None, threads=THREADS):
+    """
+    Writes an output, replacing any copy written with a different
+    compression method. The file is written under a temporary name and
+    renamed when complete.
+
+    :param df: The data to write.
+    :param output_dir: The output directory.
+    :param filename: The name of the uncompressed output.
+    :param compress: 'gzip', 'zstd', or None.
+    :param threads: The number of threads formatting and compressing chunks (for compressed outputs).
+    :return: The path of the output.
+    :rtype: str
+    """
+    if compress and compress not in COMPRESSIONS:
+        raise ValueError('Unknown compression method: {0}'.format(compress))
+
+    output_path = os.path.join(output_dir, compressed_filename(filename, compress))
+    with checkpoint.atomic_output(output_path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            starts = range(0, max(len(df), 1), CHUNK_ROWS)
+            if not compress:
+                for start in starts:
+                    f.write(encode_chunk(df, start))
+            else:
+                # Chunks are formatted and compressed in parallel and written in order. Only a few
+                # chunks per thread are in flight, so the whole file is never held in memory.
+                with ThreadPoolExecutor(threads) as executor:
+                    pending = collections.deque()
+                    for start in starts:
+                        pending.append(executor.submit(encode_chunk, df, start, compress))
+                        if len(pending) >= threads * WINDOW_CHUNKS:
+                            f.write(pending.popleft().result())
+                    while pending:
+                        f.write(pending.popleft().result())
+
+    # Readers shouldn't find a stale copy of the same output
+    for other in [None] + list(COMPRESSIONS):
+        other_path = os.path.join(output_dir, compressed_filename(filename, other))
+        if other != compress and os.path.exists(other_path):
+            os.remove(other_path)
+
+    return output_path
@@ -0,0 +1,87 @@
+"""
+A cache of parsed archive members, shared by the processes of a
+multi-vintage run (see vintages.py). A member that is identical in
+several vintages (the same name and contents, i.e. a survey year NCES
+didn't revise) is parsed once; the other vintages load the parsed frame.
+Outside a multi-vintage run no cache is configured, and members are
+parsed as usual.
+"""
+
+import os
+import time
+import hashlib
+import pandas as pd
+from src import output_manifest, checkpoint
+
+# The directory holding parsed frames (None to parse every member)
+CACHE_DIR = None
+
+# Seconds between checks while another process parses a member
+LOCK_POLL_INTERVAL = 0.1
+
+
+def configure(cache_dir):
+    """
+    Sets the cache directory for this process (i.e. as a worker initializer).
+
+    :param cache_dir: The directory, shared by every process of the run (None to disable caching).
+    :return:
+    """
+    global CACHE_DIR
+    CACHE_DIR = cache_dir
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+def member_key(path, parser):
+    """
+    Identifies a parsed member by its name, its contents and the function
+    parsing it (parsers also read the name, i.e. for the survey year).
+
+    :param path: The path of the unpacked member (i.e. 'US_CENSUS_FINANCE/elsec17.xls').
+    :param parser: The function parsing it.
+    :return: A hex digest.
+    :rtype: str
+    """
+    identity = '{0}:{1}.{2}:{3}'.format(path, parser.__module__, parser.__qualname__, output_manifest.file_hash(path))
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def parse(path, parser, logger=None):
+    """
+    Parses an archive member, or loads it from the cache if another
+    vintage already parsed an identical member.
+
+    :param path: The path of the unpacked member.
+    :param parser: A function taking the path and logger, and returning a dataframe.
+    :param logger:
+    :return: The parsed member.
+    :rtype: pd.DataFrame
+    """
+    if CACHE_DIR is None:
+        return parser(path, logger)
+
+    # Vintages run at the same time, so the first to reach a member parses it while the others wait
+    cache_path = os.path.join(CACHE_DIR, member_key(path, parser) + '.pkl')
+    lock_path = cache_path + '.lock'
+    while True:
+        if os.path.exists(cache_path):
+            if logger:
+                logger.debug('Loading ' + str(path) + ', parsed for another vintage...')
+            return pd.read_pickle(cache_path)
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    try:
+        if os.path.exists(cache_path):
+            return pd.read_pickle(cache_path)
+        df = parser(path, logger)
+        with checkpoint.atomic_output(cache_path) as tmp_path:
+            df.to_pickle(tmp_path)
+        return df
+    finally:
+        os.close(lock)
+        os.remove(lock_path)
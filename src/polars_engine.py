@@ -0,0 +1,150 @@
+"""
+Polars implementations of the reshape- and aggregation-heavy transforms,
+used when the pipeline is run with --engine polars. Each function takes
+and returns pandas dataframes, producing the same output as its pandas
+counterpart, so the stages around it are unaffected by the engine.
+
+Polars is optional; it is only imported when one of these functions runs.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Engines accepted by the pipeline (pandas is the default)
+ENGINES = ['pandas', 'polars']
+
+
+def import_polars():
+    """
+    Imports Polars, explaining how to install it if it's missing.
+
+    :return: The polars module.
+    """
+    try:
+        import polars
+    except ImportError:
+        raise ImportError('The polars engine requires Polars (pip install polars)')
+    return polars
+
+
+def convert_columns(input_df):
+    """
+    Sets columns to numeric, filtering out strings
+    (see create_enroll_districts_csv.convert_column_group).
+    Columns are converted in parallel by Polars.
+
+    :param input_df: The columns to convert.
+    :return: The converted values.
+    :rtype: np.ndarray
+    """
+    pl = import_polars()
+
+    # Text columns are parsed from strings, like pd.to_numeric
+    text_cols = [col for col in input_df.columns if input_df[col].dtype == object]
+    input_df = input_df.astype({col: str for col in text_cols})
+
+    exprs = []
+    for col in input_df.columns:
+        expr = pl.col(col)
+        if col in text_cols:
+            expr = expr.str.strip_chars()
+        exprs.append(expr.cast(pl.Float64, strict=False))
+
+    output_df = pl.from_pandas(input_df).lazy().select(exprs).collect()
+    return output_df.to_numpy().astype('float64').reshape(len(input_df), len(input_df.columns))
+
+
+def naep_aggregate(input_df):
+    """
+    Pivots NAEP data to one row per state and year, with a
+    <GRADE_RACE_GENDER_SUBJECT> column per demographic and subject
+    (see create_naep_states_csv.naep_aggregate).
+
+    :param input_df: The raw NAEP data.
+    :return: The pivoted data.
+    :rtype: pd.DataFrame
+    """
+    pl = import_polars()
+
+    # Columns follow the order in which demographics and subjects first appear
+    demographics = input_df['DEMO'].unique().tolist()
+    subjects = input_df['TEST_SUBJECT'].unique().tolist()
+    data_cols = [demo + '_' + subject.upper() for demo in demographics for subject in subjects]
+
+    input_df = pl.from_pandas(input_df[['STATE', 'YEAR', 'DEMO', 'TEST_SUBJECT', 'AVG_SCORE']])
+    long_df = input_df.lazy().select(
+        (pl.col('YEAR').cast(pl.Utf8) + '_' + pl.col('STATE')).alias('PRIMARY_KEY'),
+        pl.col('STATE'),
+        pl.col('YEAR').cast(pl.Utf8),
+        (pl.col('DEMO') + '_' + pl.col('TEST_SUBJECT').str.to_uppercase()).alias('COLUMN'),
+        pl.col('AVG_SCORE').cast(pl.Float64)
+    ).collect()
+
+    # Rows with the same primary key are summed; sums of 0 become NaN
+    output_df = long_df.pivot(on='COLUMN', index=['PRIMARY_KEY', 'STATE', 'YEAR'], values='AVG_SCORE',
+                              aggregate_function='sum')
+    output_df = output_df.sort(['PRIMARY_KEY', 'STATE', 'YEAR']).to_pandas()
+
+    output_df = output_df.reindex(columns=['PRIMARY_KEY', 'STATE', 'YEAR'] + data_cols)
+    output_df[data_cols] = output_df[data_cols].astype('float64').replace(0, np.nan)
+
+    return output_df
+
+
+def aggregate_districts(df, sums):
+    """
+    Sums district finance data by state and year
+    (see create_finance_states_csv.aggregate_districts).
+
+    :param df: District finance data.
+    :param sums: A dictionary of output column to the district column it sums.
+    :return: State finance data, with a PRIMARY_KEY column.
+    :rtype: pd.DataFrame
+    """
+    pl = import_polars()
+
+    # Like SQL, the sum of only nulls is null
+    exprs = [pl.when(pl.col(col).count() > 0).then(pl.col(col).sum()).otherwise(None).alias(name)
+             for name, col in sums.items()]
+
+    output_df = pl.from_pandas(df).lazy().group_by(['STATE', 'YRDATA']).agg(exprs)
+    output_df = output_df.rename({'YRDATA': 'YEAR'}).sort(['YEAR', 'STATE']).collect().to_pandas()
+
+    output_df.insert(0, 'PRIMARY_KEY', output_df['YEAR'].astype(str) + '_' + output_df['STATE'])
+
+    return output_df
+
+
+def indexed_join(sources, index_columns):
+    """
+    Outer joins any number of sources on their shared key columns
+    (see indexed_join.indexed_join), sorted by the key columns.
+
+    :param sources: A dictionary of source name to dataframe.
+    :param index_columns: The key columns, i.e. ['YEAR', 'STATE'].
+    :return: The joined data.
+    :rtype: pd.DataFrame
+    """
+    pl = import_polars()
+
+    output_df = None
+    data_cols = []
+    for name, df in sources.items():
+        if df.duplicated(subset=index_columns).any():
+            raise ValueError('Source "{0}" has duplicate keys on {1}'.format(name, index_columns))
+        data_cols += [col for col in df.columns if col not in index_columns]
+
+        df = pl.from_pandas(df).lazy()
+        if output_df is None:
+            output_df = df
+        else:
+            output_df = output_df.join(df, on=index_columns, how='full', coalesce=True)
+
+    duplicates = pd.Index(data_cols)[pd.Index(data_cols).duplicated()].tolist()
+    if duplicates:
+        raise ValueError('Columns appear in more than one source: {0}'.format(duplicates))
+
+    output_df = output_df.sort(index_columns).collect().to_pandas()
+
+    # Keep the key columns first, as the pandas join does
+    return output_df[index_columns + data_cols]
@@ -0,0 +1,117 @@
+"""
+Summary tables, defined as named projections of a base table: its key
+columns plus a few data columns under human-readable names. A summary is
+resolved when it's needed (when states_all is assembled, or when a
+consumer like the data service asks for it) by selecting columns of the
+base table, so nothing is written unless the summary files are requested
+(main.py --summaries).
+"""
+
+import os
+from src import data_sanity_check, output_writer, output_schema, checkpoint
+
+# Columns identifying each row of a state table
+KEY_COLUMNS = ['PRIMARY_KEY', 'STATE', 'YEAR']
+
+
+class SummaryView:
+    """
+    A projection of a base table, renaming the columns it selects.
+    """
+
+    def __init__(self, base_filename, columns, key_columns=KEY_COLUMNS):
+        """
+        :param base_filename: The output the summary is taken from.
+        :param columns: A dictionary of base column to summary column name.
+        :param key_columns: The columns identifying each row, kept as they are.
+        """
+        self.base_filename = base_filename
+        self.columns = columns
+        self.key_columns = key_columns
+
+    def apply(self, base_df, key_columns=None):
+        """
+        Projects a base table (or any table with the same data columns,
+        i.e. the district enrollment data) down to the summary.
+
+        :param base_df: The base table.
+        :param key_columns: The columns identifying each row (defaults to the view's).
+        :return: The summary.
+        :rtype: pd.DataFrame
+        """
+        key_columns = self.key_columns if key_columns is None else key_columns
+        return base_df[key_columns + list(self.columns)].rename(columns=self.columns)
+
+    def load(self, input_dir):
+        """
+        Reads only the columns of the base table that the summary needs.
+
+        :param input_dir: The directory containing the base table.
+        :return: The summary.
+        :rtype: pd.DataFrame
+        """
+        base_df = output_writer.read_csv(input_dir, self.base_filename,
+                                         usecols=self.key_columns + list(self.columns))
+        return self.apply(base_df)
+
+
+# Summary views, by the filename they're written under when requested
+VIEWS = {
+    'enroll_states_summary.csv': SummaryView('enroll_states.csv',
+                                             {'PK_A_A': 'GRADES_PK_G',
+                                              'KG_A_A': 'GRADES_KG_G',
+                                              'G04_A_A': 'GRADES_4_G',
+                                              'G08_A_A': 'GRADES_8_G',
+                                              'G12_A_A': 'GRADES_12_G',
+                                              'G01-G08_A_A': 'GRADES_1_8_G',
+                                              'G09-G12_A_A': 'GRADES_9_12_G',
+                                              'A_A_A': 'GRADES_ALL_G'}),
+    'naep_states_summary.csv': SummaryView('naep_states.csv',
+                                           {'G04_A_A_MATHEMATICS': 'AVG_MATH_4_SCORE',
+                                            'G08_A_A_MATHEMATICS': 'AVG_MATH_8_SCORE',
+                                            'G04_A_A_READING': 'AVG_READING_4_SCORE',
+                                            'G08_A_A_READING': 'AVG_READING_8_SCORE'}),
+}
+
+ENROLL_SUMMARY = VIEWS['enroll_states_summary.csv']
+NAEP_SUMMARY = VIEWS['naep_states_summary.csv']
+
+
+def summary_columns(views=None):
+    """
+    Combines the renamed columns of several views.
+
+    :param views: The views (defaults to all of them).
+    :return: A dictionary of base column to summary column name.
+    :rtype: dict
+    """
+    columns = {}
+    for view in (VIEWS.values() if views is None else views):
+        columns.update(view.columns)
+    return columns
+
+
+def main(logger=None, input_dir=None, output_dir=None, sanity_dir=None, write=False):
+    """
+    Writes every summary view as a CSV file, or, if the files weren't
+    requested, removes copies left by an earlier run (which may no
+    longer match their base tables).
+
+    :param write: Whether the summary files were requested.
+    """
+    for filename, view in VIEWS.items():
+        output_path = os.path.join(output_dir, filename)
+        if not write:
+            if os.path.exists(output_path):
+                logger.debug('Removing ' + filename + ', not requested...')
+                os.remove(output_path)
+            continue
+
+        logger.debug('Writing ' + filename + '...')
+        output_df = view.load(input_dir)
+        output_schema.validate(output_df, filename)
+        with checkpoint.atomic_output(output_path) as tmp_path:
+            output_df.to_csv(tmp_path, index=False)
+
+        # Sanity check
+        data_sanity_check.main(logger, output_dir, sanity_dir, filename, count_year_nulls=True)
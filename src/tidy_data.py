@@ -0,0 +1,87 @@
+"""
+A helper for converting wide <GRADE_RACE_GENDER>-style tables into
+tidy (long) tables, with one row per non-null value.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from src import checkpoint, output_schema
+
+# Dimensions encoded in the data column names, in order
+ENROLL_DIMENSIONS = ['GRADE', 'RACE', 'GENDER']
+NAEP_DIMENSIONS = ['GRADE', 'RACE', 'GENDER', 'SUBJECT']
+
+
+def tidy_filename(filename):
+    """
+    Names the tidy version of an output file (i.e. enroll_states_tidy.csv).
+
+    :param filename: The name of the wide output file.
+    :return: The name of the tidy output file.
+    :rtype: str
+    """
+    return filename.replace('.csv', '_tidy.csv')
+
+
+def to_tidy(input_df, key_columns, dimensions):
+    """
+    Converts a wide table into a tidy one. Data column names are split
+    into dimensions once per column rather than once per row, and the
+    dimensions are stored as categoricals. Null values are dropped.
+
+    :param input_df: The wide table.
+    :param key_columns: The columns identifying each row (i.e. PRIMARY_KEY, STATE, YEAR).
+    :param dimensions: The names of the parts of each data column name.
+    :return: One row per non-null value.
+    :rtype: pd.DataFrame
+    """
+    data_cols = [col for col in input_df.columns if col not in key_columns]
+    values = input_df[data_cols].to_numpy(dtype='float64')
+    row_idx, col_idx = np.nonzero(~np.isnan(values))
+
+    output_df = input_df[key_columns].iloc[row_idx].reset_index(drop=True)
+
+    col_specs = [col.split('_') for col in data_cols]
+    for position, dimension in enumerate(dimensions):
+        labels = [spec[position] for spec in col_specs]
+        codes, categories = pd.factorize(pd.Series(labels))
+        output_df[dimension] = pd.Categorical.from_codes(codes[col_idx], categories=categories)
+
+    output_df['VALUE'] = values[row_idx, col_idx]
+
+    return output_df
+
+
+def read_tidy(input_dir, filename, dimensions):
+    """
+    Reads a tidy table, restoring its categorical dimensions.
+
+    :param input_dir: The directory containing the file.
+    :param filename: The name of the tidy file.
+    :param dimensions: The names of the dimension columns.
+    :return: The tidy table.
+    :rtype: pd.DataFrame
+    """
+    return pd.read_csv(os.path.join(input_dir, filename), dtype={x: 'category' for x in dimensions})
+
+
+def write_tidy(input_df, output_dir, filename, key_columns, dimensions):
+    """
+    Writes the tidy version of a wide output file.
+
+    :param input_df: The wide table.
+    :param output_dir: The output directory.
+    :param filename: The name of the wide output file.
+    :param key_columns: The columns identifying each row.
+    :param dimensions: The names of the parts of each data column name.
+    :return: The name of the tidy output file.
+    :rtype: str
+    """
+    output_filename = tidy_filename(filename)
+    output_df = to_tidy(input_df, key_columns, dimensions)
+    output_schema.validate(output_df, output_filename)
+    with checkpoint.atomic_output(os.path.join(output_dir, output_filename)) as tmp_path:
+        output_df.to_csv(tmp_path, index=False)
+
+    return output_filename
@@ -0,0 +1,229 @@
+"""
+Processes several vintages of the source archives in one run
+(main.py --vintages), i.e. data/raw/2019-10 and data/raw/2021-03 when
+NCES revised prior years in between.
+
+Each vintage is run through the whole pipeline in its own process, with
+its own output and interim directories (i.e. data/processed/2019-10).
+Members that are identical across vintages are parsed once (see
+parse_cache.py). Once every vintage is done, the outputs of each vintage
+are compared with those of the one before it, and the changed cells are
+listed in a diff report (vintage_diff.csv).
+"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from src import parse_cache, output_schema, output_manifest, output_writer, checkpoint
+
+# The name of the diff report in the output directory
+DIFF_FILENAME = 'vintage_diff.csv'
+
+# The subdirectory of the interim directory holding parsed members during a run
+CACHE_DIRNAME = 'parse_cache'
+
+# Columns of the diff report
+DIFF_COLUMNS = ['BEFORE_VINTAGE', 'AFTER_VINTAGE', 'FILE', 'KEY', 'COLUMN', 'CHANGE', 'BEFORE', 'AFTER']
+
+
+def find_vintages(input_dir, zip_names):
+    """
+    Lists the vintages in the input directory: its subdirectories holding
+    source archives, in name order (so name them by date, i.e. '2019-10').
+
+    :param input_dir: The input directory.
+    :param zip_names: The names of the source archives.
+    :return: A list of vintage names.
+    :rtype: list
+    """
+    return sorted(name for name in os.listdir(input_dir)
+                  if os.path.isdir(os.path.join(input_dir, name))
+                  and any(os.path.exists(os.path.join(input_dir, name, zip_name)) for zip_name in zip_names))
+
+
+def run_vintage(input_dir, output_dir, interim_dir, cache_dir, options):
+    """
+    Runs the pipeline on a single vintage (in a worker process). Archives
+    are unpacked into the vintage's interim directory, so that vintages
+    don't unpack over each other.
+
+    :param input_dir: The directory holding the vintage's archives.
+    :param output_dir: The vintage's output directory.
+    :param interim_dir: The vintage's interim directory.
+    :param cache_dir: The parse cache shared by the vintages.
+    :param options: The other arguments of main.main.
+    :return:
+    """
+    from src import main as pipeline
+
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(interim_dir, exist_ok=True)
+    os.chdir(interim_dir)
+    parse_cache.configure(cache_dir)
+    pipeline.main.callback(input_dir, output_dir, interim_dir, **options)
+
+
+def key_labels(df, keys):
+    """
+    Joins the key columns of each row into a single label (i.e. '2016_IDAHO/G04/A/A').
+
+    :param df: A dataframe indexed by its key columns.
+    :param keys: The key columns.
+    :return: The labels.
+    :rtype: np.ndarray
+    """
+    if len(keys) == 1:
+        return df.index.astype(str).to_numpy()
+    return np.array(['/'.join(map(str, key)) for key in df.index], dtype=object)
+
+
+def changed_cells(before, after):
+    """
+    Compares two columns cell by cell. Nulls are equal to each other, and
+    numbers are compared as numbers (so 5 and 5.0 are equal).
+
+    :param before: The column in the earlier vintage.
+    :param after: The same rows of the column in the later vintage.
+    :return: A boolean array, True where the cells differ.
+    :rtype: np.ndarray
+    """
+    before_null = before.isna().to_numpy()
+    after_null = after.isna().to_numpy()
+    if pd.api.types.is_numeric_dtype(before) and pd.api.types.is_numeric_dtype(after):
+        equal = before.to_numpy(dtype='float64') == after.to_numpy(dtype='float64')
+    else:
+        equal = before.astype(str).to_numpy() == after.astype(str).to_numpy()
+    return np.where(before_null | after_null, before_null != after_null, ~equal)
+
+
+def diff_frames(before, after, keys):
+    """
+    Lists the differences between two versions of an output: the rows
+    and columns added or removed, and the changed cells of the rest.
+
+    :param before: The output of the earlier vintage.
+    :param after: The output of the later vintage.
+    :param keys: The columns identifying each row.
+    :return: A row per difference, with the columns KEY, COLUMN, CHANGE, BEFORE and AFTER.
+    :rtype: pd.DataFrame
+    """
+    before = before.set_index(keys)
+    after = after.set_index(keys)
+    rows = before.index.intersection(after.index)
+    before_rows = before.reindex(rows)
+    after_rows = after.reindex(rows)
+    labels = key_labels(before_rows, keys)
+
+    parts = []
+    for change, index in [('row removed', before.index.difference(after.index)),
+                          ('row added', after.index.difference(before.index))]:
+        if len(index):
+            parts.append(pd.DataFrame({'KEY': key_labels(pd.DataFrame(index=index), keys), 'CHANGE': change}))
+    for change, columns in [('column removed', before.columns.difference(after.columns)),
+                            ('column added', after.columns.difference(before.columns))]:
+        if len(columns):
+            parts.append(pd.DataFrame({'COLUMN': columns, 'CHANGE': change}))
+
+    for col in before.columns.intersection(after.columns, sort=False):
+        changed = changed_cells(before_rows[col], after_rows[col])
+        if changed.any():
+            parts.append(pd.DataFrame({'KEY': labels[changed], 'COLUMN': col, 'CHANGE': 'cell changed',
+                                       'BEFORE': before_rows[col].to_numpy(dtype=object)[changed],
+                                       'AFTER': after_rows[col].to_numpy(dtype=object)[changed]}))
+
+    if not parts:
+        return pd.DataFrame(columns=DIFF_COLUMNS[3:])
+    return pd.concat(parts, ignore_index=True).reindex(columns=DIFF_COLUMNS[3:])
+
+
+def diff_outputs(before_dir, after_dir, logger=None):
+    """
+    Compares the keyed outputs (those whose schema lists key columns) of
+    two vintages. Outputs with the same hash in both manifests are skipped.
+
+    :param before_dir: The output directory of the earlier vintage.
+    :param after_dir: The output directory of the later vintage.
+    :param logger:
+    :return: A row per difference, with a FILE column naming the output.
+    :rtype: pd.DataFrame
+    """
+    before_manifest = output_manifest.read_manifest(before_dir)
+    after_manifest = output_manifest.read_manifest(after_dir)
+
+    parts = []
+    for filename, schema in output_schema.SCHEMAS.items():
+        if not schema.keys:
+            continue
+        before_path = output_writer.find_csv(before_dir, filename)
+        after_path = output_writer.find_csv(after_dir, filename)
+        if not os.path.exists(before_path) or not os.path.exists(after_path):
+            continue
+        before_hash = before_manifest.get(os.path.basename(before_path))
+        if before_hash is not None and before_hash == after_manifest.get(os.path.basename(after_path)):
+            continue
+
+        diff = diff_frames(output_writer.read_csv(before_dir, filename),
+                           output_writer.read_csv(after_dir, filename), schema.keys)
+        if logger:
+            logger.info('{0}: {1} differences'.format(filename, len(diff)))
+        diff.insert(0, 'FILE', filename)
+        parts.append(diff)
+
+    if not parts:
+        return pd.DataFrame(columns=DIFF_COLUMNS[2:])
+    return pd.concat(parts, ignore_index=True)
+
+
+def main(logger=None, input_dir=None, output_dir=None, interim_dir=None, zip_names=None, options=None):
+    """
+    Runs every vintage in parallel, then writes the diff report.
+
+    :param zip_names: The names of the source archives.
+    :param options: The other arguments of main.main, passed to each vintage's run.
+    :return: The names of the vintages.
+    :rtype: list
+    """
+    names = find_vintages(input_dir, zip_names)
+    if not names:
+        raise ValueError('No vintages (subdirectories holding source archives) in ' + input_dir)
+    logger.info('Processing vintages ' + ', '.join(names) + '...')
+
+    # The cache only lives for the run, so it never holds members parsed by older code
+    cache_dir = os.path.join(os.path.abspath(interim_dir), CACHE_DIRNAME)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    failed = []
+    try:
+        with ProcessPoolExecutor(len(names)) as executor:
+            futures = {name: executor.submit(run_vintage, os.path.abspath(os.path.join(input_dir, name)),
+                                             os.path.abspath(os.path.join(output_dir, name)),
+                                             os.path.abspath(os.path.join(interim_dir, name)), cache_dir, options)
+                       for name in names}
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception('Processing vintage ' + name + ' failed')
+                    failed.append(name)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if failed:
+        raise RuntimeError('Processing failed for vintages ' + ', '.join(failed) +
+                           '; run again with --resume to continue from the failed stages')
+
+    # Compare each vintage with the one before it
+    parts = []
+    for before, after in zip(names, names[1:]):
+        logger.info('Comparing vintages ' + before + ' and ' + after + '...')
+        diff = diff_outputs(os.path.join(output_dir, before), os.path.join(output_dir, after), logger)
+        diff.insert(0, 'AFTER_VINTAGE', after)
+        diff.insert(0, 'BEFORE_VINTAGE', before)
+        parts.append(diff)
+
+    report = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=DIFF_COLUMNS)
+    with checkpoint.atomic_output(os.path.join(output_dir, DIFF_FILENAME)) as tmp_path:
+        report.to_csv(tmp_path, index=False)
+
+    return names
@@ -0,0 +1,217 @@
+"""
+Watches the source archives and rebuilds the outputs that depend on
+those that change (main.py --watch).
+
+Changes are noticed with inotify when inotify_simple is installed, and
+by polling the archives' sizes and modification times otherwise. A
+burst of changes (i.e. several archives copied in one after another) is
+handled by a single rebuild, once the archives have stopped changing
+for a while; archives whose contents didn't actually change are ignored.
+"""
+
+import os
+import time
+from src import checkpoint, output_manifest
+
+# Seconds between checks of the archives (the longest wait with inotify)
+POLL_INTERVAL = 2.0
+
+# Seconds the archives must stay unchanged before a rebuild starts
+DEBOUNCE = 5.0
+
+
+def make_waiter(input_dir):
+    """
+    Creates a function that waits for up to a number of seconds, returning
+    early when something in the directory changes (if inotify is available).
+
+    :param input_dir: The directory to watch.
+    :return: The wait function.
+    """
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return time.sleep
+
+    inotify = INotify()
+    inotify.add_watch(input_dir, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE)
+    return lambda seconds: inotify.read(timeout=int(seconds * 1000))
+
+
+def archive_signatures(input_dir, zip_names):
+    """
+    Cheaply identifies the current version of each archive.
+
+    :param input_dir: The directory containing the archives.
+    :param zip_names: The names of the archives.
+    :return: A dictionary of archive name to (size, modification time), for the archives that exist.
+    :rtype: dict
+    """
+    signatures = {}
+    for zip_name in zip_names:
+        path = os.path.join(input_dir, zip_name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signatures[zip_name] = (stat.st_size, stat.st_mtime_ns)
+    return signatures
+
+
+class ArchiveState:
+    """
+    The archives as of the last build: their signatures, and the hashes
+    of their contents (computed only when a signature changes).
+    """
+
+    def __init__(self, input_dir, zip_names):
+        self.input_dir = input_dir
+        self.zip_names = zip_names
+        self.signatures = archive_signatures(input_dir, zip_names)
+        self.hashes = {zip_name: output_manifest.file_hash(os.path.join(input_dir, zip_name))
+                       for zip_name in self.signatures}
+
+    def changed(self, signatures):
+        """
+        Lists the archives whose contents differ from the last build,
+        and records their new versions.
+
+        :param signatures: The current signatures.
+        :return: The names of the changed archives.
+        :rtype: list
+        """
+        changed = []
+        for zip_name in self.zip_names:
+            if signatures.get(zip_name) == self.signatures.get(zip_name):
+                continue
+            path = os.path.join(self.input_dir, zip_name)
+            content_hash = output_manifest.file_hash(path) if zip_name in signatures else None
+            if content_hash != self.hashes.get(zip_name):
+                changed.append(zip_name)
+            self.hashes[zip_name] = content_hash
+        self.signatures = signatures
+        return changed
+
+
+def wait_for_changes(state, wait=time.sleep, poll_interval=POLL_INTERVAL, debounce=DEBOUNCE, timeout=None):
+    """
+    Waits until the contents of some archives change, and then until the
+    archives have stayed unchanged for the debounce period (so that a
+    half-copied archive isn't read).
+
+    :param state: The ArchiveState of the last build, updated to the new versions.
+    :param wait: Waits for a number of seconds (see make_waiter).
+    :param poll_interval: Seconds between checks.
+    :param debounce: Seconds the archives must stay unchanged.
+    :param timeout: Seconds after which to give up (None to wait forever).
+    :return: The names of the changed archives (empty if the timeout passed).
+    :rtype: list
+    """
+    start = time.monotonic()
+    latest = state.signatures
+    last_change = None
+    while timeout is None or time.monotonic() - start < timeout:
+        wait(poll_interval if last_change is None else min(poll_interval, debounce))
+        signatures = archive_signatures(state.input_dir, state.zip_names)
+        now = time.monotonic()
+        if signatures != latest:
+            latest, last_change = signatures, now
+        elif last_change is not None and now - last_change >= debounce:
+            changed = state.changed(signatures)
+            if changed:
+                return changed
+            # Touched, but with the same contents
+            last_change = None
+    return []
+
+
+def dependent_stages(stage_inputs, changed):
+    """
+    Works out which stages read a changed archive, directly or through
+    the outputs of other stages.
+
+    :param stage_inputs: A dictionary of stage name to the archives and stages it reads, in pipeline order.
+    :param changed: The names of the changed archives.
+    :return: The names of the stages to rebuild, in pipeline order.
+    :rtype: list
+    """
+    affected = set(changed)
+    stages = []
+    for stage, inputs in stage_inputs.items():
+        if affected.intersection(inputs):
+            affected.add(stage)
+            stages.append(stage)
+    return stages
+
+
+def rebuild(stages, names, interim_dir, options, logger):
+    """
+    Runs some of the stages again, in pipeline order, logging how long
+    each one takes. Their completion markers are cleared first, so a
+    failed rebuild can be resumed like a failed run.
+
+    :param stages: A list of (name, function) pairs, for the whole pipeline.
+    :param names: The names of the stages to run.
+    :param interim_dir: The interim directory.
+    :param options: The options of the run, recorded in each marker.
+    :param logger:
+    :return: A dictionary of stage name to seconds taken.
+    :rtype: dict
+    """
+    checkpoint.clear_checkpoints(interim_dir, names)
+
+    timings = {}
+    for name, function in stages:
+        if name not in names:
+            continue
+        start = time.perf_counter()
+        function()
+        checkpoint.mark_complete(interim_dir, name, options)
+        timings[name] = time.perf_counter() - start
+        logger.info('Rebuilt {0} in {1:.1f}s'.format(name, timings[name]))
+
+    return timings
+
+
+def watch(state, stages, stage_inputs, interim_dir, options, logger, on_rebuild=None, on_failure=None,
+          poll_interval=POLL_INTERVAL, debounce=DEBOUNCE, max_rebuilds=None):
+    """
+    Rebuilds the stages affected by each change to the archives, until
+    interrupted. A failed rebuild is logged, and retried on the next change.
+
+    :param state: The ArchiveState of the last build.
+    :param stages: A list of (name, function) pairs, for the whole pipeline.
+    :param stage_inputs: A dictionary of stage name to the archives and stages it reads.
+    :param interim_dir: The interim directory.
+    :param options: The options of the run.
+    :param logger:
+    :param on_rebuild: Called after each successful rebuild (i.e. to write the manifest).
+    :param on_failure: Called after each failed rebuild (i.e. to remove partial outputs).
+    :param poll_interval: Seconds between checks.
+    :param debounce: Seconds the archives must stay unchanged before a rebuild.
+    :param max_rebuilds: Stop after this many rebuilds (None to watch until interrupted).
+    :return:
+    """
+    wait = make_waiter(state.input_dir)
+    logger.info('Watching ' + state.input_dir + ' for changed archives...')
+
+    rebuilds = 0
+    try:
+        while max_rebuilds is None or rebuilds < max_rebuilds:
+            changed = wait_for_changes(state, wait, poll_interval, debounce)
+            names = dependent_stages(stage_inputs, changed)
+            logger.info('{0} changed; rebuilding {1}...'.format(', '.join(changed), ', '.join(names)))
+
+            start = time.perf_counter()
+            try:
+                rebuild(stages, names, interim_dir, options, logger)
+            except Exception:
+                logger.exception('Rebuild failed; waiting for the next change...')
+                if on_failure:
+                    on_failure()
+                continue
+            finally:
+                rebuilds += 1
+            if on_rebuild:
+                on_rebuild()
+            logger.info('Rebuilt {0} stages in {1:.1f}s'.format(len(names), time.perf_counter() - start))
+    except KeyboardInterrupt:
+        logger.info('Stopped watching')
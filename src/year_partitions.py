@@ -0,0 +1,122 @@
+"""
+A helper for storing outputs as one Parquet file per year
+(i.e. finance_districts/YEAR=2017/part.parquet), so that a new survey
+year can be added without rewriting the years before it.
+"""
+
+import os
+import pandas as pd
+
+# The name of the file inside each partition directory
+PARTITION_FILENAME = 'part.parquet'
+
+
+def partition_path(output_dir, dataset, year):
+    """
+    Gives the path of a single year's partition.
+
+    :param output_dir: The output directory.
+    :param dataset: The dataset name (i.e. 'finance_districts').
+    :param year: The year of the partition.
+    :return: The path of the partition file.
+    :rtype: str
+    """
+    return os.path.join(output_dir, dataset, 'YEAR={0}'.format(year), PARTITION_FILENAME)
+
+
+def partition_years(output_dir, dataset):
+    """
+    Lists the years that have a partition, without opening any of them.
+
+    :param output_dir: The output directory.
+    :param dataset: The dataset name.
+    :return: The years, sorted.
+    :rtype: list
+    """
+    dataset_dir = os.path.join(output_dir, dataset)
+    if not os.path.isdir(dataset_dir):
+        return []
+
+    years = []
+    for name in os.listdir(dataset_dir):
+        if name.startswith('YEAR=') and os.path.exists(os.path.join(dataset_dir, name, PARTITION_FILENAME)):
+            years.append(int(name.split('=')[1]))
+
+    return sorted(years)
+
+
+def has_partition(output_dir, dataset, year):
+    """
+    Checks whether a year has already been written.
+
+    :param output_dir: The output directory.
+    :param dataset: The dataset name.
+    :param year: The year of the partition.
+    :return: True if the partition exists.
+    :rtype: bool
+    """
+    return os.path.exists(partition_path(output_dir, dataset, year))
+
+
+def is_stale(output_dir, dataset, year, source_dir, source_dataset):
+    """
+    Checks whether a derived partition is missing or older than the
+    partition it was derived from.
+
+    :param output_dir: The directory of the derived dataset.
+    :param dataset: The derived dataset name.
+    :param year: The year of the partition.
+    :param source_dir: The directory of the source dataset.
+    :param source_dataset: The source dataset name.
+    :return: True if the derived partition needs rebuilding.
+    :rtype: bool
+    """
+    if not has_partition(output_dir, dataset, year):
+        return True
+
+    derived_mtime = os.path.getmtime(partition_path(output_dir, dataset, year))
+    source_mtime = os.path.getmtime(partition_path(source_dir, source_dataset, year))
+    return source_mtime > derived_mtime
+
+
+def write_partition(df, output_dir, dataset, year):
+    """
+    Writes a single year's partition, replacing it atomically if it
+    already exists.
+
+    :param df: The data for that year.
+    :param output_dir: The output directory.
+    :param dataset: The dataset name.
+    :param year: The year of the partition.
+    :return: The path of the partition file.
+    :rtype: str
+    """
+    path = partition_path(output_dir, dataset, year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+    return path
+
+
+def read_partitions(input_dir, dataset, years=None):
+    """
+    Reads a dataset, opening only the partitions for the requested years.
+
+    :param input_dir: The directory containing the dataset.
+    :param dataset: The dataset name.
+    :param years: The years to read (defaults to all of them).
+    :return: The data for those years, in year order.
+    :rtype: pd.DataFrame
+    """
+    available_years = partition_years(input_dir, dataset)
+    if years is not None:
+        years = set(int(x) for x in years)
+        available_years = [x for x in available_years if x in years]
+
+    record = [pd.read_parquet(partition_path(input_dir, dataset, year)) for year in available_years]
+    if not record:
+        return pd.DataFrame()
+
+    return pd.concat(record, ignore_index=True)
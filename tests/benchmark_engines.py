@@ -0,0 +1,78 @@
+"""
+Times the transforms that can run on either engine (pandas or polars),
+using the intermediate files of a finished pipeline run.
+
+Usage: python -m tests.benchmark_engines [data/processed]
+"""
+
+import os
+import sys
+import time
+import pandas as pd
+from src import create_naep_states_csv, create_enroll_states_csv, create_enroll_districts_csv, \
+    create_finance_states_csv, create_states_all_csv, output_writer, polars_engine
+
+# Each transform is timed this many times, keeping the fastest
+REPEATS = 3
+
+
+def best_time(function, args, engine):
+    """
+    Times a transform on one engine, keeping the fastest of several runs.
+
+    :param function: The transform to time.
+    :param args: Its arguments, before the engine.
+    :param engine: The engine to run it on.
+    :return: The fastest run, in seconds.
+    :rtype: float
+    """
+    times = []
+    for _ in range(REPEATS):
+        # Inputs are copied (untimed), as some transforms modify them
+        run_args = [x.copy() if isinstance(x, pd.DataFrame) else x for x in args]
+        start = time.perf_counter()
+        function(*run_args, engine=engine)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def transforms(data_dir):
+    """
+    Loads the input of every engine-aware transform.
+
+    :param data_dir: The directory of a finished pipeline run.
+    :return: A dictionary of transform name to (function, arguments before the engine).
+    :rtype: dict
+    """
+    def read(filename, **kwargs):
+        return output_writer.read_csv(data_dir, filename, **kwargs)
+
+    finance = read('finance_states.csv')
+    enroll = read('enroll_states.csv')
+    achieve = read('naep_states.csv')
+
+    return {
+        'naep_aggregate': (create_naep_states_csv.naep_aggregate, [read('naep_states_raw.csv')]),
+        'restructure_enroll_data (states)': (create_enroll_states_csv.restructure_enroll_data,
+                                             [read('enroll_states_raw.csv'), 1, None]),
+        'restructure_enroll_data (districts)': (create_enroll_districts_csv.restructure_enroll_data,
+                                                [read('enroll_districts_raw.csv', dtype={'Agency ID': str}),
+                                                 1, None, False, None]),
+        'aggregate_districts': (create_finance_states_csv.aggregate_districts, [read('finance_districts.csv')]),
+        'join_state_data': (create_states_all_csv.join_state_data, [finance, enroll, achieve, None]),
+    }
+
+
+def main(data_dir):
+    polars_engine.import_polars()
+
+    print('{0:<40}{1:>10}{2:>10}{3:>10}'.format('TRANSFORM', 'PANDAS', 'POLARS', 'SPEEDUP'))
+    for name, (function, args) in transforms(data_dir).items():
+        pandas_time = best_time(function, args, 'pandas')
+        polars_time = best_time(function, args, 'polars')
+        print('{0:<40}{1:>9.3f}s{2:>9.3f}s{3:>9.1f}x'.format(name, pandas_time, polars_time,
+                                                            pandas_time / polars_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join('data', 'processed'))
@@ -0,0 +1,87 @@
+"""
+Times the two parts of reading each NAEP spreadsheet: parsing the Excel
+file, and cleaning up the parsed frame (nde_spreadsheet_to_dataframe
+without the parsing), to check that the cleanup is a small share.
+
+Usage: python -m tests.benchmark_naep_parsing [data/raw]
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import unittest.mock
+import pandas as pd
+from src import create_naep_states_raw_csv, checkpoint
+
+# Each step is timed this many times, keeping the fastest
+REPEATS = 5
+
+
+def best_time(function):
+    """
+    Times a function, keeping the fastest of several runs.
+
+    :param function: The function to time.
+    :return: The fastest run, in seconds.
+    :rtype: float
+    """
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def time_spreadsheet(filename, logger):
+    """
+    Times parsing and cleaning up a single spreadsheet.
+
+    :param filename: The unpacked spreadsheet (i.e. 'NAEP_ASSESS_STATES/NDE_MATHEMATICS_G4.xls').
+    :param logger:
+    :return: The parse and cleanup times, in seconds.
+    :rtype: (float, float)
+    """
+    read_excel = pd.read_excel
+    parsed = read_excel(filename, dtype=str, skiprows=8, skipfooter=7)
+    parse_time = best_time(lambda: read_excel(filename, dtype=str, skiprows=8, skipfooter=7))
+
+    # The cleanup gets a copy of the parsed frame instead of parsing the file again
+    with unittest.mock.patch.object(pd, 'read_excel', lambda *args, **kwargs: parsed.copy()):
+        cleanup_time = best_time(lambda: create_naep_states_raw_csv.nde_spreadsheet_to_dataframe(filename, logger))
+
+    return parse_time, cleanup_time
+
+
+def main(input_dir):
+    logger = logging.getLogger(__name__)
+    input_dir = os.path.abspath(input_dir)
+
+    # Spreadsheets are unpacked into a scratch working directory
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with checkpoint.extracted_archive(input_dir, create_naep_states_raw_csv.ZIP_NAME) as file_list:
+            print('{0:<50}{1:>10}{2:>10}{3:>10}'.format('SPREADSHEET', 'PARSE', 'CLEANUP', 'CLEANUP %'))
+            total_parse, total_cleanup = 0, 0
+            for item in file_list:
+                parse_time, cleanup_time = time_spreadsheet(item, logger)
+                total_parse += parse_time
+                total_cleanup += cleanup_time
+                print('{0:<50}{1:>8.1f}ms{2:>8.1f}ms{3:>9.1f}%'.format(
+                    os.path.basename(item), parse_time * 1000, cleanup_time * 1000,
+                    100 * cleanup_time / (parse_time + cleanup_time)))
+            print('{0:<50}{1:>8.1f}ms{2:>8.1f}ms{3:>9.1f}%'.format(
+                'PER FILE', total_parse * 1000 / len(file_list), total_cleanup * 1000 / len(file_list),
+                100 * total_cleanup / (total_parse + total_cleanup)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join('data', 'raw'))
@@ -0,0 +1,402 @@
+"""
+Checks that a candidate implementation of a transform (i.e. the polars
+engine, or a faster rewrite of a pandas transform) gives the same output
+as the reference implementation, on the same inputs.
+
+Outputs are aligned by their key columns before they're compared, so a
+change in row order is reported once rather than as a difference in
+every cell. Numbers are compared with float tolerances, but NaN only
+matches NaN, so a missing value that became 0 (or the reverse) is
+reported; so are dtype changes and missing or extra rows and columns.
+
+Inputs are synthetic frames in the layout of the intermediate files,
+with the awkward values of the real sources (missing values, zeros,
+duplicate rows, NCES markers like '†'). Each is built from a seed, so a
+failure can be reproduced.
+
+Usage: python -m tests.equivalence [number of seeds]
+"""
+
+import sys
+import functools
+import numpy as np
+import pandas as pd
+import us  # US metadata, like state names
+from src import create_naep_states_csv, create_enroll_states_csv, create_enroll_districts_csv, \
+    create_finance_states_csv, polars_engine
+
+# Default tolerances for comparing numbers (as in np.isclose)
+RTOL = 1e-9
+ATOL = 1e-6
+
+# Seeds checked by default
+SEEDS = range(10)
+
+# Labels of the synthetic inputs
+NAEP_YEARS = [2003, 2005, 2007, 2009, 2011, 2013, 2015, 2017, 2019]
+NAEP_SUBJECTS = ['Mathematics', 'Reading']
+ENROLL_YEARS = [1993, 2008, 2016, 2017]
+GRADES = ['A', 'PK', 'KG', 'G01', 'G04', 'G08', 'G12', 'G01-G08']
+RACES = ['A', 'AM', 'AS', 'BL', 'HI', 'WH', 'TR']
+GENDERS = ['A', 'M', 'F']
+
+# Values the NCES exports use for missing or inapplicable data
+NCES_MARKERS = ['†', '–', '‡']
+
+
+class EquivalenceReport:
+    """
+    The differences between a reference output and a candidate output.
+
+    issues lists structural differences (columns, dtypes, keys, row
+    order); cells holds one row per differing value, with the row's keys
+    and the COLUMN, REFERENCE and CANDIDATE values.
+    """
+
+    def __init__(self, issues, cells):
+        self.issues = issues
+        self.cells = cells
+
+    @property
+    def equivalent(self):
+        return not self.issues and self.cells.empty
+
+    def summary(self, max_cells=10):
+        """
+        Describes the differences, for test failures and the command line.
+
+        :param max_cells: The most differing values listed.
+        :return: A line per difference.
+        :rtype: str
+        """
+        lines = list(self.issues)
+        if not self.cells.empty:
+            counts = self.cells['COLUMN'].value_counts()
+            lines.append('{0} values differ, in {1} columns ({2})'.format(
+                len(self.cells), len(counts), ', '.join(counts.index[:10])))
+            lines.append(self.cells.head(max_cells).to_string(index=False))
+        return '\n'.join(lines) if lines else 'Equivalent'
+
+
+def examples(labels, count=5):
+    labels = list(labels)
+    return ', '.join(str(x) for x in labels[:count]) + (', ...' if len(labels) > count else '')
+
+
+def key_index(df, keys):
+    """
+    Indexes the rows of an output by their keys, compared as text (so a
+    key column whose dtype changed still aligns).
+
+    :return: The keys of each row.
+    :rtype: pd.Index
+    """
+    if len(keys) == 1:
+        return pd.Index(df[keys[0]].astype(str))
+    return pd.MultiIndex.from_frame(df[keys].astype(str))
+
+
+def values_differ(reference, candidate, rtol=RTOL, atol=ATOL):
+    """
+    Compares two aligned columns value by value. Numbers are close
+    within the tolerances; missing values only match missing values.
+
+    :param reference: The values of the reference output.
+    :param candidate: The values of the candidate output.
+    :param rtol: The relative tolerance.
+    :param atol: The absolute tolerance.
+    :return: True where the values differ.
+    :rtype: np.ndarray
+    """
+    reference_missing = pd.isna(reference).to_numpy()
+    candidate_missing = pd.isna(candidate).to_numpy()
+
+    both_numeric = pd.api.types.is_numeric_dtype(reference) and pd.api.types.is_numeric_dtype(candidate) \
+        and not pd.api.types.is_bool_dtype(reference) and not pd.api.types.is_bool_dtype(candidate)
+    if both_numeric:
+        a = reference.to_numpy(dtype='float64', na_value=np.nan)
+        b = candidate.to_numpy(dtype='float64', na_value=np.nan)
+        with np.errstate(invalid='ignore'):
+            same = np.isclose(a, b, rtol=rtol, atol=atol)
+    else:
+        same = (reference.astype(object).to_numpy() == candidate.astype(object).to_numpy())
+
+    same = np.where(reference_missing | candidate_missing, reference_missing & candidate_missing, same)
+    return ~same
+
+
+def compare_frames(reference, candidate, keys=None, rtol=RTOL, atol=ATOL, check_dtype=True, check_order=True):
+    """
+    Compares a candidate output to a reference output.
+
+    :param reference: The output of the reference implementation.
+    :param candidate: The output of the candidate implementation.
+    :param keys: The columns identifying each row (rows are aligned by position if None).
+    :param rtol: The relative tolerance for numbers.
+    :param atol: The absolute tolerance for numbers.
+    :param check_dtype: Whether to report columns whose dtype changed.
+    :param check_order: Whether to report rows or columns in a different order.
+    :return: The differences.
+    :rtype: EquivalenceReport
+    """
+    issues = []
+
+    # Columns
+    missing_cols = [col for col in reference.columns if col not in candidate.columns]
+    extra_cols = [col for col in candidate.columns if col not in reference.columns]
+    if missing_cols:
+        issues.append('{0} columns missing: {1}'.format(len(missing_cols), examples(missing_cols)))
+    if extra_cols:
+        issues.append('{0} extra columns: {1}'.format(len(extra_cols), examples(extra_cols)))
+    common_cols = [col for col in reference.columns if col in candidate.columns]
+    if check_order and not missing_cols and not extra_cols and list(reference.columns) != list(candidate.columns):
+        issues.append('Columns are in a different order')
+
+    if check_dtype:
+        for col in common_cols:
+            if reference[col].dtype != candidate[col].dtype:
+                issues.append('{0} is {1}, expected {2}'.format(col, candidate[col].dtype, reference[col].dtype))
+
+    # Rows
+    keys = list(keys or [])
+    if keys:
+        reference_index, candidate_index = key_index(reference, keys), key_index(candidate, keys)
+        for name, index in [('reference', reference_index), ('candidate', candidate_index)]:
+            if index.has_duplicates:
+                issues.append('Duplicate keys in the {0}: {1}'.format(name, examples(index[index.duplicated()])))
+                return EquivalenceReport(issues, pd.DataFrame())
+    else:
+        reference_index = pd.RangeIndex(len(reference))
+        candidate_index = pd.RangeIndex(len(candidate))
+
+    missing_rows = reference_index.difference(candidate_index, sort=False)
+    extra_rows = candidate_index.difference(reference_index, sort=False)
+    if len(missing_rows):
+        issues.append('{0} rows missing: {1}'.format(len(missing_rows), examples(missing_rows)))
+    if len(extra_rows):
+        issues.append('{0} extra rows: {1}'.format(len(extra_rows), examples(extra_rows)))
+
+    # Rows are aligned in the reference's order
+    common_rows = reference_index[reference_index.isin(candidate_index)]
+    if check_order and not candidate_index[candidate_index.isin(reference_index)].equals(common_rows):
+        issues.append('Rows are in a different order')
+
+    reference_rows = reference_index.get_indexer(common_rows)
+    candidate_rows = candidate_index.get_indexer(common_rows)
+
+    # Cells
+    cells = []
+    for col in [col for col in common_cols if col not in keys]:
+        a = reference[col].iloc[reference_rows].reset_index(drop=True)
+        b = candidate[col].iloc[candidate_rows].reset_index(drop=True)
+        differ = values_differ(a, b, rtol, atol)
+        if differ.any():
+            cell_df = reference[keys].iloc[reference_rows[differ]].reset_index(drop=True) if keys \
+                else pd.DataFrame({'ROW': reference_rows[differ]})
+            cell_df['COLUMN'] = col
+            cell_df['REFERENCE'] = a[differ].astype(object).to_numpy()
+            cell_df['CANDIDATE'] = b[differ].astype(object).to_numpy()
+            cells.append(cell_df)
+
+    cells = pd.concat(cells, ignore_index=True) if cells else pd.DataFrame()
+    return EquivalenceReport(issues, cells)
+
+
+def check_equivalence(reference, candidate, make_inputs, keys=None, seeds=SEEDS, **kwargs):
+    """
+    Runs two implementations of a transform on the inputs of several
+    seeds, and compares their outputs. Each implementation gets its own
+    copy of the inputs, as some transforms modify them.
+
+    :param reference: The reference implementation.
+    :param candidate: The candidate implementation (taking the same arguments).
+    :param make_inputs: A function of a np.random.Generator, returning a list of arguments.
+    :param keys: The columns identifying each row of the output.
+    :param seeds: The seeds to build inputs from.
+    :param kwargs: Passed on to compare_frames.
+    :return: A dictionary of seed to EquivalenceReport.
+    :rtype: dict
+    """
+    reports = {}
+    for seed in seeds:
+        inputs = make_inputs(np.random.default_rng(seed))
+        outputs = []
+        for function in [reference, candidate]:
+            run_inputs = [x.copy() if isinstance(x, pd.DataFrame) else x for x in inputs]
+            outputs.append(function(*run_inputs))
+        reports[seed] = compare_frames(outputs[0], outputs[1], keys, **kwargs)
+    return reports
+
+
+def scatter(rng, values, fraction, replacements):
+    """
+    Replaces a random fraction of values with others.
+
+    :param rng: The random generator.
+    :param values: An object array, modified in place.
+    :param fraction: The share of values replaced.
+    :param replacements: The values to pick from.
+    :return:
+    """
+    mask = rng.random(values.shape) < fraction
+    picks = rng.integers(0, len(replacements), size=mask.sum())
+    values[mask] = np.array(replacements, dtype=object)[picks]
+
+
+def random_naep_raw(rng):
+    """
+    Builds a frame like naep_states_raw.csv: one row per state, year,
+    demographic and subject, with some scores missing or zero, some
+    rows duplicated, and rows in no particular order.
+
+    :param rng: The random generator.
+    :return: The arguments of naep_aggregate.
+    :rtype: list
+    """
+    states = list(rng.choice([state.name.upper() for state in us.STATES], size=5, replace=False)) + ['NATIONAL']
+    demos = ['{0}_{1}_{2}'.format(grade, race, gender) for grade in ['G04', 'G08']
+             for race in rng.choice(RACES, size=3, replace=False) for gender in GENDERS]
+    years = sorted(rng.choice(NAEP_YEARS, size=4, replace=False))
+
+    index = pd.MultiIndex.from_product([years, states, demos, NAEP_SUBJECTS],
+                                       names=['YEAR', 'STATE', 'DEMO', 'TEST_SUBJECT'])
+    df = index.to_frame(index=False)
+    df['AVG_SCORE'] = rng.integers(150, 320, size=len(df)).astype('float64')
+    df.loc[rng.random(len(df)) < 0.05, 'AVG_SCORE'] = np.nan
+    df.loc[rng.random(len(df)) < 0.05, 'AVG_SCORE'] = 0
+    df['TEST_YEAR'] = df['DEMO'].str[1:3].astype(int)
+
+    # Some states are reported twice (their scores are summed)
+    df = pd.concat([df, df.sample(frac=0.02, random_state=rng.integers(2 ** 31))], ignore_index=True)
+    df = df.sample(frac=1, random_state=rng.integers(2 ** 31)).reset_index(drop=True)
+    return [df[['YEAR', 'STATE', 'DEMO', 'AVG_SCORE', 'TEST_SUBJECT', 'TEST_YEAR']]]
+
+
+def random_enroll_values(rng, rows, data_cols):
+    """
+    Builds <YEAR_GRADE_RACE_GENDER> columns of enrollment counts, as read
+    from the NCES exports: mostly integers, some missing, some zero, and
+    some columns still holding NCES markers or padded numbers as text.
+
+    :return: The columns.
+    :rtype: pd.DataFrame
+    """
+    df = pd.DataFrame(rng.integers(0, 50000, size=(rows, len(data_cols))).astype('float64'), columns=data_cols)
+    df = df.mask(rng.random(df.shape) < 0.05, 0)
+    df = df.mask(rng.random(df.shape) < 0.05)
+
+    for col in rng.choice(data_cols, size=max(1, len(data_cols) // 4), replace=False):
+        values = df[col].astype(object).to_numpy()
+        scatter(rng, values, 0.2, NCES_MARKERS)
+        numbers = np.array([isinstance(x, float) and not np.isnan(x) for x in values])
+        values[numbers] = [' {0:g} '.format(x) for x in values[numbers]]
+        df[col] = values
+    return df
+
+
+def random_data_columns(rng):
+    years = sorted(rng.choice(ENROLL_YEARS, size=2, replace=False))
+    demos = ['{0}_A_A'.format(grade) for grade in GRADES] + \
+            ['G01_{0}_{1}'.format(race, gender) for race in RACES[1:] for gender in GENDERS[1:]]
+    return ['{0}_{1}'.format(year, demo) for year in years for demo in demos]
+
+
+def random_enroll_states_raw(rng):
+    """
+    Builds a frame like enroll_states_raw.csv: one row per state.
+
+    :param rng: The random generator.
+    :return: The arguments of create_enroll_states_csv.restructure_enroll_data.
+    :rtype: list
+    """
+    states = [state.name.upper() for state in us.STATES]
+    df = random_enroll_values(rng, len(states), random_data_columns(rng))
+    df.insert(0, 'State Name', states)
+    return [df, 1, None]
+
+
+def random_enroll_districts_raw(rng):
+    """
+    Builds a frame like enroll_districts_raw.csv: one row per district,
+    some without a state, in no particular order.
+
+    :param rng: The random generator.
+    :return: The arguments of create_enroll_districts_csv.restructure_enroll_data.
+    :rtype: list
+    """
+    count = 40
+    states = rng.choice([state.name.upper() for state in us.STATES[:5]], size=count).astype(object)
+    states[rng.random(count) < 0.05] = np.nan
+
+    df = random_enroll_values(rng, count, random_data_columns(rng))
+    df.insert(0, 'Agency Name', ['DISTRICT {0}'.format(x) for x in rng.permutation(count)])
+    df.insert(1, 'State Name', states)
+    df.insert(2, 'Agency ID', ['{0:07d}'.format(x) for x in rng.choice(10 ** 7, size=count, replace=False)])
+    return [df, 1, None, False, None]
+
+
+def random_finance_districts(rng):
+    """
+    Builds a frame like finance_districts.csv: one row per district and
+    year, with some figures missing (including a column with none at all
+    for a state and year).
+
+    :param rng: The random generator.
+    :return: The arguments of aggregate_districts.
+    :rtype: list
+    """
+    count = 200
+    df = pd.DataFrame({
+        'STATE': rng.choice([state.name.upper() for state in us.STATES[:8]], size=count),
+        'ENROLL': rng.integers(0, 50000, size=count),
+        'NAME': ['DISTRICT {0}'.format(x) for x in range(count)],
+        'YRDATA': rng.choice([1992, 2008, 2016], size=count),
+    })
+    for col in create_finance_states_csv.SCHEMA[4:]:
+        df[col] = rng.integers(0, 10 ** 7, size=count)
+    for col in rng.choice(create_finance_states_csv.SCHEMA[4:], size=3, replace=False):
+        df[col] = df[col].mask(rng.random(count) < 0.1)
+    df.loc[(df['STATE'] == df['STATE'].iloc[0]) & (df['YRDATA'] == df['YRDATA'].iloc[0]), 'TCAPOUT'] = np.nan
+    return [df]
+
+
+# Transforms with a reference and a candidate implementation:
+# name -> (reference, candidate, input builder, output keys)
+TRANSFORMS = {
+    'naep_aggregate': (
+        functools.partial(create_naep_states_csv.naep_aggregate, engine='pandas'),
+        functools.partial(create_naep_states_csv.naep_aggregate, engine='polars'),
+        random_naep_raw, ['PRIMARY_KEY']),
+    'restructure_enroll_data (states)': (
+        functools.partial(create_enroll_states_csv.restructure_enroll_data, engine='pandas'),
+        functools.partial(create_enroll_states_csv.restructure_enroll_data, engine='polars'),
+        random_enroll_states_raw, ['PRIMARY_KEY']),
+    'restructure_enroll_data (districts)': (
+        functools.partial(create_enroll_districts_csv.restructure_enroll_data, engine='pandas'),
+        functools.partial(create_enroll_districts_csv.restructure_enroll_data, engine='polars'),
+        random_enroll_districts_raw, ['PRIMARY_KEY']),
+    'aggregate_districts': (
+        functools.partial(create_finance_states_csv.aggregate_districts, engine='pandas'),
+        functools.partial(create_finance_states_csv.aggregate_districts, engine='polars'),
+        random_finance_districts, ['PRIMARY_KEY']),
+}
+
+
+def main(seed_count):
+    polars_engine.import_polars()
+
+    failures = 0
+    for name, (reference, candidate, make_inputs, keys) in TRANSFORMS.items():
+        reports = check_equivalence(reference, candidate, make_inputs, keys, range(seed_count))
+        failed = {seed: report for seed, report in reports.items() if not report.equivalent}
+        print('{0:<40}{1}'.format(name, 'FAILED ({0} of {1} seeds)'.format(len(failed), len(reports))
+                                  if failed else 'OK'))
+        for seed, report in failed.items():
+            print('Seed {0}:\n{1}'.format(seed, report.summary()))
+        failures += len(failed)
+
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main(int(sys.argv[1]) if len(sys.argv) > 1 else len(SEEDS)) else 0)
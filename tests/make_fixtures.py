@@ -0,0 +1,259 @@
+"""
+Builds the small source archives in tests/fixtures/raw that the test
+suite runs the pipeline on.
+
+The NAEP and NCES state archives are cut down from the real ones in
+data/raw, keeping only a few states (NAEP) or a few years (NCES). The Census finance and NCES
+district archives aren't in the repository, so stand-ins with the same
+layout are generated for a few districts (carrying the hard-coded
+values that tests.py checks).
+
+Usage: python -m tests.make_fixtures [data/raw]
+"""
+
+import io
+import os
+import re
+import csv
+import sys
+import struct
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+import xlrd
+from src import fetch_sources, create_finance_districts_csv
+
+# Where the fixture archives are written
+FIXTURE_RAW_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'raw')
+
+# States kept in the fixtures
+FIXTURE_STATES = ['IDAHO', 'OHIO']
+
+# Lines around the data in the source exports (the NAEP header includes the column labels,
+# the NCES footer starts below the totals row)
+NAEP_HEADER_ROWS = 9
+NAEP_FOOTER_ROWS = 7
+ENROLL_HEADER_LINES = 7
+ENROLL_FOOTER_LINES = 6
+
+# Stand-in school districts, as named by the Census (finance) and NCES (enrollment)
+DISTRICTS = [
+    # (state, Census name, NCES name, NCES LEA ID)
+    ('IDAHO', 'MERIDIAN SCHOOL DISTRICT 2', 'JOINT SCHOOL DISTRICT NO. 2', '1602250'),
+    ('IDAHO', 'NAMPA SCHOOL DISTRICT 131', 'NAMPA SCHOOL DISTRICT', '1602340'),
+    ('IDAHO', 'BOISE CITY INDEPENDENT DISTRICT 1', 'BOISE INDEPENDENT DISTRICT', '1600390'),
+    ('OHIO', 'COLUMBUS CITY SCHOOL DISTRICT', 'COLUMBUS CITY SCHOOL DISTRICT', '3904380'),
+    ('OHIO', 'CLEVELAND MUNICIPAL SCH DIST', 'CLEVELAND MUNICIPAL', '3904378'),
+]
+
+# Values from the real source files, checked by tests.py
+KNOWN_VALUES = {('finance', 2016, 'MERIDIAN SCHOOL DISTRICT 2', 'TOTALREV'): 281989,
+                ('enroll', 2017, 'NAMPA SCHOOL DISTRICT', 'Total'): 15585}
+
+FINANCE_YEARS = [2016, 2017]
+ENROLL_YEARS = [2016, 2017]
+ENROLL_GRADES = ['Prekindergarten', 'Kindergarten', 'Grades 1-8', 'Grades 9-12'] + \
+    ['Grade {0}'.format(x) for x in range(1, 13)]
+
+
+def biff_record(opcode, data):
+    return struct.pack('<HH', opcode, len(data)) + data
+
+
+def write_xls(path, rows):
+    """
+    Writes a single-sheet Excel 2.1 (BIFF2) file, the simplest format
+    that pd.read_excel reads as .xls.
+
+    :param path: The path of the file.
+    :param rows: Lists of cell values (str, number, or None for an empty cell).
+    :return:
+    """
+    out = io.BytesIO()
+    out.write(biff_record(0x0009, struct.pack('<HH', 0x0007, 0x0010)))  # BOF (worksheet)
+    out.write(biff_record(0x0042, struct.pack('<H', 1252)))  # CODEPAGE
+    out.write(biff_record(0x0000, struct.pack('<HHHH', 0, len(rows), 0, max(len(x) for x in rows))))  # DIMENSIONS
+    for row_idx, row in enumerate(rows):
+        for col_idx, value in enumerate(row):
+            if value is None or value == '':
+                continue
+            if isinstance(value, str):
+                # Labels hold at most 255 bytes
+                label = value.encode('cp1252', errors='replace')[:255]
+                record = struct.pack('<HH3sB', row_idx, col_idx, b'\0\0\0', len(label)) + label
+                out.write(biff_record(0x0004, record))
+            else:
+                out.write(biff_record(0x0003, struct.pack('<HH3sd', row_idx, col_idx, b'\0\0\0', value)))
+    out.write(biff_record(0x000A, b''))  # EOF
+
+    with open(path, 'wb') as f:
+        f.write(out.getvalue())
+
+
+def cut_naep(source, path):
+    """
+    Copies a NAEP spreadsheet, keeping only the rows of FIXTURE_STATES
+    (and the national rows).
+
+    :param source: The contents of the original spreadsheet.
+    :param path: The path of the copy.
+    :return:
+    """
+    sheet = xlrd.open_workbook(file_contents=source).sheet_by_index(0)
+    rows = [[cell.value if cell.ctype in (xlrd.XL_CELL_TEXT, xlrd.XL_CELL_NUMBER) else None
+             for cell in sheet.row(row_idx)] for row_idx in range(sheet.nrows)]
+
+    data = rows[NAEP_HEADER_ROWS:-NAEP_FOOTER_ROWS]
+    kept = [row for row in data if str(row[1]).upper() in FIXTURE_STATES + ['NATIONAL']]
+    write_xls(path, rows[:NAEP_HEADER_ROWS] + kept + rows[-NAEP_FOOTER_ROWS:])
+
+
+def cut_enroll(source, path):
+    """
+    Copies an NCES export, keeping only the columns of ENROLL_YEARS (the
+    state stages expect every state, so all rows are kept).
+
+    :param source: The contents of the original export.
+    :param path: The path of the copy.
+    :return:
+    """
+    lines = source.decode('utf-8').splitlines(keepends=True)
+    data = list(csv.reader(lines[ENROLL_HEADER_LINES - 1:-ENROLL_FOOTER_LINES]))
+
+    years = [re.search(r'\d{4}', label) for label in data[0]]
+    kept = [col_idx for col_idx, year in enumerate(years) if year is None or int(year.group(0)) in ENROLL_YEARS]
+
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(''.join(lines[:ENROLL_HEADER_LINES - 1]))
+        writer = csv.writer(f, lineterminator='\n')
+        for row in data:
+            writer.writerow([row[col_idx] for col_idx in kept])
+        f.write(''.join(lines[-ENROLL_FOOTER_LINES:]))
+
+
+def cut_archive(input_dir, zip_name, mirror_dir, cut):
+    """
+    Copies every member of a source archive through a cut function.
+
+    :return: The names of the members.
+    :rtype: list
+    """
+    folder = zip_name[:-len('.zip')]
+    os.makedirs(os.path.join(mirror_dir, folder))
+    members = []
+    with zipfile.ZipFile(os.path.join(input_dir, zip_name)) as archive:
+        for name in archive.namelist():
+            if name.endswith('/'):
+                continue
+            member = name.split('/')[-1]
+            cut(archive.read(name), os.path.join(mirror_dir, folder, member))
+            members.append(member)
+    return members
+
+
+def write_finance(mirror_dir, rng):
+    """
+    Writes stand-in Census finance spreadsheets (elsecYY.xls) for the
+    fixture districts, including a column the pipeline ignores.
+
+    :return: The names of the members.
+    :rtype: list
+    """
+    folder = os.path.join(mirror_dir, 'US_CENSUS_FINANCE')
+    os.makedirs(folder)
+    columns = ['IDCENSUS', 'NAME', 'STATE', 'CONUM', 'ENROLL', 'YRDATA', 'TOTALREV', 'TFEDREV', 'TSTREV',
+               'TLOCREV', 'TOTALEXP', 'TCURINST', 'TCURSSVC', 'TCURONON', 'TCAPOUT']
+    state_codes = {name.upper(): state_idx + 1
+                   for state_idx, name in enumerate(create_finance_districts_csv.CENSUS_STATES)}
+
+    members = []
+    for year in FINANCE_YEARS:
+        rows = [columns]
+        for district_idx, (state, census_name, _, _) in enumerate(DISTRICTS):
+            # The pipeline reads the state from the first two digits of the ID
+            state_code = state_codes[state]
+            total = KNOWN_VALUES.get(('finance', year, census_name, 'TOTALREV'), int(rng.integers(50000, 900000)))
+            federal, state_revenue = int(total * rng.uniform(0.05, 0.15)), int(total * rng.uniform(0.4, 0.6))
+            expenditure = [int(total * x) for x in rng.dirichlet(np.ones(4))]
+            rows.append(['{0:02d}5{1:011d}'.format(state_code, district_idx), census_name, str(state_code),
+                         '{0:05d}'.format(district_idx), int(rng.integers(5000, 50000)), year % 100,
+                         total, federal, state_revenue, total - federal - state_revenue,
+                         sum(expenditure)] + expenditure)
+        member = 'elsec{0:02d}.xls'.format(year % 100)
+        write_xls(os.path.join(folder, member), rows)
+        members.append(member)
+    return members
+
+
+def write_enroll_districts(mirror_dir, rng):
+    """
+    Writes stand-in NCES district exports in the layout of the state
+    exports: one with total enrollment, one by grade. Some values are
+    marked as missing or not applicable, as in the real exports.
+
+    :return: The names of the members.
+    :rtype: list
+    """
+    folder = os.path.join(mirror_dir, 'NCES_ENROLL_DISTRICTS')
+    os.makedirs(folder)
+
+    header = ['﻿ELSI Export', '', 'National Center for Education Statistics - http://nces.ed.gov/ccd/elsi/', '',
+              'This is a District based table with the following filters applied: State(s) (All Years): Idaho, Ohio',
+              '']
+    footer = ['', 'Data Source: U.S. Department of Education National Center for Education Statistics Common Core '
+                  'of Data (CCD) "Local Education Agency Universe Survey"', '',
+              '† indicates that the data are not applicable.', '– indicates that the data are missing.',
+              '‡ indicates that the data do not meet NCES data quality standards.']
+
+    def labels(grade):
+        name = 'Total Students All Grades (Excludes AE)' if grade == 'Total' else grade + ' Students'
+        return ['{0} [District] {1}-{2:02d}'.format(name, year, (year + 1) % 100) for year in reversed(ENROLL_YEARS)]
+
+    members = []
+    for member, grades in [('NCES_ENROLL_DISTRICT_TOTALS.csv', ['Total']),
+                           ('NCES_ENROLL_DISTRICT_GRADES.csv', ENROLL_GRADES)]:
+        columns = ['Agency Name', 'State Name [District] Latest available year',
+                   'Agency ID - NCES Assigned [District] Latest available year']
+        columns += [label for grade in grades for label in labels(grade)]
+        lines = header + [','.join(columns)]
+
+        for state, _, nces_name, lea_id in DISTRICTS:
+            values = []
+            for grade in grades:
+                for year in reversed(ENROLL_YEARS):
+                    value = KNOWN_VALUES.get(('enroll', year, nces_name, grade), int(rng.integers(100, 20000)))
+                    if grade == 'Prekindergarten' and state == 'IDAHO':
+                        value = '†'
+                    elif grade == 'Grade 12' and year == ENROLL_YEARS[0] and state == 'OHIO':
+                        value = '–'
+                    values.append(str(value))
+            lines.append(','.join([nces_name, state, lea_id] + values))
+        lines.append('Totals:' + ',' * (len(columns) - 1))
+
+        with open(os.path.join(folder, member), 'w', encoding='utf-8', newline='\n') as f:
+            f.write('\n'.join(lines + footer) + '\n')
+        members.append(member)
+    return members
+
+
+def main(input_dir):
+    rng = np.random.default_rng(2016)
+    mirror_dir = tempfile.mkdtemp()
+    os.makedirs(FIXTURE_RAW_DIR, exist_ok=True)
+
+    archives = {
+        'NAEP_ASSESS_STATES.zip': cut_archive(input_dir, 'NAEP_ASSESS_STATES.zip', mirror_dir, cut_naep),
+        'NCES_ENROLL_STATES.zip': cut_archive(input_dir, 'NCES_ENROLL_STATES.zip', mirror_dir, cut_enroll),
+        'US_CENSUS_FINANCE.zip': write_finance(mirror_dir, rng),
+        'NCES_ENROLL_DISTRICTS.zip': write_enroll_districts(mirror_dir, rng),
+    }
+    for zip_name, members in archives.items():
+        fetch_sources.assemble_archive(mirror_dir, zip_name, members, FIXTURE_RAW_DIR)
+        print('Wrote ' + os.path.join(FIXTURE_RAW_DIR, zip_name))
+
+    shutil.rmtree(mirror_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join('data', 'raw'))
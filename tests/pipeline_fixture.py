@@ -0,0 +1,175 @@
+"""
+Runs the pipeline once per test session on the fixture archives in
+tests/fixtures/raw (see make_fixtures.py), and hands out its outputs,
+each loaded once and indexed by its key columns.
+
+Whole outputs are compared against per-column digests stored in
+tests/fixtures/golden.json. After an intended change to the outputs,
+regenerate the digests (and review the diff) with:
+
+    python -m tests.pipeline_fixture
+"""
+
+import os
+import json
+import atexit
+import shutil
+import hashlib
+import tempfile
+import functools
+import pandas as pd
+from src import main as pipeline, output_writer, output_manifest, summary_views
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+FIXTURE_RAW_DIR = os.path.join(FIXTURE_DIR, 'raw')
+GOLDEN_PATH = os.path.join(FIXTURE_DIR, 'golden.json')
+
+# Columns identifying the rows of each output (PRIMARY_KEY if not listed)
+OUTPUT_KEYS = {'finance_districts.csv': ['YRDATA', 'STATE', 'NAME'],
+               'naep_states_raw.csv': ['YEAR', 'STATE', 'DEMO', 'TEST_SUBJECT'],
+               'enroll_states_raw.csv': ['State Name'],
+               'enroll_districts_raw.csv': ['State Name', 'Agency Name'],
+               'enroll_states_rollup.csv': ['PRIMARY_KEY', 'GRADE', 'RACE', 'GENDER'],
+               'districts.csv': ['DISTRICT_ID']}
+
+# Numbers are rounded to this many decimals before hashing, so digests
+# don't depend on how an output's floats were formatted
+DIGEST_DECIMALS = 6
+
+
+@functools.lru_cache(maxsize=None)
+def run_pipeline():
+    """
+    Runs the whole pipeline on the fixture archives, once per session.
+    The outputs are removed when the session ends.
+
+    :return: The directory holding the outputs.
+    :rtype: str
+    """
+    run_dir = tempfile.mkdtemp(prefix='usedudata_')
+    atexit.register(shutil.rmtree, run_dir, True)
+    output_dir = os.path.join(run_dir, 'processed')
+    interim_dir = os.path.join(run_dir, 'interim')
+    os.makedirs(output_dir)
+    os.makedirs(interim_dir)
+
+    # Archives are unpacked into the working directory
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        pipeline.main([FIXTURE_RAW_DIR, output_dir, interim_dir], standalone_mode=False)
+    finally:
+        os.chdir(cwd)
+
+    return output_dir
+
+
+@functools.lru_cache(maxsize=None)
+def load(filename):
+    """
+    Loads an output of the fixture run, indexed (and sorted) by its key
+    columns, i.e. load('states_all.csv').loc['2016_IDAHO', 'TOTAL_REVENUE'].
+    Summary tables are resolved from their base tables, as they aren't
+    written by default. The same frame is returned on every call, so
+    don't modify it.
+
+    :param filename: The name of the output.
+    :return: The output.
+    :rtype: pd.DataFrame
+    """
+    if filename in summary_views.VIEWS:
+        df = summary_views.VIEWS[filename].load(run_pipeline())
+    else:
+        df = output_writer.read_csv(run_pipeline(), filename)
+    return df.set_index(OUTPUT_KEYS.get(filename, ['PRIMARY_KEY'])).sort_index()
+
+
+def column_digest(series):
+    """
+    Hashes the values of a column, in order.
+
+    :param series: The column.
+    :return: A short hex digest.
+    :rtype: str
+    """
+    if pd.api.types.is_numeric_dtype(series):
+        series = series.astype('float64').round(DIGEST_DECIMALS)
+    else:
+        series = series.astype(str)
+    return hashlib.sha256(series.to_csv(index=False, header=False).encode('utf-8')).hexdigest()[:16]
+
+
+def output_digests(output_dir):
+    """
+    Hashes every output: each column of the CSV files (by their
+    uncompressed name, so the digests don't depend on --compress), and
+    the other files whole.
+
+    :param output_dir: The directory holding the outputs.
+    :return: A dictionary of filename to {'rows': ..., 'columns': {column: digest}} or {'file': digest}.
+    :rtype: dict
+    """
+    digests = {}
+    for filename in sorted(os.listdir(output_dir)):
+        if filename == output_manifest.MANIFEST_FILENAME or not filename.endswith(output_manifest.OUTPUT_EXTENSIONS):
+            continue
+        for extension in output_writer.COMPRESSIONS.values():
+            filename = filename[:-len(extension)] if filename.endswith('.csv' + extension) else filename
+        if filename.endswith('.csv'):
+            df = output_writer.read_csv(output_dir, filename)
+            digests[filename] = {'rows': len(df), 'columns': {col: column_digest(df[col]) for col in df.columns}}
+        else:
+            digests[filename] = {'file': output_manifest.file_hash(os.path.join(output_dir, filename))[:16]}
+    return digests
+
+
+def compare_digests(expected, actual):
+    """
+    Lists the differences between two sets of output digests.
+
+    :param expected: The golden digests.
+    :param actual: The digests of the fixture run.
+    :return: A line per difference (empty if they match).
+    :rtype: list
+    """
+    differences = []
+    for filename in sorted(set(expected) | set(actual)):
+        if filename not in actual:
+            differences.append('{0}: missing'.format(filename))
+        elif filename not in expected:
+            differences.append('{0}: not in the golden digests'.format(filename))
+        elif expected[filename] != actual[filename]:
+            before, after = expected[filename], actual[filename]
+            if 'columns' not in before or 'columns' not in after:
+                differences.append('{0}: contents changed'.format(filename))
+                continue
+            if before['rows'] != after['rows']:
+                differences.append('{0}: {1} rows, expected {2}'.format(filename, after['rows'], before['rows']))
+            changed = [col for col in after['columns'] if before['columns'].get(col) != after['columns'][col]]
+            dropped = [col for col in before['columns'] if col not in after['columns']]
+            for label, cols in [('changed', changed), ('dropped', dropped)]:
+                if cols:
+                    differences.append('{0}: {1} columns {2}: {3}'.format(
+                        filename, len(cols), label, ', '.join(cols[:10]) + (', ...' if len(cols) > 10 else '')))
+    return differences
+
+
+def read_golden():
+    with open(GOLDEN_PATH) as f:
+        return json.load(f)
+
+
+def write_golden(digests):
+    with open(GOLDEN_PATH, 'w') as f:
+        json.dump(digests, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    output_dir = run_pipeline()
+    digests = output_digests(output_dir)
+    if os.path.exists(GOLDEN_PATH):
+        for line in compare_digests(read_golden(), digests):
+            print(line)
+    write_golden(digests)
+    print('Wrote ' + GOLDEN_PATH)
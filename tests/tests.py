@@ -1,185 +1,153 @@
 """
 A testing script that evaluates each pipeline.
 
-Should only be run AFTER the main script has executed and
-output files have been generated.
+The pipeline tests run the main script once, on the small fixture
+archives in tests/fixtures/raw (see tests/pipeline_fixture.py).
 """
 
 import os
+import sys
+import json
 import time
+import logging
 import shutil
+import tempfile
+import threading
+import urllib.request
+import urllib.error
+import hashlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import numpy as np
 import pandas as pd
 import unittest
+import unittest.mock
 import zipfile
 from pathlib import Path
 
+# Run as a script (python tests/tests.py), the tests package would be shadowed by this file
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from src import indexed_join, create_enroll_cube, create_enroll_states_rollup_csv, tidy_data, \
+    create_enroll_districts_raw_csv, district_index, create_districts_all_csv, \
+    create_states_enriched_csv, create_naep_states_csv, create_finance_states_csv, create_enroll_districts_csv, \
+    polars_engine, data_service, output_manifest, fetch_sources, output_writer, checkpoint, output_schema, \
+    summary_views, watch, main as pipeline, parse_cache, vintages, create_finance_districts_csv, year_partitions, \
+    frame_handoff, data_sanity_check
+from tests import pipeline_fixture, equivalence
+from tests.pipeline_fixture import load, run_pipeline
+
 # Set shared input/output directories
 PARENT_DIR = os.path.dirname(os.path.realpath(__file__))
 PROJECT_DIR = os.path.join(PARENT_DIR, '..')
 
-INPUT_DIR = os.path.join(PROJECT_DIR, 'data/raw')
-OUTPUT_DIR = os.path.join(PROJECT_DIR, 'data/processed')
 SANITY_DIR = os.path.join(PROJECT_DIR, 'data/interim')
 
 
 class FinanceDistrictPipelineTests(unittest.TestCase):
     def test_csv_to_standard(self):
-        # Load in data
-        output_filename = 'finance_districts.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
         ## Uses a hardcoded value from the source spreadsheet for input
         input_val = 281989
 
-        output_row = output_data[output_data['YRDATA'] == 2016]
-        output_row = output_row[output_row['STATE'] == 'IDAHO']
-        output_row = output_row[output_row['NAME'] == 'MERIDIAN SCHOOL DISTRICT 2']
-        output_val = output_row['TOTALREV'].iloc[0]
+        output_val = load('finance_districts.csv').loc[(2016, 'IDAHO', 'MERIDIAN SCHOOL DISTRICT 2'), 'TOTALREV']
 
         assert (input_val == output_val)
 
 
 class FinanceStatePipelineTests(unittest.TestCase):
     def test_district_to_state(self):
-        # Load in data
-        input_filename = 'finance_districts.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'finance_states.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
-        input_row = input_data[input_data['YRDATA'] == 2016]
-        input_row = input_row[input_row['STATE'] == 'IDAHO']
-        input_val = input_row['TOTALREV'].sum()
-
-        output_row = output_data[output_data['PRIMARY_KEY'] == '2016_IDAHO']
-        output_val = output_row['TOTAL_REVENUE'].iloc[0]
+        input_val = load('finance_districts.csv').loc[(2016, 'IDAHO'), 'TOTALREV'].sum()
+        output_val = load('finance_states.csv').loc['2016_IDAHO', 'TOTAL_REVENUE']
 
         assert (input_val == output_val)
 
     def test_standard_to_all(self):
-        # Load in data
-        input_filename = 'finance_states.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'states_all.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
-        input_row = input_data[input_data['PRIMARY_KEY'] == '2016_IDAHO']
-        input_val = input_row['TOTAL_REVENUE'].iloc[0]
-
-        output_row = output_data[output_data['PRIMARY_KEY'] == '2016_IDAHO']
-        output_val = output_row['TOTAL_REVENUE'].iloc[0]
+        input_val = load('finance_states.csv').loc['2016_IDAHO', 'TOTAL_REVENUE']
+        output_val = load('states_all.csv').loc['2016_IDAHO', 'TOTAL_REVENUE']
 
         assert (input_val == output_val)
 
 
 class EnrollDistrictPipelineTests(unittest.TestCase):
     def test_csv_to_raw(self):
-        # Load in data
-        output_filename = 'enroll_districts_raw.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
         ## Uses a hardcoded value from the source spreadsheet for input
         input_val = 15585
 
-        output_row = output_data[output_data['State Name'] == 'IDAHO']
-        output_row = output_row[output_row['Agency Name'] == 'NAMPA SCHOOL DISTRICT']
-        output_val = output_row['2017_A_A_A'].iloc[0]
+        output_val = load('enroll_districts_raw.csv').loc[('IDAHO', 'NAMPA SCHOOL DISTRICT'), '2017_A_A_A']
 
         assert (input_val == output_val)
 
     def test_raw_to_standard(self):
-        # Load in data
-        input_filename = 'enroll_districts_raw.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'enroll_districts.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
-        input_row = input_data[input_data['State Name'] == 'IDAHO']
-        input_row = input_row[input_row['Agency Name'] == 'NAMPA SCHOOL DISTRICT']
-        input_val = input_row['2017_A_A_A'].iloc[0]
-
-        output_row = output_data[output_data['PRIMARY_KEY'] == '2017_NAMPA SCHOOL DISTRICT']
-        output_val = output_row['A_A_A'].iloc[0]
+        input_val = load('enroll_districts_raw.csv').loc[('IDAHO', 'NAMPA SCHOOL DISTRICT'), '2017_A_A_A']
+        district_id = load('districts.csv').reset_index().set_index(['STATE', 'AGENCY_NAME']).loc[
+            ('IDAHO', 'NAMPA SCHOOL DISTRICT'), 'DISTRICT_ID']
+        output_val = load('enroll_districts.csv').loc['2017_{0}'.format(district_id), 'A_A_A']
 
         assert (input_val == output_val)
 
+    def test_names_repeat_within_state(self):
+        # Two districts in one state share a name, but not an LEA ID
+        input_data = pd.DataFrame({'Agency Name': ['UNION SCHOOL DISTRICT', 'UNION SCHOOL DISTRICT'],
+                                   'State Name': ['OREGON', 'OREGON'],
+                                   'Agency ID': ['4112750', '4112760'],
+                                   '2016_G04_A_A': [100, 200], '2017_G04_A_A': [110, 210]})
+
+        output_data = create_enroll_districts_csv.restructure_enroll_data(input_data)
+        output_schema.validate(output_data, 'enroll_districts.csv')
+
+        assert (output_data['PRIMARY_KEY'].tolist() == ['2016_1', '2017_1', '2016_2', '2017_2'])
+        assert (output_data['G04_A_A'].tolist() == [100, 110, 200, 210])
+
 
 class EnrollStatePipelineTests(unittest.TestCase):
     def test_csv_to_raw(self):
-        # Load in data
-        output_filename = 'enroll_states_raw.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
         ## Uses a hardcoded value from the source spreadsheet for input
         input_val = 301186
 
-        output_row = output_data[output_data['State Name'] == 'IDAHO']
-        output_val = output_row['2017_A_A_A'].iloc[0]
+        output_val = load('enroll_states_raw.csv').loc['IDAHO', '2017_A_A_A']
 
         assert (input_val == output_val)
 
     def test_raw_to_standard(self):
-        # Load in data
-        input_filename = 'enroll_states_raw.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'enroll_states.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
-        input_row = input_data[input_data['State Name'] == 'IDAHO']
-        input_val = input_row['2017_A_A_A'].iloc[0]
-
-        output_row = output_data[output_data['PRIMARY_KEY'] == '2017_IDAHO']
-        output_val = output_row['A_A_A'].iloc[0]
+        input_val = load('enroll_states_raw.csv').loc['IDAHO', '2017_A_A_A']
+        output_val = load('enroll_states.csv').loc['2017_IDAHO', 'A_A_A']
 
         assert (input_val == output_val)
 
     def test_standard_to_summary(self):
-        # Load in data
-        input_filename = 'enroll_states.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'enroll_states_summary.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
-        input_row = input_data[input_data['PRIMARY_KEY'] == '2017_IDAHO']
-        input_val = input_row['A_A_A'].iloc[0]
-
-        output_row = output_data[output_data['PRIMARY_KEY'] == '2017_IDAHO']
-        output_val = output_row['GRADES_ALL_G'].iloc[0]
+        input_val = load('enroll_states.csv').loc['2017_IDAHO', 'A_A_A']
+        output_val = load('enroll_states_summary.csv').loc['2017_IDAHO', 'GRADES_ALL_G']
 
         assert (input_val == output_val)
 
     def test_standard_to_all(self):
-        # Load in data
-        input_filename = 'enroll_states.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'states_all.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test one entry to ensure that the transformed value matches
-        input_row = input_data[input_data['PRIMARY_KEY'] == '2017_IDAHO']
-        input_val = input_row['A_A_A'].iloc[0]
-
-        output_row = output_data[output_data['PRIMARY_KEY'] == '2017_IDAHO']
-        output_val = output_row['GRADES_ALL_G'].iloc[0]
+        input_val = load('enroll_states.csv').loc['2017_IDAHO', 'A_A_A']
+        output_val = load('states_all.csv').loc['2017_IDAHO', 'GRADES_ALL_G']
 
         assert (input_val == output_val)
 
 
 class AchievementStatePipelineTests(unittest.TestCase):
-    def test_csv_to_raw(self):
-        # Load in data
-        output_filename = 'naep_states_raw.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
+    # Years of the NAEP assessments
+    YEARS = ['2019', '2017', '2015', '2013', '2011', '2009', '2007', '2005', '2003', '2002', '2000', '1998', '1994',
+             '1992']
+
+    def assert_same(self, input_val, output_val, year):
+        if np.isnan(input_val):
+            assert np.isnan(output_val), year
+        else:
+            assert input_val == output_val, year
 
+    def test_csv_to_raw(self):
         # Test various entries to ensure that the transformed value matches
         ## Uses hardcoded values from the source spreadsheet for input
         input_vals_hardcoded = {'2019': 223,
@@ -198,103 +166,1000 @@ class AchievementStatePipelineTests(unittest.TestCase):
                      '1992': 219
                      }
 
+        output_data = load('naep_states_raw.csv')
         for year, input_val in input_vals_hardcoded.items():
-            try:
-                output_row = output_data[output_data['YEAR'] == int(year)]
-                output_row = output_row[output_row['STATE'] == 'IDAHO']
-                output_row = output_row[output_row['DEMO'] == 'G04_A_A']
-                output_row = output_row[output_row['TEST_SUBJECT'] == 'Reading']
-                output_val = output_row['AVG_SCORE'].iloc[0]
-                if np.isnan(input_val):
-                    assert (np.isnan(output_val))
-                else:
-                    assert (input_val == output_val)
-            except:
-                print(f'{year}:{input_val}')
-                raise Exception
+            output_val = output_data.loc[(int(year), 'IDAHO', 'G04_A_A', 'Reading'), 'AVG_SCORE']
+            self.assert_same(input_val, output_val, year)
 
     def test_raw_to_standard(self):
-        # Load in data
-        input_filename = 'naep_states_raw.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'naep_states.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test various entries to ensure that the transformed value matches
-        input_val_years = ['2019', '2017', '2015', '2013', '2011', '2009', '2007',
-                           '2005', '2003', '2002', '2000', '1998', '1994', '1992']
-        for year in input_val_years:
-            try:
-                input_row = input_data[input_data['YEAR'] == int(year)]
-                input_row = input_row[input_row['STATE'] == 'IDAHO']
-                input_row = input_row[input_row['DEMO'] == 'G04_A_A']
-                input_row = input_row[input_row['TEST_SUBJECT'] == 'Reading']
-                input_val = input_row['AVG_SCORE'].iloc[0]
-
-                output_row = output_data[output_data['PRIMARY_KEY'] == '2019_IDAHO']
-                output_val = output_row['G04_A_A_READING'].iloc[0]
-
-                if np.isnan(input_val):
-                    assert (np.isnan(output_val))
-                else:
-                    assert (input_val == output_val)
-            except:
-                print(f'{year}')
-                raise Exception
+        input_data = load('naep_states_raw.csv')
+        output_data = load('naep_states.csv')
+        for year in self.YEARS:
+            input_val = input_data.loc[(int(year), 'IDAHO', 'G04_A_A', 'Reading'), 'AVG_SCORE']
+            output_val = output_data.loc[f'{year}_IDAHO', 'G04_A_A_READING']
+            self.assert_same(input_val, output_val, year)
 
     def test_standard_to_summary(self):
-        # Load in data
-        input_filename = 'naep_states.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'naep_states_summary.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test various entries to ensure that the transformed value matches
-        input_val_years = ['2019', '2017', '2015', '2013', '2011', '2009', '2007',
-                           '2005', '2003', '2002', '2000', '1998', '1994', '1992']
-        for year in input_val_years:
-            try:
-                input_row = input_data[input_data['PRIMARY_KEY'] == f'{year}_IDAHO']
-                input_val = input_row['G04_A_A_READING'].iloc[0]
-
-                output_row = output_data[output_data['PRIMARY_KEY'] == f'{year}_IDAHO']
-                output_val = output_row['AVG_READING_4_SCORE'].iloc[0]
-
-                if np.isnan(input_val):
-                    assert (np.isnan(output_val))
-                else:
-                    assert (input_val == output_val)
-
-            except:
-                print(f'{year}')
-                raise Exception
+        input_data = load('naep_states.csv')
+        output_data = load('naep_states_summary.csv')
+        for year in self.YEARS:
+            input_val = input_data.loc[f'{year}_IDAHO', 'G04_A_A_READING']
+            output_val = output_data.loc[f'{year}_IDAHO', 'AVG_READING_4_SCORE']
+            self.assert_same(input_val, output_val, year)
 
     def test_standard_to_all(self):
-        # Load in data
-        input_filename = 'naep_states.csv'
-        input_data = pd.read_csv(os.path.join(OUTPUT_DIR, input_filename))
-        output_filename = 'states_all_extended.csv'
-        output_data = pd.read_csv(os.path.join(OUTPUT_DIR, output_filename))
-
         # Test various entries to ensure that the transformed value matches
-        input_val_years = ['2019', '2017', '2015', '2013', '2011', '2009', '2007',
-                           '2005', '2003', '2002', '2000', '1998', '1994', '1992']
-        for year in input_val_years:
+        input_data = load('naep_states.csv')
+        output_data = load('states_all_extended.csv')
+        for year in self.YEARS:
+            input_val = input_data.loc[f'{year}_IDAHO', 'G04_A_A_READING']
+            output_val = output_data.loc[f'{year}_IDAHO', 'G04_A_A_READING']
+            self.assert_same(input_val, output_val, year)
+
+
+class GoldenOutputTests(unittest.TestCase):
+    def test_outputs_match_golden(self):
+        # Every output of the fixture run, compared column by column;
+        # regenerate with `python -m tests.pipeline_fixture` after an intended change
+        differences = pipeline_fixture.compare_digests(pipeline_fixture.read_golden(),
+                                                       pipeline_fixture.output_digests(run_pipeline()))
+        assert not differences, '\n'.join(differences)
+
+
+class OutputSchemaTests(unittest.TestCase):
+    def test_outputs_match_schemas(self):
+        output_dir = run_pipeline()
+        for filename, schema in output_schema.SCHEMAS.items():
+            if os.path.exists(output_writer.find_csv(output_dir, filename)):
+                with self.subTest(filename=filename):
+                    self.assertEqual(output_schema.check(output_writer.read_csv(output_dir, filename), schema), [])
+
+    def test_violations(self):
+        input_data = pd.DataFrame({'PRIMARY_KEY': ['2017_IDAHO', '2017_IDAHO', '2017_OHIO'],
+                                   'STATE': ['IDAHO', 'IDAHO', 'ATLANTIS'],
+                                   'YEAR': ['2017', '2017', '2017.5'],
+                                   'AVG_MATH_4_SCORE': [240.0, 650.0, np.nan],
+                                   'AVG_READING_4_SCORE': [220.0, '\u2020', 221.0],
+                                   'NOTES': ['', '', '']})
+
+        with self.assertRaises(output_schema.SchemaError) as context:
+            output_schema.validate(input_data, 'naep_states_summary.csv')
+        problems = str(context.exception).split('\n')[1:]
+        self.assertEqual([x.strip() for x in problems],
+                         ["STATE: 1 unexpected values ('ATLANTIS')",
+                          "YEAR: 1 values are not whole numbers (2017.5)",
+                          "AVG_MATH_4_SCORE: 1 values above 500 (650.0)",
+                          "AVG_READING_4_SCORE: 1 values are not numbers ('\u2020')",
+                          "Unexpected columns: 'NOTES'",
+                          "PRIMARY_KEY: 2 rows share a key ('2017_IDAHO')"])
+
+    def test_stage_fails_before_writing(self):
+        input_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, input_dir)
+        input_data = load('finance_districts.csv').reset_index()
+        input_data.loc[0, 'ENROLL'] = -10 ** 9
+        input_data.to_csv(os.path.join(input_dir, 'finance_districts.csv'), index=False)
+
+        with self.assertRaises(output_schema.SchemaError):
+            create_finance_states_csv.main(logging.getLogger(__name__), input_dir, input_dir, input_dir)
+        self.assertEqual(os.listdir(input_dir), ['finance_districts.csv'])
+
+    def test_partition_fails_before_writing(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        parse = create_finance_districts_csv.elsect_spreadsheet_to_dataframe
+
+        def parse_bad_year(filename, logger=None):
+            df = parse(filename, logger)
+            df['ENROLL'] = '-1'
+            return df
+
+        # A bad year isn't stored, so the next run parses it again
+        cwd = os.getcwd()
+        os.chdir(output_dir)
+        try:
+            with unittest.mock.patch.object(create_finance_districts_csv, 'elsect_spreadsheet_to_dataframe',
+                                            parse_bad_year):
+                with self.assertRaises(output_schema.SchemaError):
+                    create_finance_districts_csv.main(logging.getLogger(__name__), pipeline_fixture.FIXTURE_RAW_DIR,
+                                                      output_dir, output_dir, partitioned=True)
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(year_partitions.partition_years(output_dir, create_finance_districts_csv.DATASET_NAME), [])
+
+
+class SummaryViewTests(unittest.TestCase):
+    def test_not_written_by_default(self):
+        for filename in summary_views.VIEWS:
+            self.assertFalse(os.path.exists(os.path.join(run_pipeline(), filename)))
+
+    def test_states_all_uses_views(self):
+        states_all = load('states_all.csv')
+        for filename in summary_views.VIEWS:
+            summary = load(filename)
+            pd.testing.assert_frame_equal(states_all.loc[summary.index, summary.columns], summary,
+                                          check_names=False, check_dtype=False)
+
+    def test_written_on_request(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        logger = logging.getLogger(__name__)
+
+        summary_views.main(logger, run_pipeline(), output_dir, output_dir, write=True)
+        output_data = pd.read_csv(os.path.join(output_dir, 'enroll_states_summary.csv'))
+        self.assertEqual(output_data.set_index('PRIMARY_KEY').loc['2017_IDAHO', 'GRADES_ALL_G'],
+                         load('enroll_states.csv').loc['2017_IDAHO', 'A_A_A'])
+
+        # Copies from a run that requested them are removed by one that doesn't
+        summary_views.main(logger, run_pipeline(), output_dir, output_dir, write=False)
+        self.assertFalse(any(filename in summary_views.VIEWS for filename in os.listdir(output_dir)))
+
+
+class EnrollCubeTests(unittest.TestCase):
+    def test_slice_and_rollup(self):
+        # Two states, one year, grade 4 broken down by race and gender
+        input_data = pd.DataFrame({'State Name': ['IDAHO', 'NEW YORK'],
+                                   '2015_G04_A_A': [100, 200],
+                                   '2015_G04_AS_F': [10, 20],
+                                   '2015_G04_WH_F': [30, '†'],
+                                   '2015_G04_WH_M': [40, 50]})
+        cube_path = os.path.join(SANITY_DIR, 'test_enroll_cube.npy')
+        create_enroll_cube.build_cube(input_data, cube_path)
+        try:
+            cube = np.load(cube_path, mmap_mode='r')
+            axes = create_enroll_cube.build_axes(input_data.columns[1:], 'STATE', ['IDAHO', 'NEW_YORK'])
+
+            output_data, output_axes = create_enroll_cube.cube_slice(cube, axes, YEAR=2015, STATE='NEW_YORK')
+            assert (list(output_axes.keys()) == ['GRADE', 'RACE', 'GENDER'])
+            assert (output_data[0, output_axes['RACE']['A'], output_axes['GENDER']['A']] == 200)
+
+            output_data, output_axes = create_enroll_cube.cube_rollup(cube, axes, 'RACE')
+            assert (output_data[0, 0, 0, output_axes['GENDER']['F']] == 40)
+            assert (output_data[0, 1, 0, output_axes['GENDER']['F']] == 20)
+            assert (np.isnan(output_data[0, 0, 0, output_axes['GENDER']['A']]))
+        finally:
+            os.remove(cube_path)
+
+    def test_grade_rollup_skips_bands(self):
+        # NCES provides bands of grades alongside the grades themselves
+        input_data = pd.DataFrame({'State Name': ['IDAHO'],
+                                   '2015_A_A_A': [60],
+                                   '2015_G01-G08_A_A': [30],
+                                   '2015_G09-G12_A_A': [30],
+                                   '2015_G01_A_A': [10],
+                                   '2015_G02_A_A': [20],
+                                   '2015_G09_A_A': [30]})
+        cube_path = os.path.join(SANITY_DIR, 'test_enroll_cube.npy')
+        create_enroll_cube.build_cube(input_data, cube_path)
+        try:
+            cube = np.load(cube_path, mmap_mode='r')
+            axes = create_enroll_cube.build_axes(input_data.columns[1:], 'STATE', ['IDAHO'])
+
+            # Rolling up the only remaining axis leaves a single value
+            grades, grade_axes = create_enroll_cube.cube_slice(cube, axes, YEAR=2015, STATE='IDAHO', RACE='A',
+                                                               GENDER='A')
+            output_data, output_axes = create_enroll_cube.cube_rollup(grades, grade_axes, 'GRADE')
+            assert (output_axes == {})
+            assert (output_data == grades[grade_axes['GRADE']['A']])
+        finally:
+            os.remove(cube_path)
+
+    def test_rollup_reconciliation(self):
+        # NCES reports 100 students in grade 4, but the breakdown only adds up to 90
+        input_data = pd.DataFrame({'State Name': ['IDAHO'],
+                                   '2015_G04_A_A': [100],
+                                   '2015_G04_AS_F': [10],
+                                   '2015_G04_WH_F': [30],
+                                   '2015_G04_WH_M': [50]})
+        cube_path = os.path.join(SANITY_DIR, 'test_enroll_cube.npy')
+        axes = create_enroll_cube.build_cube(input_data, cube_path)
+        try:
+            output_data = create_enroll_states_rollup_csv.rollup_enroll_data(np.load(cube_path), axes)
+            output_data = output_data.set_index(['GRADE', 'RACE', 'GENDER'])
+
+            assert (output_data.loc[('G04', 'A', 'F'), 'VALUE'] == 40)
+            assert (output_data.loc[('G04', 'A', 'A'), 'VALUE'] == 90)
+            assert (output_data.loc[('G04', 'A', 'A'), 'NCES_VALUE'] == 100)
+            assert (output_data.loc[('G04', 'A', 'A'), 'MISMATCH'])
+            assert (not output_data.loc[('G04', 'WH', 'M'), 'MISMATCH'])
+        finally:
+            os.remove(cube_path)
+
+    def test_district_cube(self):
+        # District names repeat across states
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        input_data = pd.DataFrame({'Agency Name': ['LINCOLN CO', 'LINCOLN CO', 'ADA'],
+                                   'State Name': ['OREGON', 'WYOMING', 'IDAHO'],
+                                   '2015_G04_A_A': [100, 200, 300]})
+        input_data.to_csv(os.path.join(output_dir, 'enroll_districts_raw.csv'), index=False)
+
+        logger = logging.getLogger(__name__)
+        district_index.main(logger, output_dir, output_dir, output_dir)
+        create_enroll_cube.main(logger, output_dir, output_dir, output_dir, 'enroll_districts_raw.csv')
+
+        cube, axes = create_enroll_cube.load_cube(output_dir, 'enroll_districts_cube')
+        dimension = district_index.load_dimension(output_dir).set_index(['STATE', 'AGENCY_NAME'])
+        for state, value in [('OREGON', 100), ('WYOMING', 200)]:
+            district_id = dimension.loc[(state, 'LINCOLN CO'), 'DISTRICT_ID']
+            output_data, output_axes = create_enroll_cube.cube_slice(cube, axes, YEAR=2015, DISTRICT=district_id)
+            assert (output_data[output_axes['GRADE']['G04'], 0, 0] == value)
+
+
+class TidyDataTests(unittest.TestCase):
+    def test_wide_to_tidy(self):
+        input_data = pd.DataFrame({'PRIMARY_KEY': ['2019_IDAHO'], 'STATE': ['IDAHO'], 'YEAR': [2019],
+                                   'G04_A_A_READING': [223.0], 'G04_AS_F_READING': [np.nan]})
+
+        output_data = tidy_data.to_tidy(input_data, ['PRIMARY_KEY', 'STATE', 'YEAR'], tidy_data.NAEP_DIMENSIONS)
+
+        # The null value is dropped
+        assert (len(output_data) == 1)
+        assert (output_data['SUBJECT'].iloc[0] == 'READING')
+        assert (output_data['VALUE'].iloc[0] == 223)
+        assert (output_data['GRADE'].dtype.name == 'category')
+
+
+class EnrollExportMergeTests(unittest.TestCase):
+    def test_exports_merge_by_key(self):
+        # The second export lists districts in a different order and is missing one
+        exports = {'NCES_G_1_4.csv': pd.DataFrame({'Agency Name': ['NAMPA SCHOOL DISTRICT', 'BOISE ', 'BOISE'],
+                                                   'State Name': ['IDAHO', 'IDAHO', 'OREGON'],
+                                                   '2017_G01_A_A': [1, 2, 3]}),
+                   'NCES_G_5_8.csv': pd.DataFrame({'Agency Name': ['BOISE', 'NAMPA SCHOOL DISTRICT'],
+                                                   'State Name': ['IDAHO', 'IDAHO'],
+                                                   '2017_G01_A_A': [9, 9],
+                                                   '2017_G05_A_A': [20, 10]})}
+
+        output_data = create_enroll_districts_raw_csv.merge_exports(exports, ['Agency Name', 'State Name'],
+                                                                    logging.getLogger(__name__))
+        output_data = output_data.set_index(['Agency Name', 'State Name'])
+
+        assert (output_data.loc[('NAMPA SCHOOL DISTRICT', 'IDAHO'), '2017_G05_A_A'] == 10)
+        assert (output_data.loc[('BOISE', 'IDAHO'), '2017_G05_A_A'] == 20)
+        # Duplicate columns keep the first export's values
+        assert (output_data.loc[('BOISE', 'IDAHO'), '2017_G01_A_A'] == 2)
+        assert (np.isnan(output_data.loc[('BOISE', 'OREGON'), '2017_G05_A_A']))
+
+    def test_later_export_adds_district(self):
+        # Joined on the LEA ID, the second export lists a district the first doesn't
+        exports = {'NCES_G_1_4.csv': pd.DataFrame({'Agency Name': ['NAMPA SCHOOL DISTRICT'],
+                                                   'State Name': ['IDAHO'],
+                                                   'Agency ID': ['1602280'],
+                                                   '2017_G01_A_A': [1]}),
+                   'NCES_G_5_8.csv': pd.DataFrame({'Agency Name': ['BOISE', 'NAMPA SCHOOL DISTRICT'],
+                                                   'State Name': ['IDAHO', 'IDAHO'],
+                                                   'Agency ID': ['1600270', '1602280'],
+                                                   '2017_G05_A_A': [20, 10]})}
+
+        output_data = create_enroll_districts_raw_csv.merge_exports(exports, ['Agency ID'],
+                                                                    logging.getLogger(__name__))
+        output_data = output_data.set_index('Agency ID')
+
+        assert (output_data.loc['1600270', 'Agency Name'] == 'BOISE')
+        assert (output_data.loc['1600270', 'State Name'] == 'IDAHO')
+        assert (output_data.loc['1600270', '2017_G05_A_A'] == 20)
+        assert (np.isnan(output_data.loc['1600270', '2017_G01_A_A']))
+        assert (output_data.loc['1602280', 'Agency Name'] == 'NAMPA SCHOOL DISTRICT')
+
+
+class DistrictIndexTests(unittest.TestCase):
+    def test_stable_ids_and_name_lookup(self):
+        # Two districts share a name in different states
+        raw_data = pd.DataFrame({'Agency Name': ['UNION SCHOOL DISTRICT', 'UNION SCHOOL DISTRICT'],
+                                 'State Name': ['OREGON', 'NEW JERSEY'],
+                                 'Agency ID': ['4112750', '3416200']})
+        dimension = district_index.update_dimension(district_index.raw_districts(raw_data))
+        assert (len(dimension) == 2)
+
+        # A later run adds a district without renumbering the others
+        raw_data.loc[2] = ['NAMPA SCHOOL DISTRICT', 'IDAHO', '1602280']
+        output_data = district_index.update_dimension(district_index.raw_districts(raw_data), dimension)
+        assert (output_data['DISTRICT_ID'].iloc[:2].tolist() == dimension['DISTRICT_ID'].tolist())
+        assert (output_data['DISTRICT_ID'].iloc[2] == 3)
+
+        index = district_index.name_index(output_data)
+        output_ids = district_index.lookup_by_name(index, pd.Series(['New Jersey']),
+                                                   pd.Series(['Union  School District ']))
+        assert (output_ids.iloc[0] == dimension['DISTRICT_ID'].iloc[0])
+
+    def test_ids_kept_when_lea_ids_appear(self):
+        # A table built from data without LEA IDs...
+        raw_data = pd.DataFrame({'Agency Name': ['A', 'B'], 'State Name': ['IDAHO', 'OHIO']})
+        dimension = district_index.update_dimension(district_index.raw_districts(raw_data))
+
+        # ...keeps the same IDs once the data carries them
+        raw_data['Agency ID'] = ['1600001', '3900002']
+        raw_data.loc[2] = ['C', 'OHIO', '3900003']
+        districts = district_index.raw_districts(raw_data)
+        output_data = district_index.update_dimension(districts, dimension)
+        assert (output_data['DISTRICT_ID'].tolist() == [1, 2, 3])
+        assert (output_data['LEA_ID'].tolist() == ['1600001', '3900002', '3900003'])
+        assert (district_index.assign_district_ids(districts, output_data).tolist() == [1, 2, 3])
+
+
+class DistrictMatchTests(unittest.TestCase):
+    def test_fuzzy_match_within_state(self):
+        # Census and NCES spell the same districts differently
+        dimension = pd.DataFrame({'DISTRICT_ID': [1, 2, 3],
+                                  'AGENCY_NAME': ['AUTAUGA COUNTY SCHOOL DISTRICT', 'AUTAUGA CITY SCHOOL DISTRICT',
+                                                  'MERIDIAN JOINT DISTRICT'],
+                                  'STATE': ['ALABAMA', 'ALABAMA', 'IDAHO']})
+        finance = pd.DataFrame({'STATE': ['ALABAMA', 'ALABAMA', 'IDAHO', 'IDAHO'],
+                                'NAME': ['AUTAUGA CO SCH DIST', 'AUTAUGA CITY SCH DIST', 'MERIDIAN JT SCH DIST 2',
+                                         'AUTAUGA CO SCH DIST']})
+
+        matches, unmatched = create_districts_all_csv.match_districts(finance, dimension)
+        assert (matches['DISTRICT_ID'].tolist() == [1, 2, 3])
+        assert (unmatched[['STATE', 'NAME']].values.tolist() == [['IDAHO', 'AUTAUGA CO SCH DIST']])
+
+        # Cached matches aren't matched again
+        cached = matches.assign(DISTRICT_ID=[2, 1, 3])
+        output_data, _ = create_districts_all_csv.match_districts(finance, dimension, cached)
+        assert (output_data['DISTRICT_ID'].tolist() == [2, 1, 3])
+
+    def test_partial_name_does_not_match(self):
+        # Every n-gram of 'ADA' is in 'ADAMS 14', but not the other way around
+        dimension = pd.DataFrame({'DISTRICT_ID': [1], 'AGENCY_NAME': ['ADA SCHOOL DISTRICT'], 'STATE': ['COLORADO']})
+        finance = pd.DataFrame({'STATE': ['COLORADO'], 'NAME': ['ADAMS 14 SCH DIST']})
+
+        matches, unmatched = create_districts_all_csv.match_districts(finance, dimension)
+        assert (matches.empty)
+        assert (unmatched['SCORE'].iloc[0] < create_districts_all_csv.MATCH_THRESHOLD)
+
+    def test_closest_match_kept(self):
+        # Two finance records match the same district; the closer one is kept whatever the row order
+        dimension = pd.DataFrame({'DISTRICT_ID': [1], 'AGENCY_NAME': ['BOISE'], 'STATE': ['IDAHO']})
+        matches = pd.DataFrame({'STATE': ['IDAHO', 'IDAHO'], 'NAME': ['BOISE INDEP', 'BOISE'],
+                                'DISTRICT_ID': [1, 1], 'SCORE': [0.8, 1.0]})
+        enroll = pd.DataFrame({'PRIMARY_KEY': ['2016_1'], 'DISTRICT': ['BOISE'], 'DISTRICT_ID': [1], 'YEAR': [2016]})
+        for grade in ['A', 'PK', 'KG', 'G04', 'G08', 'G12', 'G01-G08', 'G09-G12']:
+            enroll[grade + '_A_A'] = [100]
+        finance = pd.DataFrame({'STATE': ['IDAHO', 'IDAHO'], 'NAME': ['BOISE INDEP', 'BOISE'], 'YRDATA': [2016, 2016]})
+        for col in create_districts_all_csv.FINANCE_COLUMNS:
+            finance[col] = [1, 2]
+
+        for order in [[0, 1], [1, 0]]:
+            output_data = create_districts_all_csv.join_district_data(finance.iloc[order], enroll, matches, dimension,
+                                                                      logging.getLogger(__name__))
+            assert (output_data['TOTAL_REVENUE'].tolist() == [2])
+
+
+class EnrichmentTests(unittest.TestCase):
+    def test_real_dollars_and_per_pupil(self):
+        cpi_table = create_states_enriched_csv.load_lookup(create_states_enriched_csv.LOOKUP_DIR,
+                                                           create_states_enriched_csv.CPI_FILENAME)
+        regions_table = create_states_enriched_csv.load_lookup(create_states_enriched_csv.LOOKUP_DIR,
+                                                               create_states_enriched_csv.REGIONS_FILENAME)
+        assert (len(regions_table) == 51)
+
+        input_data = pd.DataFrame({'PRIMARY_KEY': ['2019_IDAHO', '1992_OHIO'], 'STATE': ['IDAHO', 'OHIO'],
+                                   'YEAR': [2019, 1992], 'ENROLL': [100, 0]})
+        for col in create_states_enriched_csv.DOLLAR_COLUMNS:
+            input_data[col] = [1000.0, 1403.0]
+
+        output_data = create_states_enriched_csv.enrich_state_data(input_data, cpi_table, regions_table)
+        assert (output_data['REGION'].tolist() == ['WEST', 'MIDWEST'])
+        assert (output_data['TOTAL_REVENUE_REAL'].iloc[0] == 1000)
+        assert (round(output_data['TOTAL_REVENUE_REAL'].iloc[1]) == 2557)
+        assert (output_data['TOTAL_REVENUE_PER_PUPIL'].iloc[0] == 10)
+        assert (np.isnan(output_data['TOTAL_REVENUE_PER_PUPIL'].iloc[1]))
+
+    def test_lookup_cached_between_runs(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        expected = create_states_enriched_csv.load_lookup(create_states_enriched_csv.LOOKUP_DIR,
+                                                          create_states_enriched_csv.CPI_FILENAME, cache_dir)
+
+        # A later run (with an empty in-memory cache) loads the parsed table instead of the CSV
+        create_states_enriched_csv._read_lookup.cache_clear()
+        with unittest.mock.patch.object(pd, 'read_csv', side_effect=AssertionError('parsed again')):
+            output_data = create_states_enriched_csv.load_lookup(create_states_enriched_csv.LOOKUP_DIR,
+                                                                 create_states_enriched_csv.CPI_FILENAME, cache_dir)
+        pd.testing.assert_frame_equal(output_data, expected)
+
+
+try:
+    import polars
+except ImportError:
+    polars = None
+
+
+@unittest.skipIf(polars is None, 'Polars is not installed')
+class PolarsEngineTests(unittest.TestCase):
+    def test_naep_aggregate_matches_pandas(self):
+        input_data = pd.DataFrame({'YEAR': [2019, 2019, 2019, 2017],
+                                   'STATE': ['IDAHO', 'IDAHO', 'OHIO', 'IDAHO'],
+                                   'DEMO': ['G04_A_A', 'G04_A_F', 'G04_A_A', 'G04_A_A'],
+                                   'AVG_SCORE': [220.0, 223.0, np.nan, 0.0],
+                                   'TEST_SUBJECT': ['Reading', 'Reading', 'Mathematics', 'Reading']})
+
+        expected = create_naep_states_csv.naep_aggregate(input_data.copy())
+        output_data = create_naep_states_csv.naep_aggregate(input_data.copy(), engine='polars')
+        pd.testing.assert_frame_equal(output_data, expected)
+
+    def test_aggregate_districts_matches_pandas(self):
+        input_data = pd.DataFrame({'STATE': ['IDAHO', 'IDAHO', 'OHIO'], 'NAME': ['A', 'B', 'C'],
+                                   'YRDATA': [2016, 2016, 2015]})
+        for col in create_finance_states_csv.SUMS.values():
+            input_data[col] = [1.0, 2.5, np.nan]
+
+        expected = create_finance_states_csv.aggregate_districts(input_data)
+        output_data = create_finance_states_csv.aggregate_districts(input_data, engine='polars')
+        pd.testing.assert_frame_equal(output_data, expected)
+
+    def test_indexed_join_matches_pandas(self):
+        finance = pd.DataFrame({'YEAR': [2017, 2016], 'STATE': ['IDAHO', 'IDAHO'], 'ENROLL': [2, 1]})
+        achieve = pd.DataFrame({'YEAR': [2017, 2019], 'STATE': ['IDAHO', 'IDAHO'], 'SCORE': [220.0, 223.0]})
+        sources = {'finance': finance, 'achieve': achieve}
+
+        expected, expected_coverage = indexed_join.indexed_join(sources, ['YEAR', 'STATE'])
+        output_data, coverage = indexed_join.indexed_join(sources, ['YEAR', 'STATE'], engine='polars')
+        pd.testing.assert_frame_equal(output_data, expected)
+        pd.testing.assert_frame_equal(coverage, expected_coverage)
+
+    def test_convert_columns_matches_pandas(self):
+        input_data = pd.DataFrame({'2017_A_A_A': ['12', ' 7 ', '\u2013', None], '2018_A_A_A': [1, 2, 3, 4]})
+
+        expected = create_enroll_districts_csv.convert_column_group(input_data)
+        output_data = polars_engine.convert_columns(input_data)
+        np.testing.assert_array_equal(output_data, expected)
+
+
+class EquivalenceTests(unittest.TestCase):
+    def test_compare_frames_reports_differences(self):
+        reference = pd.DataFrame({'PRIMARY_KEY': ['2016_IDAHO', '2017_IDAHO', '2017_OHIO'],
+                                  'ENROLL': [10, 20, 30], 'SCORE': [220.0, np.nan, 230.0]})
+        candidate = pd.DataFrame({'PRIMARY_KEY': ['2017_IDAHO', '2016_IDAHO', '2019_OHIO'],
+                                  'ENROLL': [20.0, 10.0, 30.0], 'SCORE': [0.0, 220.0 + 1e-12, 230.0]})
+
+        report = equivalence.compare_frames(reference, candidate, ['PRIMARY_KEY'])
+        self.assertFalse(report.equivalent)
+        self.assertEqual(report.issues, ['ENROLL is float64, expected int64', '1 rows missing: 2017_OHIO',
+                                         '1 extra rows: 2019_OHIO', 'Rows are in a different order'])
+
+        # Only the NaN that became 0 differs; the rest are within tolerance
+        expected = pd.DataFrame({'PRIMARY_KEY': ['2017_IDAHO'], 'COLUMN': ['SCORE'],
+                                 'REFERENCE': [np.nan], 'CANDIDATE': [0.0]}, dtype=object)
+        pd.testing.assert_frame_equal(report.cells, expected)
+
+        report = equivalence.compare_frames(reference, reference.iloc[::-1], ['PRIMARY_KEY'], check_order=False)
+        self.assertTrue(report.equivalent)
+
+    @unittest.skipIf(polars is None, 'Polars is not installed')
+    def test_engines_equivalent_on_random_inputs(self):
+        for name, (reference, candidate, make_inputs, keys) in equivalence.TRANSFORMS.items():
+            reports = equivalence.check_equivalence(reference, candidate, make_inputs, keys, seeds=range(3))
+            for seed, report in reports.items():
+                with self.subTest(transform=name, seed=seed):
+                    self.assertTrue(report.equivalent, report.summary())
+
+
+class DataServiceTests(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.write_states_all([100, 200, 300])
+        self.server = data_service.create_server(self.output_dir, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://{0}:{1}/'.format(*self.server.server_address)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output_dir)
+
+    def write_states_all(self, revenue):
+        pd.DataFrame({'PRIMARY_KEY': ['2015_IDAHO', '2016_IDAHO', '2016_OHIO'], 'STATE': ['IDAHO', 'IDAHO', 'OHIO'],
+                      'YEAR': [2015, 2016, 2016], 'TOTAL_REVENUE': revenue, 'ENROLL': [1, 2, 3]}).to_csv(
+            os.path.join(self.output_dir, 'states_all.csv'), index=False)
+        output_manifest.write_manifest(self.output_dir)
+
+    def test_filter_etag_and_reload(self):
+        request = urllib.request.urlopen(self.url + 'states_all?state=idaho&year=2016-2017&columns=TOTAL_REVENUE')
+        etag = request.headers['ETag']
+        assert (json.loads(request.read()) == [{'PRIMARY_KEY': '2016_IDAHO', 'STATE': 'IDAHO', 'YEAR': 2016,
+                                                'TOTAL_REVENUE': 200}])
+
+        # An unchanged table isn't sent again, however the same query is spelled
+        request = urllib.request.Request(self.url + 'states_all?year=2016,2017&state=IDAHO&columns=TOTAL_REVENUE',
+                                         headers={'If-None-Match': etag})
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(request)
+        assert (context.exception.code == 304)
+
+        # A new manifest reloads the table
+        self.write_states_all([100, 250, 300])
+        manifest_path = os.path.join(self.output_dir, output_manifest.MANIFEST_FILENAME)
+        os.utime(manifest_path, (time.time() + 1, time.time() + 1))
+        request = urllib.request.urlopen(self.url + 'states_all?state=IDAHO&year=2016&format=csv')
+        assert (request.headers['ETag'] != etag)
+        assert (pd.read_csv(request)['TOTAL_REVENUE'].tolist() == [250])
+
+    def test_summary_view(self):
+        enroll_states = pd.DataFrame({'PRIMARY_KEY': ['2016_IDAHO', '2016_OHIO'], 'STATE': ['IDAHO', 'OHIO'],
+                                      'YEAR': [2016, 2016]})
+        for col in summary_views.ENROLL_SUMMARY.columns:
+            enroll_states[col] = [10.0, 20.0]
+        enroll_states.to_csv(os.path.join(self.output_dir, 'enroll_states.csv'), index=False)
+        output_manifest.write_manifest(self.output_dir)
+        manifest_path = os.path.join(self.output_dir, output_manifest.MANIFEST_FILENAME)
+        os.utime(manifest_path, (time.time() + 1, time.time() + 1))
+
+        request = urllib.request.urlopen(self.url + 'enroll_states_summary?state=OHIO&columns=GRADES_ALL_G')
+        assert (json.loads(request.read()) == [{'PRIMARY_KEY': '2016_OHIO', 'STATE': 'OHIO', 'YEAR': 2016,
+                                                'GRADES_ALL_G': 20.0}])
+
+
+class SourceRequestHandler(BaseHTTPRequestHandler):
+    # A stand-in for a source website, supporting ETags and ranges
+    files = {}
+    requests = []
+    truncate = set()
+
+    def do_GET(self):
+        body = self.files[self.path]
+        etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        self.requests.append((self.path, self.headers.get('Range'), self.headers.get('If-None-Match')))
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        # Drop the connection halfway through, once
+        if self.path in self.truncate:
+            self.truncate.discard(self.path)
+            self.wfile.write(body[start:start + len(body) // 2])
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FetchSourcesTests(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        SourceRequestHandler.files = {'/a.csv': b'a' * 100000, '/b.csv': b'b' * 1000}
+        SourceRequestHandler.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SourceRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        url = 'http://{0}:{1}'.format(*self.server.server_address)
+        self.sources = {'NCES_ENROLL_STATES.zip': {'a.csv': url + '/a.csv', 'b.csv': url + '/b.csv'}}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_dir)
+
+    def test_resume_and_conditional_refresh(self):
+        # The first download of a.csv is cut off and resumed
+        SourceRequestHandler.truncate = {'/a.csv'}
+        rebuilt = fetch_sources.refresh_archives(self.sources, self.data_dir, self.data_dir, concurrency=2)
+        assert (rebuilt == ['NCES_ENROLL_STATES.zip'])
+        assert (('/a.csv', 'bytes=50000-', None) in SourceRequestHandler.requests)
+
+        with zipfile.ZipFile(os.path.join(self.data_dir, 'NCES_ENROLL_STATES.zip')) as archive:
+            assert (archive.namelist() == ['NCES_ENROLL_STATES/', 'NCES_ENROLL_STATES/a.csv',
+                                           'NCES_ENROLL_STATES/b.csv'])
+            assert (archive.read('NCES_ENROLL_STATES/a.csv') == SourceRequestHandler.files['/a.csv'])
+
+        # Nothing changed, so nothing is downloaded or rebuilt
+        SourceRequestHandler.requests = []
+        assert (fetch_sources.refresh_archives(self.sources, self.data_dir, self.data_dir) == [])
+        assert (all(request[2] is not None for request in SourceRequestHandler.requests))
+
+        SourceRequestHandler.files['/b.csv'] = b'c' * 1000
+        assert (fetch_sources.refresh_archives(self.sources, self.data_dir, self.data_dir) ==
+                ['NCES_ENROLL_STATES.zip'])
+
+
+class FrameHandoffTests(unittest.TestCase):
+    def setUp(self):
+        self.interim_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.interim_dir)
+
+    def test_publish_and_open(self):
+        input_data = pd.DataFrame({'A': [1.0, np.nan], 'B': ['x', 'y'], 'C': [3, 4]})
+        path = frame_handoff.publish_frame(input_data, 'test', self.interim_dir)
+        assert (path.endswith('.arrow'))
+        pd.testing.assert_frame_equal(frame_handoff.open_frame(path), input_data)
+        pd.testing.assert_frame_equal(frame_handoff.open_frame(path, ['C', 'A']), input_data[['C', 'A']])
+        frame_handoff.release_frame(path)
+        assert (not os.path.exists(path))
+
+        # Frames Arrow can't convert, or any frame without pyarrow, are pickled
+        mixed_data = pd.DataFrame({'A': [1, 'x']})
+        path = frame_handoff.publish_frame(mixed_data, 'mixed', self.interim_dir)
+        assert (path.endswith('.pkl'))
+        pd.testing.assert_frame_equal(frame_handoff.open_frame(path), mixed_data)
+        with unittest.mock.patch.object(frame_handoff, 'pa', None):
+            path = frame_handoff.publish_frame(input_data, 'no_arrow', self.interim_dir)
+        assert (path.endswith('.pkl'))
+        pd.testing.assert_frame_equal(frame_handoff.open_frame(path, ['B']), input_data[['B']])
+
+        # No temporary files are left behind
+        handoff_dir = os.path.join(self.interim_dir, frame_handoff.HANDOFF_DIRNAME)
+        assert (sorted(os.listdir(handoff_dir)) == ['mixed.pkl', 'no_arrow.pkl'])
+
+    def test_cleanup(self):
+        # Published frames are removed when the block fails...
+        with self.assertRaises(ValueError):
+            with frame_handoff.published_frame(pd.DataFrame({'A': [1]}), 'test', self.interim_dir) as path:
+                assert (os.path.exists(path))
+                raise ValueError()
+        assert (not os.path.exists(path))
+
+        # ...and any left behind by a killed run are removed by cleanup
+        frame_handoff.publish_frame(pd.DataFrame({'A': [1]}), 'left', self.interim_dir)
+        frame_handoff.cleanup(self.interim_dir)
+        assert (os.listdir(self.interim_dir) == [])
+
+    def test_parallel_transform(self):
+        input_data = pd.DataFrame({'Agency Name': ['A', 'B', 'C'],
+                                   '2015_G04_A_A': [100, '†', 300],
+                                   '2015_G05_A_A': [10, 20, '‡'],
+                                   '2016_G04_A_A': [1, 2, 3]})
+        data_cols = input_data.columns[1:].tolist()
+        expected = create_enroll_districts_csv.transform_column_groups(input_data, data_cols)
+
+        # Workers get pickled columns, or map the published frame
+        for handoff_dir in [None, self.interim_dir]:
+            output_data = create_enroll_districts_csv.transform_column_groups(input_data, data_cols, 2, handoff_dir)
+            pd.testing.assert_frame_equal(output_data, expected)
+        assert (os.listdir(os.path.join(self.interim_dir, frame_handoff.HANDOFF_DIRNAME)) == [])
+
+
+class SparseStorageTests(unittest.TestCase):
+    def test_round_trip(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        input_data = load('enroll_districts.csv').reset_index()
+        data_cols = [col for col in input_data.columns if col not in create_enroll_districts_csv.KEY_COLUMNS]
+        input_data[data_cols] = input_data[data_cols].astype(pd.SparseDtype('float64', np.nan))
+
+        output_path = os.path.join(output_dir, 'enroll_districts.npz')
+        create_enroll_districts_csv.write_sparse(input_data, output_path)
+        output_data = create_enroll_districts_csv.read_sparse(output_path)
+        assert (all(isinstance(output_data[col].dtype, pd.SparseDtype) for col in data_cols))
+        pd.testing.assert_frame_equal(output_data[data_cols].sparse.to_dense(),
+                                      input_data[data_cols].sparse.to_dense())
+        pd.testing.assert_frame_equal(output_data[create_enroll_districts_csv.KEY_COLUMNS],
+                                      input_data[create_enroll_districts_csv.KEY_COLUMNS], check_dtype=False)
+
+    def test_sparse_conversion(self):
+        # Converted group by group, the sparse columns hold the same cells as the dense ones
+        input_data = pd.DataFrame({'2016_G04_A_A': ['1', '†', '3'], '2016_G05_A_A': ['†', '†', '6'],
+                                   '2017_G04_A_A': ['7', '8', '†'], '2017_KG_A_A': ['†', '10', '†']})
+        data_cols = input_data.columns.tolist()
+        expected = create_enroll_districts_csv.transform_column_groups(input_data, data_cols)
+
+        output_data = create_enroll_districts_csv.transform_column_groups(input_data, data_cols, sparse=True)
+        assert (all(isinstance(dtype, pd.SparseDtype) for dtype in output_data.dtypes))
+        assert (output_data['G04_A_A'].sparse.density == 4 / 6)
+        pd.testing.assert_frame_equal(output_data.sparse.to_dense(), expected)
+
+    def test_density_report(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        pd.DataFrame({'A': [1, np.nan, np.nan, np.nan], 'B': [1, 2, 3, 4]}).to_csv(
+            os.path.join(output_dir, 'test.csv'), index=False)
+
+        data_sanity_check.main(logging.getLogger(__name__), output_dir, output_dir, 'test.csv', report_density=True)
+        with open(os.path.join(output_dir, 'sanity_check_test.csv')) as f:
+            report = f.read()
+        assert ('A: 0.250\nB: 1.000\nOverall: 0.625\n' in report)
+
+
+class YearPartitionTests(unittest.TestCase):
+    def test_append_only_ingestion(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        input_dir = os.path.join(work_dir, 'raw')
+        output_dir = os.path.join(work_dir, 'processed')
+        os.makedirs(input_dir)
+        os.makedirs(output_dir)
+        logger = logging.getLogger(__name__)
+        zip_name = create_finance_districts_csv.ZIP_NAME
+
+        # The first vintage of the archive only has 2016
+        with zipfile.ZipFile(os.path.join(pipeline_fixture.FIXTURE_RAW_DIR, zip_name)) as source:
+            with zipfile.ZipFile(os.path.join(input_dir, zip_name), 'w') as archive:
+                for item in source.namelist():
+                    if '17' not in item:
+                        archive.writestr(item, source.read(item))
+
+        parse = create_finance_districts_csv.elsect_spreadsheet_to_dataframe
+        parsed = []
+
+        def run():
+            def parse_logged(filename, logger=None):
+                parsed.append(filename)
+                return parse(filename, logger)
+
+            cwd = os.getcwd()
+            os.chdir(work_dir)
             try:
-                input_row = input_data[input_data['PRIMARY_KEY'] == f'{year}_IDAHO']
-                input_val = input_row['G04_A_A_READING'].iloc[0]
-
-                output_row = output_data[output_data['PRIMARY_KEY'] == f'{year}_IDAHO']
-                output_val = output_row['G04_A_A_READING'].iloc[0]
-
-                if np.isnan(input_val):
-                    assert (np.isnan(output_val))
-                else:
-                    assert (input_val == output_val)
-
-            except:
-                print(f'{year}')
-                raise Exception
+                with unittest.mock.patch.object(create_finance_districts_csv, 'elsect_spreadsheet_to_dataframe',
+                                                parse_logged):
+                    create_finance_districts_csv.main(logger, input_dir, output_dir, output_dir, partitioned=True)
+                create_finance_states_csv.main(logger, output_dir, output_dir, output_dir, partitioned=True)
+            finally:
+                os.chdir(cwd)
+
+        def partitions():
+            paths = [year_partitions.partition_path(output_dir, dataset, year)
+                     for dataset in ['finance_districts', 'finance_states']
+                     for year in year_partitions.partition_years(output_dir, dataset)]
+            return {path: os.path.getmtime(path) for path in paths}
+
+        def age(paths):
+            for path in paths:
+                os.utime(path, (time.time() - 100, time.time() - 100))
+
+        run()
+        age(partitions())
+        before = partitions()
+        assert (len(before) == 2)
+
+        # Adding a year only parses and aggregates that year
+        shutil.copy(os.path.join(pipeline_fixture.FIXTURE_RAW_DIR, zip_name), input_dir)
+        parsed.clear()
+        run()
+        after = partitions()
+        assert (parsed == ['US_CENSUS_FINANCE/elsec17.xls'])
+        assert ({path: after[path] for path in before} == before)
+        assert (sorted(os.path.relpath(path, output_dir) for path in set(after) - set(before)) ==
+                [os.path.join('finance_districts', 'YEAR=2017', 'part.parquet'),
+                 os.path.join('finance_states', 'YEAR=2017', 'part.parquet')])
+        pd.testing.assert_frame_equal(pd.read_csv(os.path.join(output_dir, 'finance_states.csv')),
+                                      load('finance_states.csv').reset_index(), check_like=True, check_dtype=False)
+
+        # A rewritten district partition makes its state partition stale
+        age(after)
+        after = partitions()
+        district_2016 = year_partitions.partition_path(output_dir, 'finance_districts', 2016)
+        os.utime(district_2016)
+        create_finance_states_csv.update_state_partitions(logger, output_dir, output_dir)
+        changed = [path for path, mtime in partitions().items() if mtime != after[path]]
+        assert (sorted(changed) == sorted([district_2016,
+                                           year_partitions.partition_path(output_dir, 'finance_states', 2016)]))
+
+        # Only the requested years are read
+        years = year_partitions.read_partitions(output_dir, 'finance_districts', years=['2017'])['YRDATA']
+        assert (set(years) == {'2017'})
+
+
+class OutputWriterTests(unittest.TestCase):
+    def test_compressed_round_trip(self):
+        output_dir = tempfile.mkdtemp()
+        input_data = pd.DataFrame({'PRIMARY_KEY': ['2017_A, B', '2017_C'], 'YEAR': [2017, 2017],
+                                   'A_A_A': [1.5, np.nan]})
+        input_data['G01_A_A'] = pd.arrays.SparseArray([np.nan, 2.0])
+
+        with unittest.mock.patch.object(output_writer, 'CHUNK_ROWS', 1):
+            for compress in ['gzip', 'zstd', None]:
+                output_writer.write_csv(input_data, output_dir, 'enroll.csv', compress)
+                output_data = output_writer.read_csv(output_dir, 'enroll.csv')
+                pd.testing.assert_frame_equal(output_data, input_data.assign(G01_A_A=[np.nan, 2.0]))
+
+        # Only the latest copy is kept
+        assert (os.listdir(output_dir) == ['enroll.csv'])
+        shutil.rmtree(output_dir)
+
+    def test_uncompressed_format(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        input_data = pd.DataFrame({'IDCENSUS': ['01', '02'], 'TOTALREV': [1.0, np.nan], 'MISMATCH': [True, False]})
+
+        # Written exactly as pandas writes it, chunked or not
+        with unittest.mock.patch.object(output_writer, 'CHUNK_ROWS', 1):
+            output_path = output_writer.write_csv(input_data, output_dir, 'finance.csv')
+        with open(output_path) as f:
+            assert (f.read() == input_data.to_csv(index=False))
+
+
+class CheckpointTests(unittest.TestCase):
+    def setUp(self):
+        self.interim_dir = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.interim_dir)
+
+    def stage(self, name, fail=False):
+        def run():
+            self.calls.append(name)
+            if fail:
+                raise MemoryError(name)
+        return name, run
+
+    def test_resume_from_failed_stage(self):
+        options = {'tidy': False}
+        stages = [self.stage('a'), self.stage('b', fail=True), self.stage('c')]
+        with self.assertRaises(MemoryError):
+            checkpoint.run_stages(stages, self.interim_dir, options)
+
+        # The resumed run picks up at the stage that failed
+        self.calls = []
+        stages = [self.stage('a'), self.stage('b'), self.stage('c')]
+        assert (checkpoint.run_stages(stages, self.interim_dir, options, resume=True) == ['b', 'c'])
+        assert (self.calls == ['b', 'c'])
+
+        # Different options invalidate the markers
+        assert (checkpoint.run_stages(stages, self.interim_dir, {'tidy': True}, resume=True) == ['a', 'b', 'c'])
+
+    def test_cleanup_on_failure(self):
+        # A failed write leaves neither the output nor its temporary file
+        output_path = os.path.join(self.interim_dir, 'out.csv')
+        with self.assertRaises(ValueError):
+            with checkpoint.atomic_output(output_path) as tmp_path:
+                pd.DataFrame({'A': [1]}).to_csv(tmp_path, index=False)
+                raise ValueError()
+        assert (os.listdir(self.interim_dir) == [])
+
+        # Unpacked archives are removed even if reading them fails
+        archive_path = os.path.join(self.interim_dir, 'TEST_SOURCE.zip')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('TEST_SOURCE/', b'')
+            archive.writestr('TEST_SOURCE/a.csv', b'A\n1\n')
+        cwd = os.getcwd()
+        os.chdir(self.interim_dir)
+        try:
+            with self.assertRaises(ValueError):
+                with checkpoint.extracted_archive(self.interim_dir, 'TEST_SOURCE.zip') as file_list:
+                    assert (file_list == ['TEST_SOURCE/a.csv'] and os.path.exists(file_list[0]))
+                    raise ValueError()
+            assert (not os.path.exists('TEST_SOURCE'))
+
+            # Leftovers of a killed run are found and removed
+            os.makedirs('TEST_SOURCE')
+            Path(output_path + '.tmp').touch()
+            removed = checkpoint.cleanup_partial([self.interim_dir], ['TEST_SOURCE.zip'])
+            assert (removed == [output_path + '.tmp', 'TEST_SOURCE'])
+            assert (os.listdir(self.interim_dir) == ['TEST_SOURCE.zip'])
+        finally:
+            os.chdir(cwd)
+
+
+class WatchTests(unittest.TestCase):
+    def setUp(self):
+        self.input_dir = tempfile.mkdtemp()
+        self.calls = []
+        self.write('A.zip', b'a')
+        self.write('B.zip', b'b')
+
+    def tearDown(self):
+        shutil.rmtree(self.input_dir)
+
+    def write(self, zip_name, contents):
+        with open(os.path.join(self.input_dir, zip_name), 'wb') as f:
+            f.write(contents)
+
+    def test_dependent_stages(self):
+        changed = watch.dependent_stages(pipeline.STAGE_INPUTS, ['NAEP_ASSESS_STATES.zip'])
+        assert (changed == ['naep_states_raw', 'naep_states', 'states_all', 'states_enriched', 'summaries'])
+
+        # Every stage reads an archive, directly or through other stages
+        assert (watch.dependent_stages(pipeline.STAGE_INPUTS, pipeline.SOURCE_ARCHIVES) ==
+                list(pipeline.STAGE_INPUTS))
+
+    def test_wait_for_changes(self):
+        state = watch.ArchiveState(self.input_dir, ['A.zip', 'B.zip'])
+
+        # A burst of writes is picked up once, after it ends
+        def copy():
+            for contents in [b'a1', b'a12', b'a123']:
+                time.sleep(0.05)
+                self.write('A.zip', contents)
+        writer = threading.Thread(target=copy)
+        writer.start()
+        changed = watch.wait_for_changes(state, poll_interval=0.02, debounce=0.3, timeout=5)
+        writer.join()
+        assert (changed == ['A.zip'])
+        assert (watch.wait_for_changes(state, poll_interval=0.02, debounce=0.1, timeout=0.3) == [])
+
+        # Rewriting an archive with the same contents doesn't count
+        os.utime(os.path.join(self.input_dir, 'B.zip'), ns=(0, 0))
+        assert (watch.wait_for_changes(state, poll_interval=0.02, debounce=0.1, timeout=0.5) == [])
+
+    def test_rebuild(self):
+        def stage(name):
+            return name, lambda: self.calls.append(name)
+
+        stages = [stage('a'), stage('b'), stage('c')]
+        options = {'tidy': False}
+        state = watch.ArchiveState(self.input_dir, ['A.zip', 'B.zip'])
+        checkpoint.run_stages(stages, self.input_dir, options)
+        self.write('B.zip', b'b2')
+
+        # Only the stages downstream of the changed archive run again
+        self.calls = []
+        watch.watch(state, stages, {'a': ['A.zip'], 'b': ['B.zip'], 'c': ['b']}, self.input_dir, options,
+                    logging.getLogger(__name__), poll_interval=0.02, debounce=0.05, max_rebuilds=1)
+        assert (self.calls == ['b', 'c'])
+        assert (all(checkpoint.is_complete(self.input_dir, name, options) for name in ['a', 'b', 'c']))
+
+
+class VintageTests(unittest.TestCase):
+    def test_diff_frames(self):
+        before = pd.DataFrame({'PRIMARY_KEY': ['2016_IDAHO', '2016_OHIO', '2017_IDAHO'],
+                               'A': [1, 2, np.nan], 'B': ['x', 'y', 'z'], 'C': [0, 0, 0]})
+        after = pd.DataFrame({'PRIMARY_KEY': ['2016_IDAHO', '2016_OHIO', '2018_IDAHO'],
+                              'A': [1.0, 3.0, 4.0], 'B': ['x', None, 'z'], 'D': [0, 0, 0]})
+        diff = vintages.diff_frames(before, after, ['PRIMARY_KEY'])
+        changes = set(map(tuple, diff[['KEY', 'COLUMN', 'CHANGE']].fillna('').to_numpy()))
+
+        # 1 and 1.0 are the same number; the row only in one vintage isn't compared cell by cell
+        assert (changes == {('2017_IDAHO', '', 'row removed'), ('2018_IDAHO', '', 'row added'),
+                            ('', 'C', 'column removed'), ('', 'D', 'column added'),
+                            ('2016_OHIO', 'A', 'cell changed'), ('2016_OHIO', 'B', 'cell changed')})
+        assert (diff.set_index(['KEY', 'COLUMN']).loc[('2016_OHIO', 'A'), 'AFTER'] == 3)
+
+        assert (vintages.diff_frames(before, before, ['PRIMARY_KEY']).empty)
+
+    def test_parse_cache(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        self.addCleanup(parse_cache.configure, None)
+        for vintage, contents in [('2019', 'A\n1\n'), ('2021', 'A\n1\n'), ('2022', 'A\n2\n')]:
+            os.makedirs(os.path.join(work_dir, vintage))
+            with open(os.path.join(work_dir, vintage, 'a.csv'), 'w') as f:
+                f.write(contents)
+
+        calls = []
+
+        def parser(path, logger=None):
+            calls.append(path)
+            return pd.read_csv(path)
+
+        # A member identical in two vintages (each unpacked in its own directory) is only parsed once
+        parse_cache.configure(os.path.join(work_dir, 'cache'))
+        cwd = os.getcwd()
+        outputs = []
+        try:
+            for vintage in ['2019', '2021', '2022']:
+                os.chdir(os.path.join(work_dir, vintage))
+                outputs.append(parse_cache.parse('a.csv', parser))
+        finally:
+            os.chdir(cwd)
+        assert (len(calls) == 2)
+        pd.testing.assert_frame_equal(outputs[0], outputs[1])
+        assert (outputs[2].loc[0, 'A'] == 2)
+
+        # Without a cache, every member is parsed
+        parse_cache.configure(None)
+        parse_cache.parse(os.path.join(work_dir, '2019', 'a.csv'), parser)
+        assert (len(calls) == 3)
+
+
+class IndexedJoinTests(unittest.TestCase):
+    def test_outer_join_and_coverage(self):
+        # Two sources that only partially overlap
+        finance = pd.DataFrame({'YEAR': [2016, 2017], 'STATE': ['IDAHO', 'IDAHO'], 'ENROLL': [1, 2]})
+        achieve = pd.DataFrame({'YEAR': [2017, 2019], 'STATE': ['IDAHO', 'IDAHO'], 'SCORE': [220, 223]})
+
+        output_data, coverage = indexed_join.indexed_join({'finance': finance, 'achieve': achieve},
+                                                          ['YEAR', 'STATE'])
+
+        assert (output_data['YEAR'].tolist() == [2016, 2017, 2019])
+        assert (output_data['ENROLL'].iloc[1] == 2)
+        assert (output_data['SCORE'].iloc[1] == 220)
+        assert (np.isnan(output_data['SCORE'].iloc[0]))
+        assert (coverage['MATCHED'].tolist() == [2, 2])
 
 
 if __name__ == '__main__':